@@ -1,5 +1,10 @@
+import os
+
 from chalice import Chalice
-from chalicelib import api, prmbot
+
+# Blueprints this deployment serves. A stage can set it to just one of them in
+# its environment_variables, so its functions only import what they run.
+SLING_BLUEPRINTS = os.environ.get("SLING_BLUEPRINTS", "lockapi,prmbot").split(",")
 
 # Setup
 app = Chalice(app_name="state_management")
@@ -8,5 +13,11 @@ app.debug = True
 
 # Blueprints confirmed to be fully supported
 app.experimental_feature_flags.update(["BLUEPRINTS"])
-app.register_blueprint(api.lockapi)
-app.register_blueprint(prmbot.prmbot)
+if "lockapi" in SLING_BLUEPRINTS:
+    from chalicelib.api import lockapi
+
+    app.register_blueprint(lockapi)
+if "prmbot" in SLING_BLUEPRINTS:
+    from chalicelib.prmbot import prmbot
+
+    app.register_blueprint(prmbot)
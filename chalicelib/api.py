@@ -1,11 +1,18 @@
-import boto3
+import os
+import random
+import threading
+import time
 import uuid
 import logging
 
-from botocore.exceptions import ClientError
+from collections import OrderedDict
+
+from botocore.exceptions import BotoCoreError, ClientError
 from datetime import datetime
 from chalice import Response, BadRequestError, Blueprint
 
+from .storage import get_client
+
 
 lockapi = Blueprint(__name__)
 
@@ -15,35 +22,1409 @@ logger = logging.getLogger(__name__)
 console = logging.StreamHandler
 logger.addHandler(console)
 
+# DynamoDB rejects transactions that touch more items than this
+MAX_TRANSACTION_ITEMS = 100
+
+# Longest lease, in seconds, a single acquire or renew may ask for
+MAX_LEASE_DURATION = 24 * 60 * 60
+
+# How a caller may hold a lock. Any number of shared holders may hold a lock that
+# has no exclusive holder. Semaphore locks are registered with a number of Permits
+# and can have that many holders at once.
+EXCLUSIVE_MODE = "exclusive"
+SHARED_MODE = "shared"
+SEMAPHORE_MODE = "semaphore"
+LOCK_MODES = (EXCLUSIVE_MODE, SHARED_MODE, SEMAPHORE_MODE)
+
+# Highest priority an acquire may ask for. Routine acquires have priority 0.
+MAX_PRIORITY = 100
+
+# Fields botocore adds to every ResponseMetadata, which compact responses leave out
+# along with the Message meant for people
+BOTO_RESPONSE_FIELDS = ("RequestId", "HTTPStatusCode", "HTTPHeaders", "RetryAttempts")
+
+# Header a caller sets to full or compact to pick the format of successful responses
+RESPONSE_FORMAT_HEADER = "X-Sling-Response-Format"
+FULL_RESPONSE_FORMAT = "full"
+COMPACT_RESPONSE_FORMAT = "compact"
+RESPONSE_FORMATS = (FULL_RESPONSE_FORMAT, COMPACT_RESPONSE_FORMAT)
+
+# Separates the levels of hierarchical lock names, as in repo/branch/path
+LOCK_NAME_SEPARATOR = "/"
+
+# Expired entries of a lock row cleared in one update, which keeps its expressions
+# well within DynamoDB's size limits
+MAX_PRUNED_ENTRIES = 25
+
+# Times an enqueue tries both drawing into a queue with waiters and into an empty one,
+# each of which fails if another caller changes the queue from one to the other first
+ENQUEUE_ROUNDS = 2
+
+# Environmental Variables
+# Seconds the waiter at the head of a lock's queue has to take the lock once it is
+# free before waiters behind it may skip it
+QUEUE_HEAD_GRACE_PERIOD = float(os.environ.get("QUEUE_HEAD_GRACE_PERIOD", 30))
+
+# Seconds a pending high-priority acquire keeps lower priorities out. Callers that
+# keep retrying, such as /acquire_wait, refresh it on every failed attempt.
+PENDING_PRIORITY_PERIOD = float(os.environ.get("PENDING_PRIORITY_PERIOD", 60))
+
+# Format of successful responses for callers that don't send RESPONSE_FORMAT_HEADER
+RESPONSE_FORMAT = os.environ.get("RESPONSE_FORMAT", FULL_RESPONSE_FORMAT)
+
+# Seconds a warm container trusts that a service it saw registered still is, and how
+# many services it remembers. A TTL of 0 checks the service table on every acquire.
+SERVICE_CACHE_TTL = float(os.environ.get("SERVICE_CACHE_TTL", 60))
+SERVICE_CACHE_SIZE = int(os.environ.get("SERVICE_CACHE_SIZE", 1024))
+
+# API Gateway gives up on an integration after 29 seconds, so waits stop short of that
+ACQUIRE_WAIT_MAX_TIMEOUT = float(os.environ.get("ACQUIRE_WAIT_MAX_TIMEOUT", 25))
+
+# Seconds between acquire attempts start around the base and back off up to the cap
+ACQUIRE_WAIT_BACKOFF_BASE = 0.05
+ACQUIRE_WAIT_BACKOFF_CAP = 1.0
+
+# Seconds kept aside so a wait never runs into the Lambda timeout
+LAMBDA_TIMEOUT_MARGIN = 1.0
+
 
 class ValidationException(Exception):
     pass
 
 
 class SingletonDynamoDBClient:
+    """Holds the client for the storage backend picked by the STORAGE_BACKEND setting."""
+
     __instance = None
 
     @classmethod
     def getInstance(cls):
         if cls.__instance is None:
-            client = boto3.client("dynamodb")
+            client = get_client()
             cls.__instance = client
         return cls.__instance
 
 
+class ServiceRegistryCache:
+    """Remembers which services were recently seen registered, for up to ttl seconds.
+
+    Acquires by a remembered service leave the service check out of their
+    transaction. The least recently used service is forgotten once max_size are
+    remembered. Other containers keep their own cache, so a service deregistered
+    elsewhere may keep acquiring here until its entry runs out.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.expiries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def contains(self, service_table_name, service_name):
+        key = (service_table_name, service_name)
+        with self.lock:
+            expiry = self.expiries.get(key)
+            if expiry is None:
+                return False
+            if expiry < time.time():
+                del self.expiries[key]
+                return False
+            self.expiries.move_to_end(key)
+            return True
+
+    def add(self, service_table_name, service_name):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        key = (service_table_name, service_name)
+        with self.lock:
+            self.expiries[key] = time.time() + self.ttl
+            self.expiries.move_to_end(key)
+            while len(self.expiries) > self.max_size:
+                self.expiries.popitem(last=False)
+
+    def discard(self, service_table_name, service_name):
+        with self.lock:
+            self.expiries.pop((service_table_name, service_name), None)
+
+    def clear(self):
+        with self.lock:
+            self.expiries.clear()
+
+
+service_registry = ServiceRegistryCache(SERVICE_CACHE_TTL, SERVICE_CACHE_SIZE)
+
+
+# Built while the container starts, so the first request doesn't wait for it.
+# Without a region or credentials it is built on the first request instead.
+try:
+    SingletonDynamoDBClient.getInstance()
+except BotoCoreError as e:
+    logger.debug(str(e))
+
+
+def get_response_format():
+    """Returns the response format the current request asked for.
+
+    Like an Accept header, a format the API doesn't know falls back to RESPONSE_FORMAT.
+    """
+
+    headers = lockapi.current_request.headers
+    response_format = headers.get(RESPONSE_FORMAT_HEADER, "").lower()
+    return response_format if response_format in RESPONSE_FORMATS else RESPONSE_FORMAT
+
+
+def format_response(response):
+    """Formats a successful response in the format the current request asked for.
+
+    Compact responses keep just the fields Sling added to ResponseMetadata, such as
+    JobId, FencingToken and LeaseExpiry, so they stay readable by the same clients.
+    """
+
+    if get_response_format() == FULL_RESPONSE_FORMAT:
+        return response
+    return {
+        "ResponseMetadata": {
+            field: value
+            for field, value in response["ResponseMetadata"].items()
+            if field not in BOTO_RESPONSE_FIELDS and field != "Message"
+        }
+    }
+
+
 def check_fields(api_data, fields_list):
     """Checks if every element of fields_list appears inside api_data."""
 
-    missing_fields = [field for field in fields_list if field not in api_data]
-    if len(missing_fields) > 0:
-        miss_msg = "Missing the following fields in your request: %s" % missing_fields
-        raise BadRequestError(miss_msg)
+    missing_fields = [field for field in fields_list if field not in api_data]
+    if len(missing_fields) > 0:
+        miss_msg = "Missing the following fields in your request: %s" % missing_fields
+        raise BadRequestError(miss_msg)
+
+
+def service_check_item(service_table_name, service_name):
+    """Builds the transaction item that requires service_name to be registered.
+
+    It must be the first item of a transaction for service_check_failed to find it.
+    """
+
+    return {
+        "ConditionCheck": {
+            "TableName": service_table_name,
+            "Key": {"ServiceName": {"S": service_name}},
+            "ConditionExpression": "attribute_exists(ServiceName)",
+        }
+    }
+
+
+def service_check_failed(client_error):
+    """Checks if a cancelled transaction was cancelled by its leading service check."""
+
+    if not client_error.response.get("ServiceChecked", True):
+        return False
+    reasons = client_error.response.get("CancellationReasons", [])
+    return len(reasons) > 0 and reasons[0].get("Code") == "ConditionalCheckFailed"
+
+
+def checked_transact_write_items(client, service_table_name, service_name, items):
+    """Writes items in one transaction that also requires service_name to be registered.
+
+    The service check is left out for services in service_registry. A ClientError
+    raised for the transaction records whether it had the check under ServiceChecked.
+    """
+
+    service_checked = not service_registry.contains(service_table_name, service_name)
+    if service_checked:
+        items = [service_check_item(service_table_name, service_name)] + items
+    try:
+        response = client.transact_write_items(TransactItems=items)
+    except ClientError as e:
+        e.response["ServiceChecked"] = service_checked
+        # A transaction cancelled by something else still shows the service exists
+        if (
+            service_checked
+            and e.response.get("CancellationReasons")
+            and not service_check_failed(e)
+        ):
+            service_registry.add(service_table_name, service_name)
+        raise
+    if service_checked:
+        service_registry.add(service_table_name, service_name)
+    return response
+
+
+def get_lease_duration(api_data):
+    """Returns the lease length in seconds requested in api_data, or None without a lease."""
+
+    lease_duration = api_data.get("LeaseDuration")
+    if lease_duration is None:
+        return None
+    if (
+        isinstance(lease_duration, bool)
+        or not isinstance(lease_duration, (int, float))
+        or not 0 < lease_duration <= MAX_LEASE_DURATION
+    ):
+        raise BadRequestError(
+            "LeaseDuration must be a number of seconds between 0 and %s"
+            % MAX_LEASE_DURATION
+        )
+    return lease_duration
+
+
+def get_lease_expiry(lease_duration, now):
+    """Returns the epoch time a lease of lease_duration taken at now runs out."""
+
+    if lease_duration is None:
+        return None
+    return now + lease_duration
+
+
+def get_mode(api_data):
+    """Returns how the caller in api_data wants to hold a lock, exclusively by default."""
+
+    mode = api_data.get("Mode", EXCLUSIVE_MODE)
+    if mode not in LOCK_MODES:
+        raise BadRequestError("Mode must be one of the following: %s" % (LOCK_MODES,))
+    return mode
+
+
+def check_mode_options(
+    mode, ticket, hierarchical=False, priority=0, idempotency_key=None
+):
+    """Checks that options only exclusive holders support aren't used with another mode.
+
+    Every mode may take a lease.
+    """
+
+    if mode != EXCLUSIVE_MODE and (
+        ticket is not None or hierarchical or priority or idempotency_key is not None
+    ):
+        raise BadRequestError(
+            "Ticket, Hierarchical, Priority and IdempotencyKey are only supported for %s locks"
+            % EXCLUSIVE_MODE
+        )
+
+
+def get_idempotency_key(api_data):
+    """Returns the key the caller in api_data sent to make its retries safe, or None."""
+
+    idempotency_key = api_data.get("IdempotencyKey")
+    if idempotency_key is None:
+        return None
+    if not isinstance(idempotency_key, str) or not idempotency_key:
+        raise BadRequestError("IdempotencyKey must be a non-empty string")
+    return idempotency_key
+
+
+def get_priority(api_data):
+    """Returns the priority the caller in api_data asked for, 0 if it didn't ask for one."""
+
+    priority = api_data.get("Priority", 0)
+    if (
+        isinstance(priority, bool)
+        or not isinstance(priority, int)
+        or not 0 <= priority <= MAX_PRIORITY
+    ):
+        raise BadRequestError(
+            "Priority must be an integer between 0 and %s" % MAX_PRIORITY
+        )
+    return priority
+
+
+def yield_requested(row_dict, now):
+    """Checks if a dictified lock row has a pending acquire that outranks its holder."""
+
+    if not row_dict.get("HeldBy") or "PendingPriority" not in row_dict:
+        return False
+    return float(row_dict["PendingPriorityExpiry"]) >= now and int(
+        row_dict["PendingPriority"]
+    ) > int(row_dict.get("HolderPriority", 0))
+
+
+def get_hierarchical(api_data):
+    """Returns whether the caller in api_data treats the lock name as a hierarchy."""
+
+    hierarchical = api_data.get("Hierarchical", False)
+    if not isinstance(hierarchical, bool):
+        raise BadRequestError("Hierarchical must be true or false")
+    if hierarchical and "" in api_data["LockName"].split(LOCK_NAME_SEPARATOR):
+        raise BadRequestError(
+            "Hierarchical lock names can't have empty levels: %s" % api_data["LockName"]
+        )
+    return hierarchical
+
+
+def ancestor_lock_names(lock_name):
+    """Returns the names of every lock above lock_name, starting from the top."""
+
+    levels = lock_name.split(LOCK_NAME_SEPARATOR)
+    return [LOCK_NAME_SEPARATOR.join(levels[:depth]) for depth in range(1, len(levels))]
+
+
+def get_ticket(api_data):
+    """Returns the queue ticket a caller sent in api_data, or None if it isn't queued."""
+
+    ticket = api_data.get("Ticket")
+    if ticket is None:
+        return None
+    if isinstance(ticket, bool) or not isinstance(ticket, int) or ticket < 1:
+        raise BadRequestError("Ticket must be a positive integer")
+    return ticket
+
+
+def read_lock_rows(client, lock_table_name, lock_names):
+    """Reads the rows of lock_names with strongly consistent reads, by lock name.
+
+    One lock is read with get_item and several with batch_get_item, which unlike
+    transact_get_items costs no more than the reads themselves.
+    """
+
+    keys = [{"LockName": {"S": lock_name}} for lock_name in lock_names]
+    if len(keys) == 1:
+        item = client.get_item(
+            TableName=lock_table_name, Key=keys[0], ConsistentRead=True
+        ).get("Item")
+        return {lock_names[0]: item} if item is not None else {}
+
+    rows = {}
+    while keys:
+        read_resp = client.batch_get_item(
+            RequestItems={lock_table_name: {"Keys": keys, "ConsistentRead": True}}
+        )
+        for item in read_resp["Responses"].get(lock_table_name, []):
+            rows[item["LockName"]["S"]] = item
+        # Keys DynamoDB didn't get to, such as when it throttled the read, are read again
+        keys = read_resp.get("UnprocessedKeys", {}).get(lock_table_name, {}).get("Keys", [])
+    return rows
+
+
+def held_fencing_token(row, job_id, mode=EXCLUSIVE_MODE):
+    """Returns the fencing token job_id holds in a lock row, or None if it doesn't hold it.
+
+    row may be a whole lock row, or only the attributes an acquire updated.
+    """
+
+    if mode == SEMAPHORE_MODE:
+        fencing_token = (
+            row.get("HolderTokens", {}).get("M", {}).get(job_id, {}).get("N")
+        )
+    elif row.get("JobId", {}).get("S") == job_id:
+        fencing_token = row.get("FencingToken", {}).get("N")
+    else:
+        fencing_token = None
+    return int(fencing_token) if fencing_token is not None else None
+
+
+def acquired_fencing_tokens(client, lock_table_name, job_ids, mode=EXCLUSIVE_MODE):
+    """Returns the fencing tokens handed out with the JobIds in job_ids, by lock name.
+
+    Each lock counts its acquires in FencingToken. DynamoDB transactions can't return
+    updated values, so the counts are read back once an acquire that needed a
+    transaction went through. A lock whose lease already ran out and was taken over
+    by then gets None.
+    """
+
+    rows = read_lock_rows(client, lock_table_name, list(job_ids))
+    return {
+        lock_name: held_fencing_token(rows.get(lock_name, {}), job_id, mode)
+        for lock_name, job_id in job_ids.items()
+    }
+
+
+def write_lock_item(client, lock_item):
+    """Writes the only item of an acquire with update_item, returning what it updated.
+
+    An update costs half of a transaction, and unlike one hands back the FencingToken
+    it incremented. A failed condition is raised as the TransactionCanceledException
+    a transaction would have raised, with the lock row read back if the item asked
+    for it on failure, so callers handle both the same way.
+    """
+
+    request = dict(lock_item["Update"])
+    return_values = request.pop("ReturnValuesOnConditionCheckFailure", "NONE")
+    try:
+        return client.update_item(ReturnValues="UPDATED_NEW", **request)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+        reason = {"Code": "ConditionalCheckFailed", "Message": str(e)}
+        if return_values == "ALL_OLD":
+            item = client.get_item(
+                TableName=request["TableName"], Key=request["Key"], ConsistentRead=True
+            ).get("Item")
+            if item is not None:
+                reason["Item"] = item
+        e.response["Error"]["Code"] = "TransactionCanceledException"
+        e.response["CancellationReasons"] = [reason]
+        e.response["ServiceChecked"] = False
+        raise
+
+
+def get_fencing_token(api_data):
+    """Returns the fencing token a caller sent in api_data, or None if it didn't send one."""
+
+    fencing_token = api_data.get("FencingToken")
+    if fencing_token is None:
+        return None
+    if isinstance(fencing_token, bool) or not isinstance(fencing_token, int):
+        raise BadRequestError("FencingToken must be an integer")
+    return fencing_token
+
+
+def acquire_update_item(
+    lock_table_name,
+    lock_name,
+    service_name,
+    date_time,
+    job_id,
+    now,
+    lease_expiry=None,
+    ticket=None,
+    priority=0,
+    idempotency_key=None,
+    hierarchical=False,
+):
+    """Builds the transaction item that hands an unheld or expired lock to service_name.
+
+    A caller holding a queue ticket only gets the lock while its ticket is at the head
+    of the queue. A caller without one only gets it while nobody is queued. Either way,
+    a pending acquire of higher priority keeps it out. A cancelled transaction hands
+    back the lock row, so marks left by holders below that are gone can be cleared.
+    """
+
+    update_expression = "SET HeldBy = :held_by, Lock_Acquire_DateTime = :date_time, JobId = :job_id, FencingToken = if_not_exists(FencingToken, :zero) + :one, QueueHeadExpiry = :queue_head_expiry, HolderPriority = :priority"
+    expression_attribute_values = {
+        ":held_by": {"S": service_name},
+        ":empty_string": {"S": ""},
+        ":date_time": {"S": date_time},
+        ":job_id": {"S": job_id},
+        ":now": {"N": str(now)},
+        ":zero": {"N": "0"},
+        ":one": {"N": "1"},
+        ":priority": {"N": str(priority)},
+        # The next waiter's turn starts once this holder's lease could have run out
+        ":queue_head_expiry": {
+            "N": str((lease_expiry or now) + QUEUE_HEAD_GRACE_PERIOD)
+        },
+    }
+    condition_expressions = [
+        # Semaphores are only handed out through semaphore_acquire_update_item
+        "attribute_not_exists(Permits)",
+        # A lock whose lease ran out may be taken over by a new holder
+        "((HeldBy = :empty_string AND JobId = :empty_string) OR LeaseExpiry < :now)",
+        # Shared holders keep exclusive holders out until the last one releases
+        "(attribute_not_exists(ReaderCount) OR ReaderCount = :zero)",
+        # So do holders of any lock below this one in the hierarchy
+        "(attribute_not_exists(Intentions) OR size(Intentions) = :zero)",
+        "(attribute_not_exists(PendingPriority) OR PendingPriority <= :priority OR PendingPriorityExpiry < :now)",
+    ]
+
+    if ticket is None:
+        condition_expressions.append(
+            "(attribute_not_exists(QueueHead) OR QueueHead > QueueTail OR QueueHeadExpiry < :now)"
+        )
+    else:
+        # A head that let its turn expire may only be skipped by the ticket right behind
+        # it. Tickets further back move the head along with skip_expired_queue_head.
+        update_expression += ", QueueHead = :next_ticket"
+        expression_attribute_values[":ticket"] = {"N": str(ticket)}
+        expression_attribute_values[":previous_ticket"] = {"N": str(ticket - 1)}
+        expression_attribute_values[":next_ticket"] = {"N": str(ticket + 1)}
+        condition_expressions.append(
+            "(QueueHead = :ticket OR (QueueHead = :previous_ticket AND QueueHeadExpiry < :now))"
+        )
+
+    # Whatever was pending has been outranked or has expired by now
+    remove_attributes = ["PendingPriority", "PendingPriorityExpiry"]
+    if lease_expiry is None:
+        remove_attributes.append("LeaseExpiry")
+    else:
+        update_expression += ", LeaseExpiry = :lease_expiry"
+        expression_attribute_values[":lease_expiry"] = {"N": str(lease_expiry)}
+    # The key lets a retried acquire find out it already got the lock
+    if idempotency_key is None:
+        remove_attributes.append("IdempotencyKey")
+    else:
+        update_expression += ", IdempotencyKey = :idempotency_key"
+        expression_attribute_values[":idempotency_key"] = {"S": idempotency_key}
+    # Kept so a release clears the marks above the lock even if it doesn't say so
+    if hierarchical:
+        update_expression += ", Hierarchical = :hierarchical"
+        expression_attribute_values[":hierarchical"] = {"BOOL": True}
+    else:
+        remove_attributes.append("Hierarchical")
+    update_expression += " REMOVE " + ", ".join(remove_attributes)
+
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": lock_name}},
+            "UpdateExpression": update_expression,
+            "ExpressionAttributeValues": expression_attribute_values,
+            "ConditionExpression": " AND ".join(condition_expressions),
+            "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+        }
+    }
+
+
+def shared_acquire_update_item(
+    lock_table_name, lock_name, service_name, date_time, job_id, now, lease_expiry=None
+):
+    """Builds the transaction item that adds job_id to the shared holders of a lock.
+
+    Shared holders are kept in a Readers map keyed by JobId, next to a ReaderCount.
+    A holder with a lease_expiry keeps exclusive holders out until it runs out, after
+    which prune_expired_readers clears it.
+    """
+
+    reader = {
+        "ServiceName": {"S": service_name},
+        "Lock_Acquire_DateTime": {"S": date_time},
+    }
+    if lease_expiry is not None:
+        reader["LeaseExpiry"] = {"N": str(lease_expiry)}
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": lock_name}},
+            # An exclusive holder whose lease ran out is cleared out of the way
+            "UpdateExpression": "SET HeldBy = :empty_string, JobId = :empty_string, Readers.#job_id = :reader ADD ReaderCount :one REMOVE LeaseExpiry",
+            "ExpressionAttributeNames": {"#job_id": job_id},
+            "ExpressionAttributeValues": {
+                ":empty_string": {"S": ""},
+                ":reader": {"M": reader},
+                ":one": {"N": "1"},
+                ":zero": {"N": "0"},
+                ":now": {"N": str(now)},
+            },
+            # Shared holders have priority 0, so any pending priority keeps them out
+            "ConditionExpression": "attribute_not_exists(Permits) AND ((HeldBy = :empty_string AND JobId = :empty_string) OR LeaseExpiry < :now) AND (attribute_not_exists(QueueHead) OR QueueHead > QueueTail OR QueueHeadExpiry < :now) AND (attribute_not_exists(Intentions) OR size(Intentions) = :zero) AND (attribute_not_exists(PendingPriority) OR PendingPriority <= :zero OR PendingPriorityExpiry < :now)",
+            "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+        }
+    }
+
+
+def intention_update_item(
+    lock_table_name, ancestor_name, lock_name, job_id, lease_expiry, now
+):
+    """Builds the transaction item that marks ancestor_name as having lock_name held below it.
+
+    Intentions is a map from the names of held locks below the ancestor to the JobId
+    and LeaseExpiry they are held under. While it is non-empty, the ancestor itself
+    can't be acquired. Keying it by lock name means a holder taking over an expired
+    lock re-marks the same entry instead of leaking one.
+    """
+
+    intention = {"JobId": {"S": job_id}}
+    if lease_expiry is not None:
+        intention["LeaseExpiry"] = {"N": str(lease_expiry)}
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": ancestor_name}},
+            "UpdateExpression": "SET Intentions.#lock_name = :intention",
+            "ExpressionAttributeNames": {"#lock_name": lock_name},
+            "ExpressionAttributeValues": {
+                ":intention": {"M": intention},
+                ":empty_string": {"S": ""},
+                ":zero": {"N": "0"},
+                ":now": {"N": str(now)},
+            },
+            "ConditionExpression": "attribute_exists(LockName) AND ((HeldBy = :empty_string AND JobId = :empty_string) OR LeaseExpiry < :now) AND (attribute_not_exists(ReaderCount) OR ReaderCount = :zero)",
+        }
+    }
+
+
+def intention_release_update_item(lock_table_name, ancestor_name, lock_name):
+    """Builds the transaction item that clears the mark lock_name left on ancestor_name."""
+
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": ancestor_name}},
+            "UpdateExpression": "REMOVE Intentions.#lock_name",
+            "ExpressionAttributeNames": {"#lock_name": lock_name},
+            "ConditionExpression": "attribute_exists(LockName)",
+        }
+    }
+
+
+def document_path_invalid(client_error):
+    """Checks if a write failed because it set a path under a map the item doesn't have."""
+
+    error = client_error.response.get("Error", {})
+    if error.get("Code") == "ValidationException":
+        return "document path" in error.get("Message", "")
+    return any(
+        reason.get("Code") == "ValidationError"
+        for reason in client_error.response.get("CancellationReasons", [])
+    )
+
+
+def add_empty_maps(client, lock_table_name, lock_names, attribute_name):
+    """Gives the registered locks among lock_names an empty map attribute_name if they have none.
+
+    Locks registered before intentions and shared holders were kept in maps don't
+    have Intentions or Readers, and an entry can't be set in a map that doesn't exist.
+    """
+
+    for lock_name in lock_names:
+        try:
+            client.update_item(
+                TableName=lock_table_name,
+                Key={"LockName": {"S": lock_name}},
+                UpdateExpression="SET #map = if_not_exists(#map, :empty_map)",
+                ExpressionAttributeNames={"#map": attribute_name},
+                ExpressionAttributeValues={":empty_map": {"M": {}}},
+                ConditionExpression="attribute_exists(LockName)",
+            )
+        except ClientError as e:
+            logger.debug(str(e))
+
+
+def cancelled_lock_row(client_error, lock_name):
+    """Returns the row of lock_name a cancelled transaction handed back, or None."""
+
+    for reason in client_error.response.get("CancellationReasons", []):
+        item = reason.get("Item", {})
+        if item.get("LockName", {}).get("S") == lock_name:
+            return item
+    return None
+
+
+def prune_stale_intentions(client, lock_table_name, lock_name, row, now):
+    """Clears the marks on lock_name left by holders below it that no longer hold their lock.
+
+    Only marks whose LeaseExpiry has passed are checked. The lock below is read, as
+    its holder may have renewed the lease since, and the mark is cleared if the lock
+    was taken over or its lease did run out. Returns whether any mark was cleared.
+    """
+
+    intentions = row.get("Intentions", {}).get("M", {})
+    expired_names = [
+        below_name
+        for below_name, intention in intentions.items()
+        if float(intention["M"].get("LeaseExpiry", {}).get("N", now)) < now
+    ][:MAX_TRANSACTION_ITEMS]
+    if len(expired_names) == 0:
+        return False
+
+    read_resp = client.transact_get_items(
+        TransactItems=[
+            {
+                "Get": {
+                    "TableName": lock_table_name,
+                    "Key": {"LockName": {"S": below_name}},
+                }
+            }
+            for below_name in expired_names
+        ]
+    )
+    remove_paths = []
+    condition_expressions = []
+    expression_attribute_names = {}
+    expression_attribute_values = {}
+    for index, (below_name, item) in enumerate(
+        zip(expired_names, read_resp["Responses"])
+    ):
+        below = dictify_resp([item])
+        job_id = intentions[below_name]["M"]["JobId"]["S"]
+        if below.get("JobId") == job_id and float(below.get("LeaseExpiry", now)) >= now:
+            continue
+        expression_attribute_names["#lock_name%s" % index] = below_name
+        expression_attribute_values[":job_id%s" % index] = {"S": job_id}
+        remove_paths.append("Intentions.#lock_name%s" % index)
+        # A holder that took the lock below over in the meantime left its own mark
+        condition_expressions.append(
+            "Intentions.#lock_name%s.JobId = :job_id%s" % (index, index)
+        )
+    if len(remove_paths) == 0:
+        return False
+
+    try:
+        client.update_item(
+            TableName=lock_table_name,
+            Key={"LockName": {"S": lock_name}},
+            UpdateExpression="REMOVE " + ", ".join(remove_paths),
+            ExpressionAttributeNames=expression_attribute_names,
+            ExpressionAttributeValues=expression_attribute_values,
+            ConditionExpression=" AND ".join(condition_expressions),
+        )
+    except ClientError as e:
+        logger.debug(str(e))
+        return False
+    return True
+
+
+def prune_expired_entries(
+    client, lock_table_name, lock_name, row, now, map_names, count_name
+):
+    """Clears the holders of lock_name in the maps map_names whose lease has run out.
+
+    Holders are keyed by JobId, and the first of map_names holds their LeaseExpiry.
+    count_name is lowered by the number cleared. The update only removes holders whose
+    LeaseExpiry is still in the past, so a holder that renewed in the meantime keeps
+    its hold. Returns whether any was cleared.
+    """
+
+    holders = row.get(map_names[0], {}).get("M", {})
+    expired_job_ids = [
+        job_id
+        for job_id, holder in holders.items()
+        if float(holder["M"].get("LeaseExpiry", {}).get("N", now)) < now
+    ][:MAX_PRUNED_ENTRIES]
+    if len(expired_job_ids) == 0:
+        return False
+
+    job_id_names = {
+        "#job_id%s" % index: job_id for index, job_id in enumerate(expired_job_ids)
+    }
+    try:
+        client.update_item(
+            TableName=lock_table_name,
+            Key={"LockName": {"S": lock_name}},
+            UpdateExpression="REMOVE "
+            + ", ".join(
+                "%s.%s" % (map_name, name)
+                for name in job_id_names
+                for map_name in map_names
+            )
+            + " ADD #count :released",
+            ExpressionAttributeNames={**job_id_names, "#count": count_name},
+            ExpressionAttributeValues={
+                ":released": {"N": str(-len(expired_job_ids))},
+                ":now": {"N": str(now)},
+            },
+            ConditionExpression=" AND ".join(
+                "%s.%s.LeaseExpiry < :now" % (map_names[0], name)
+                for name in job_id_names
+            ),
+        )
+    except ClientError as e:
+        logger.debug(str(e))
+        return False
+    return True
+
+
+def prune_expired_readers(client, lock_table_name, lock_name, row, now):
+    """Clears the shared holders of lock_name whose lease has run out."""
+
+    return prune_expired_entries(
+        client, lock_table_name, lock_name, row, now, ("Readers",), "ReaderCount"
+    )
+
+
+def prune_expired_semaphore_holders(client, lock_table_name, lock_name, row, now):
+    """Clears the holders of a semaphore whose lease has run out, freeing their permits."""
+
+    return prune_expired_entries(
+        client,
+        lock_table_name,
+        lock_name,
+        row,
+        now,
+        ("Holders", "HolderTokens"),
+        "HolderCount",
+    )
+
+
+def prune_stale_holders(client, lock_table_name, lock_name, row, now):
+    """Clears whatever in a lock row is left by holders that are gone.
+
+    Returns whether anything was cleared, in which case the acquire or deregistration
+    that handed back row may be tried again.
+    """
+
+    pruned = [
+        prune(client, lock_table_name, lock_name, row, now)
+        for prune in (
+            prune_stale_intentions,
+            prune_expired_readers,
+            prune_expired_semaphore_holders,
+        )
+    ]
+    return any(pruned)
+
+
+def semaphore_acquire_update_item(
+    lock_table_name, lock_name, service_name, date_time, job_id, lease_expiry=None
+):
+    """Builds the transaction item that adds service_name as a holder of a semaphore.
+
+    Holders are kept in a map keyed by JobId, and HolderCount may never exceed Permits.
+    Each holder's fencing token is kept in HolderTokens, also keyed by JobId. A holder
+    with a lease_expiry keeps its permit until it runs out, after which
+    prune_expired_semaphore_holders clears it.
+    """
+
+    holder = {
+        "ServiceName": {"S": service_name},
+        "Lock_Acquire_DateTime": {"S": date_time},
+    }
+    if lease_expiry is not None:
+        holder["LeaseExpiry"] = {"N": str(lease_expiry)}
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": lock_name}},
+            # Both sides read the count from before the update, so they get the same token
+            "UpdateExpression": "SET Holders.#job_id = :holder, HolderCount = HolderCount + :one, HolderTokens.#job_id = if_not_exists(FencingToken, :zero) + :one, FencingToken = if_not_exists(FencingToken, :zero) + :one",
+            "ExpressionAttributeNames": {"#job_id": job_id},
+            "ExpressionAttributeValues": {
+                ":holder": {"M": holder},
+                ":zero": {"N": "0"},
+                ":one": {"N": "1"},
+            },
+            "ConditionExpression": "attribute_exists(Permits) AND HolderCount < Permits",
+            "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+        }
+    }
+
+
+def release_log_item(
+    log_table_name, lock_name, service_name, job_id, acquire_date_time, date_time
+):
+    """Builds the transaction item that records a lock release in the log table."""
+
+    return {
+        "Put": {
+            "TableName": log_table_name,
+            "Item": {
+                "LockName": {"S": lock_name},
+                "ServiceName": {"S": service_name},
+                "JobId": {"S": job_id},
+                "Lock_Acquire_DateTime": {"S": acquire_date_time},
+                "Lock_Release_DateTime": {"S": date_time},
+            },
+        }
+    }
+
+
+def holder_condition(expression_attribute_values, fencing_token=None):
+    """Returns the condition that a lock is still held by :held_by under :job_id.
+
+    When the caller sent a fencing token, a lock that has since been taken over by
+    a newer holder is rejected even if the old JobId were somehow reused.
+    """
+
+    if fencing_token is None:
+        return "HeldBy = :held_by AND JobId = :job_id"
+    expression_attribute_values[":fencing_token"] = {"N": str(fencing_token)}
+    return "HeldBy = :held_by AND JobId = :job_id AND FencingToken = :fencing_token"
+
+
+def release_update_item(
+    lock_table_name,
+    lock_name,
+    service_name,
+    job_id,
+    fencing_token=None,
+    idempotency_key=None,
+):
+    """Builds the transaction item that frees a lock held by service_name under job_id."""
+
+    update_expression = "SET HeldBy = :empty_string, JobId = :empty_string, QueueHeadExpiry = :queue_head_expiry"
+    expression_attribute_values = {
+        ":held_by": {"S": service_name},
+        ":empty_string": {"S": ""},
+        ":job_id": {"S": job_id},
+        # The waiter at the head of the queue gets a fresh turn from now on
+        ":queue_head_expiry": {"N": str(time.time() + QUEUE_HEAD_GRACE_PERIOD)},
+    }
+    # Kept after the lock is freed so a retried release can tell it already went through
+    if idempotency_key is not None:
+        update_expression += ", ReleaseIdempotencyKey = :idempotency_key"
+        expression_attribute_values[":idempotency_key"] = {"S": idempotency_key}
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": lock_name}},
+            "UpdateExpression": update_expression
+            + " REMOVE LeaseExpiry, IdempotencyKey",
+            "ExpressionAttributeValues": expression_attribute_values,
+            "ConditionExpression": holder_condition(
+                expression_attribute_values, fencing_token
+            ),
+        }
+    }
+
+
+def semaphore_release_update_item(
+    lock_table_name, lock_name, service_name, job_id, fencing_token=None
+):
+    """Builds the transaction item that removes job_id from the holders of a semaphore."""
+
+    expression_attribute_values = {
+        ":held_by": {"S": service_name},
+        ":one": {"N": "1"},
+    }
+    condition_expression = "Holders.#job_id.ServiceName = :held_by"
+    if fencing_token is not None:
+        expression_attribute_values[":fencing_token"] = {"N": str(fencing_token)}
+        condition_expression += " AND HolderTokens.#job_id = :fencing_token"
+
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": lock_name}},
+            "UpdateExpression": "REMOVE Holders.#job_id, HolderTokens.#job_id SET HolderCount = HolderCount - :one",
+            "ExpressionAttributeNames": {"#job_id": job_id},
+            "ExpressionAttributeValues": expression_attribute_values,
+            "ConditionExpression": condition_expression,
+        }
+    }
+
+
+def shared_release_update_item(lock_table_name, lock_name, service_name, job_id):
+    """Builds the transaction item that removes job_id from the shared holders of a lock."""
+
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": lock_name}},
+            "UpdateExpression": "REMOVE Readers.#job_id ADD ReaderCount :minus_one",
+            "ExpressionAttributeNames": {"#job_id": job_id},
+            "ExpressionAttributeValues": {
+                ":held_by": {"S": service_name},
+                ":minus_one": {"N": "-1"},
+            },
+            "ConditionExpression": "Readers.#job_id.ServiceName = :held_by",
+        }
+    }
+
+
+def row_acquire_date_time(row_dict, mode, job_id):
+    """Returns when job_id acquired the lock described by a dictified lock row."""
+
+    if mode in (SEMAPHORE_MODE, SHARED_MODE):
+        holders = row_dict.get("Holders" if mode == SEMAPHORE_MODE else "Readers", {})
+        holder = holders.get(job_id, {}).get("M", {})
+        return holder.get("Lock_Acquire_DateTime", {}).get("S", "")
+    return row_dict.get("Lock_Acquire_DateTime", "")
+
+
+def renew_update_item(
+    lock_table_name, lock_name, service_name, job_id, lease_expiry, fencing_token=None
+):
+    """Builds the transaction item that extends the lease of a lock held under job_id."""
+
+    expression_attribute_values = {
+        ":held_by": {"S": service_name},
+        ":job_id": {"S": job_id},
+        ":lease_expiry": {"N": str(lease_expiry)},
+    }
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": lock_name}},
+            "UpdateExpression": "SET LeaseExpiry = :lease_expiry",
+            "ExpressionAttributeValues": expression_attribute_values,
+            "ConditionExpression": holder_condition(
+                expression_attribute_values, fencing_token
+            ),
+        }
+    }
+
+
+def shared_renew_update_item(
+    lock_table_name, lock_name, service_name, job_id, lease_expiry
+):
+    """Builds the transaction item that extends the lease of a shared holder of a lock."""
+
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": lock_name}},
+            "UpdateExpression": "SET Readers.#job_id.LeaseExpiry = :lease_expiry",
+            "ExpressionAttributeNames": {"#job_id": job_id},
+            "ExpressionAttributeValues": {
+                ":held_by": {"S": service_name},
+                ":lease_expiry": {"N": str(lease_expiry)},
+            },
+            "ConditionExpression": "Readers.#job_id.ServiceName = :held_by",
+        }
+    }
+
+
+def semaphore_renew_update_item(
+    lock_table_name, lock_name, service_name, job_id, lease_expiry, fencing_token=None
+):
+    """Builds the transaction item that extends the lease of a holder of a semaphore."""
+
+    expression_attribute_values = {
+        ":held_by": {"S": service_name},
+        ":lease_expiry": {"N": str(lease_expiry)},
+    }
+    condition_expression = "Holders.#job_id.ServiceName = :held_by"
+    if fencing_token is not None:
+        expression_attribute_values[":fencing_token"] = {"N": str(fencing_token)}
+        condition_expression += " AND HolderTokens.#job_id = :fencing_token"
+
+    return {
+        "Update": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": lock_name}},
+            "UpdateExpression": "SET Holders.#job_id.LeaseExpiry = :lease_expiry",
+            "ExpressionAttributeNames": {"#job_id": job_id},
+            "ExpressionAttributeValues": expression_attribute_values,
+            "ConditionExpression": condition_expression,
+        }
+    }
+
+
+def check_lock_names(lock_names, max_locks):
+    """Checks that lock_names is a non-empty list of unique names that fits in one transaction."""
+
+    if not isinstance(lock_names, list) or len(lock_names) == 0:
+        raise BadRequestError("LockNames must be a non-empty list")
+    if len(lock_names) > max_locks:
+        raise BadRequestError(
+            "A single request may contain at most %s locks" % max_locks
+        )
+    if len(set(lock_names)) != len(lock_names):
+        raise BadRequestError("LockNames must not contain duplicates")
+
+
+def replayed_acquire(lock_table_name, lock_name, service_name, idempotency_key):
+    """Returns the result of an earlier acquire sent with idempotency_key, if it got the lock.
+
+    Returns None if service_name doesn't hold lock_name under that key.
+    """
+
+    row_dict = dictify_resp(retrieve_tables_values(lock_name, lock_table_name))
+    if (
+        row_dict.get("HeldBy") != service_name
+        or row_dict.get("IdempotencyKey") != idempotency_key
+    ):
+        return None
+    return {
+        "ResponseMetadata": {
+            "JobId": row_dict["JobId"],
+            "FencingToken": int(row_dict["FencingToken"]),
+            "LockAcquireDateTime": row_dict["Lock_Acquire_DateTime"],
+            "LeaseExpiry": (
+                float(row_dict["LeaseExpiry"]) if "LeaseExpiry" in row_dict else None
+            ),
+            "Replayed": True,
+            "Message": "%s acquired the following lock: %s"
+            % (service_name, lock_name),
+        }
+    }
+
+
+def replayed_release(lock_table_name, lock_name, idempotency_key):
+    """Checks if an earlier release sent with idempotency_key already freed lock_name."""
+
+    row_dict = dictify_resp(retrieve_tables_values(lock_name, lock_table_name))
+    return row_dict.get("ReleaseIdempotencyKey") == idempotency_key
+
+
+def request_priority(client, lock_table_name, lock_name, priority, now):
+    """Marks lock_name as wanted by an acquire of the given priority.
+
+    Until the mark expires, acquires of lower priority fail and the holder sees that
+    it has been asked to yield. A mark of higher priority is never lowered.
+    """
+
+    try:
+        client.update_item(
+            TableName=lock_table_name,
+            Key={"LockName": {"S": lock_name}},
+            UpdateExpression="SET PendingPriority = :priority, PendingPriorityExpiry = :pending_priority_expiry",
+            ExpressionAttributeValues={
+                ":priority": {"N": str(priority)},
+                ":pending_priority_expiry": {"N": str(now + PENDING_PRIORITY_PERIOD)},
+                ":now": {"N": str(now)},
+            },
+            ConditionExpression="attribute_exists(LockName) AND (attribute_not_exists(PendingPriority) OR PendingPriority <= :priority OR PendingPriorityExpiry < :now)",
+        )
+    except ClientError as e:
+        logger.debug(str(e))
+
+
+def skip_expired_queue_head(client, lock_table_name, lock_name, ticket, now):
+    """Moves the queue of lock_name past a head that let its turn expire on a free lock.
+
+    The head only moves one position at a time, and the ticket it moves to gets a
+    full turn of its own, so each abandoned ticket is skipped in order. Only tickets
+    at least two positions behind the head move it; the one right behind the head
+    takes the lock over straight away.
+    """
+
+    try:
+        client.update_item(
+            TableName=lock_table_name,
+            Key={"LockName": {"S": lock_name}},
+            UpdateExpression="SET QueueHead = QueueHead + :one, QueueHeadExpiry = :queue_head_expiry",
+            ExpressionAttributeValues={
+                ":one": {"N": "1"},
+                ":previous_ticket": {"N": str(ticket - 1)},
+                ":empty_string": {"S": ""},
+                ":now": {"N": str(now)},
+                ":queue_head_expiry": {"N": str(now + QUEUE_HEAD_GRACE_PERIOD)},
+            },
+            ConditionExpression="QueueHead < :previous_ticket AND QueueHeadExpiry < :now AND ((HeldBy = :empty_string AND JobId = :empty_string) OR LeaseExpiry < :now)",
+        )
+    except ClientError as e:
+        logger.debug(str(e))
+
+
+def attempt_acquire(
+    client,
+    service_name,
+    lock_name,
+    lock_table_name,
+    service_table_name,
+    lease_duration=None,
+    ticket=None,
+    mode=EXCLUSIVE_MODE,
+    hierarchical=False,
+    priority=0,
+    idempotency_key=None,
+    retry=True,
+):
+    """Makes one attempt at acquiring lock_name for service_name.
+
+    Raises the transaction's ClientError if the service isn't registered or the lock is held.
+    A held lock is marked with the caller's priority if it is above 0. A lock already
+    acquired under the caller's idempotency_key is reported as acquired again. With
+    retry, a lock only kept out by holders that are gone, or missing the map the
+    acquire adds its holder to, is tried once more after those are fixed.
+    """
+
+    now = time.time()
+    lease_expiry = get_lease_expiry(lease_duration, now)
+    date_time = str(datetime.utcnow())
+    job_id = str(uuid.uuid4())
+
+    if mode == SEMAPHORE_MODE:
+        lock_item = semaphore_acquire_update_item(
+            lock_table_name, lock_name, service_name, date_time, job_id, lease_expiry
+        )
+    elif mode == SHARED_MODE:
+        lock_item = shared_acquire_update_item(
+            lock_table_name,
+            lock_name,
+            service_name,
+            date_time,
+            job_id,
+            now,
+            lease_expiry,
+        )
+    else:
+        lock_item = acquire_update_item(
+            lock_table_name,
+            lock_name,
+            service_name,
+            date_time,
+            job_id,
+            now,
+            lease_expiry,
+            ticket,
+            priority,
+            idempotency_key,
+            hierarchical,
+        )
+
+    transact_items = [lock_item]
+    if hierarchical:
+        transact_items += [
+            intention_update_item(
+                lock_table_name, ancestor_name, lock_name, job_id, lease_expiry, now
+            )
+            for ancestor_name in ancestor_lock_names(lock_name)
+        ]
+
+    # A registered service acquiring one lock needs no transaction, and its update
+    # returns the fencing token, so the acquire is a single write either way
+    single_write = len(transact_items) == 1 and service_registry.contains(
+        service_table_name, service_name
+    )
+    try:
+        if single_write:
+            response = write_lock_item(client, lock_item)
+        else:
+            # The service check rides along in the write, so one round trip decides both
+            response = checked_transact_write_items(
+                client, service_table_name, service_name, transact_items
+            )
+    except ClientError as e:
+        if retry and (hierarchical or mode == SHARED_MODE) and document_path_invalid(e):
+            if hierarchical:
+                add_empty_maps(
+                    client,
+                    lock_table_name,
+                    ancestor_lock_names(lock_name),
+                    "Intentions",
+                )
+            else:
+                add_empty_maps(client, lock_table_name, [lock_name], "Readers")
+            return attempt_acquire(
+                client,
+                service_name,
+                lock_name,
+                lock_table_name,
+                service_table_name,
+                lease_duration,
+                ticket,
+                mode,
+                hierarchical,
+                priority,
+                idempotency_key,
+                retry=False,
+            )
+        if idempotency_key is not None and lock_is_held(e):
+            response = replayed_acquire(
+                lock_table_name, lock_name, service_name, idempotency_key
+            )
+            if response is not None:
+                return response
+        row = cancelled_lock_row(e, lock_name)
+        if (
+            retry
+            and row is not None
+            and prune_stale_holders(client, lock_table_name, lock_name, row, now)
+        ):
+            return attempt_acquire(
+                client,
+                service_name,
+                lock_name,
+                lock_table_name,
+                service_table_name,
+                lease_duration,
+                ticket,
+                mode,
+                hierarchical,
+                priority,
+                idempotency_key,
+                retry=False,
+            )
+        if priority > 0 and lock_is_held(e):
+            request_priority(client, lock_table_name, lock_name, priority, now)
+        if ticket is not None and lock_is_held(e):
+            skip_expired_queue_head(client, lock_table_name, lock_name, ticket, now)
+        raise
+    if mode == SHARED_MODE:
+        # Shared holders don't fence out anyone, so they aren't given a token
+        fencing_token = None
+    elif single_write:
+        fencing_token = held_fencing_token(response.pop("Attributes"), job_id, mode)
+    else:
+        fencing_token = acquired_fencing_tokens(
+            client, lock_table_name, {lock_name: job_id}, mode
+        )[lock_name]
+    response.pop("Attributes", None)
+    response["ResponseMetadata"]["JobId"] = job_id
+    response["ResponseMetadata"]["FencingToken"] = fencing_token
+    response["ResponseMetadata"]["LockAcquireDateTime"] = date_time
+    response["ResponseMetadata"]["LeaseExpiry"] = lease_expiry
+    response["ResponseMetadata"]["Message"] = "%s acquired the following lock: %s" % (
+        service_name,
+        lock_name,
+    )
+    return response
+
+
+@lockapi.route("/acquire", methods=["POST"])
+def acquire_lock():
+    api_data = lockapi.current_request.json_body
+    required_fields = ["ServiceName", "LockName", "LockTableName", "ServiceTableName"]
+    check_fields(api_data, required_fields)
+
+    service_name, lock_name, lock_table_name, service_table_name = (
+        api_data["ServiceName"],
+        api_data["LockName"],
+        api_data["LockTableName"],
+        api_data["ServiceTableName"],
+    )
+
+    lease_duration = get_lease_duration(api_data)
+    ticket = get_ticket(api_data)
+    mode = get_mode(api_data)
+    hierarchical = get_hierarchical(api_data)
+    priority = get_priority(api_data)
+    idempotency_key = get_idempotency_key(api_data)
+    check_mode_options(mode, ticket, hierarchical, priority, idempotency_key)
+
+    client = SingletonDynamoDBClient.getInstance()
+
+    try:
+        response = attempt_acquire(
+            client,
+            service_name,
+            lock_name,
+            lock_table_name,
+            service_table_name,
+            lease_duration,
+            ticket,
+            mode,
+            hierarchical,
+            priority,
+            idempotency_key,
+        )
+        return format_response(response)
+    except ClientError as e:
+        logger.debug(str(e))
+        if service_check_failed(e):
+            return Response(
+                body={"Message": "Service doesn't exist"},
+                status_code=400,
+                headers={"Content-Type": "application/json"},
+            )
+        return Response(
+            body={"Message": "Unable to acquire a lock"},
+            status_code=409,
+            headers={"Content-Type": "application/json"},
+        )
+    except Exception as e:
+        logger.debug(str(e))
+        return Response(
+            body={"Message": "Unexpected exception occurred during the request"},
+            status_code=500,
+            headers={"Content-Type": "application/json"},
+        )
+
+
+def get_wait_deadline(api_data, now):
+    """Returns the epoch time an /acquire_wait request must give up by.
+
+    The caller's WaitTimeout is bounded by ACQUIRE_WAIT_MAX_TIMEOUT and by the time
+    left before the Lambda invocation itself is timed out.
+    """
+
+    wait_timeout = api_data["WaitTimeout"]
+    if (
+        isinstance(wait_timeout, bool)
+        or not isinstance(wait_timeout, (int, float))
+        or wait_timeout < 0
+    ):
+        raise BadRequestError("WaitTimeout must be a non-negative number of seconds")
+    wait_timeout = min(wait_timeout, ACQUIRE_WAIT_MAX_TIMEOUT)
+
+    lambda_context = lockapi.lambda_context
+    if hasattr(lambda_context, "get_remaining_time_in_millis"):
+        remaining = lambda_context.get_remaining_time_in_millis() / 1000.0
+        wait_timeout = min(wait_timeout, remaining - LAMBDA_TIMEOUT_MARGIN)
+
+    return now + wait_timeout
+
+
+def lock_is_held(client_error):
+    """Checks if a failed acquire is worth retrying because the lock was held."""
+
+    return client_error.response.get("Error", {}).get(
+        "Code"
+    ) == "TransactionCanceledException" and not service_check_failed(client_error)
 
 
-@lockapi.route("/acquire", methods=["POST"])
-def acquire_lock():
+@lockapi.route("/acquire_wait", methods=["POST"])
+def acquire_lock_wait():
     api_data = lockapi.current_request.json_body
-    required_fields = ["ServiceName", "LockName", "LockTableName", "ServiceTableName"]
+    required_fields = [
+        "ServiceName",
+        "LockName",
+        "LockTableName",
+        "ServiceTableName",
+        "WaitTimeout",
+    ]
     check_fields(api_data, required_fields)
 
     service_name, lock_name, lock_table_name, service_table_name = (
@@ -53,58 +1434,54 @@ def acquire_lock():
         api_data["ServiceTableName"],
     )
 
+    lease_duration = get_lease_duration(api_data)
+    ticket = get_ticket(api_data)
+    mode = get_mode(api_data)
+    hierarchical = get_hierarchical(api_data)
+    priority = get_priority(api_data)
+    idempotency_key = get_idempotency_key(api_data)
+    check_mode_options(mode, ticket, hierarchical, priority, idempotency_key)
+    deadline = get_wait_deadline(api_data, time.time())
+
     client = SingletonDynamoDBClient.getInstance()
-    date_time = str(datetime.utcnow())
-    job_id = str(uuid.uuid4())
 
     try:
-        # If either service_resp, or response fails, will trigger exception
-        service_resp = client.transact_get_items(
-            TransactItems=[
-                {
-                    "Get": {
-                        "TableName": service_table_name,
-                        "Key": {"ServiceName": {"S": service_name}},
-                    }
-                }
-            ]
-        )
-        # In case service doesn't exist
-        if service_resp["Responses"] == [{}]:
-            raise ValidationException("Service doesn't exist")
-        response = client.transact_write_items(
-            TransactItems=[
-                {
-                    "Update": {
-                        "TableName": lock_table_name,
-                        "Key": {"LockName": {"S": lock_name}},
-                        "UpdateExpression": "SET HeldBy = :held_by, Lock_Acquire_DateTime = :date_time, JobId = :job_id",
-                        "ExpressionAttributeValues": {
-                            ":held_by": {"S": service_name},
-                            ":empty_string": {"S": ""},
-                            ":date_time": {"S": date_time},
-                            ":job_id": {"S": job_id},
-                        },
-                        "ConditionExpression": "HeldBy = :empty_string AND JobId = :empty_string",
-                    }
-                }
-            ]
-        )
-        response["ResponseMetadata"]["JobId"] = job_id
-        response["ResponseMetadata"][
-            "Message"
-        ] = "%s acquired the following lock: %s" % (service_name, lock_name)
+        attempt = 0
+        while True:
+            try:
+                response = attempt_acquire(
+                    client,
+                    service_name,
+                    lock_name,
+                    lock_table_name,
+                    service_table_name,
+                    lease_duration,
+                    ticket,
+                    mode,
+                    hierarchical,
+                    priority,
+                    idempotency_key,
+                )
+                return format_response(response)
+            except ClientError as e:
+                remaining = deadline - time.time()
+                if not lock_is_held(e) or remaining <= 0:
+                    raise
 
-        return response
-    except ValidationException as e:
-        logger.debug(str(e))
-        return Response(
-            body={"Message": str(e)},
-            status_code=400,
-            headers={"Content-Type": "application/json"},
-        )
+            # Full jitter keeps waiters on the same lock from retrying in lockstep
+            backoff = min(
+                ACQUIRE_WAIT_BACKOFF_CAP, ACQUIRE_WAIT_BACKOFF_BASE * 2 ** attempt
+            )
+            time.sleep(min(random.uniform(0, backoff), remaining))
+            attempt += 1
     except ClientError as e:
         logger.debug(str(e))
+        if service_check_failed(e):
+            return Response(
+                body={"Message": "Service doesn't exist"},
+                status_code=400,
+                headers={"Content-Type": "application/json"},
+            )
         return Response(
             body={"Message": "Unable to acquire a lock"},
             status_code=409,
@@ -169,45 +1546,72 @@ def release_lock():
         api_data["LogTableName"],
     )
 
+    fencing_token = get_fencing_token(api_data)
+    mode = get_mode(api_data)
+    if mode == SHARED_MODE and fencing_token is not None:
+        raise BadRequestError("Shared holders aren't given a FencingToken")
+    hierarchical = get_hierarchical(api_data)
+    idempotency_key = get_idempotency_key(api_data)
+    check_mode_options(mode, None, hierarchical, idempotency_key=idempotency_key)
+
     client = SingletonDynamoDBClient.getInstance()
 
     try:
 
-        # Put relevant Row information into dict. This is for logging purposes
-        read_resp = retrieve_tables_values(lock_name, lock_table_name)
-        row_dict = dictify_resp(read_resp)
+        # Callers that kept the acquire time from /acquire skip the lock row read,
+        # unless the lock may have been acquired as part of a hierarchy
+        acquire_date_time = api_data.get("LockAcquireDateTime")
+        if acquire_date_time is None or (
+            mode == EXCLUSIVE_MODE
+            and not hierarchical
+            and LOCK_NAME_SEPARATOR in lock_name
+        ):
+            # Put relevant Row information into dict. This is for logging purposes
+            row_dict = dictify_resp(retrieve_tables_values(lock_name, lock_table_name))
+            if acquire_date_time is None:
+                acquire_date_time = row_acquire_date_time(row_dict, mode, job_id)
+            # The marks above a hierarchical lock go with it, whatever the release says
+            hierarchical = hierarchical or (
+                row_dict.get("Hierarchical") is True
+                and row_dict.get("JobId") == job_id
+            )
+
+        if mode == SEMAPHORE_MODE:
+            lock_item = semaphore_release_update_item(
+                lock_table_name, lock_name, service_name, job_id, fencing_token
+            )
+        elif mode == SHARED_MODE:
+            lock_item = shared_release_update_item(
+                lock_table_name, lock_name, service_name, job_id
+            )
+        else:
+            lock_item = release_update_item(
+                lock_table_name,
+                lock_name,
+                service_name,
+                job_id,
+                fencing_token,
+                idempotency_key,
+            )
 
         date_time = str(datetime.utcnow())
 
         response = client.transact_write_items(
             TransactItems=[
-                {
-                    "Put": {
-                        "TableName": log_table_name,
-                        "Item": {
-                            "LockName": {"S": lock_name},
-                            "ServiceName": {"S": service_name},
-                            "JobId": {"S": job_id},
-                            "Lock_Acquire_DateTime": {
-                                "S": row_dict.get("Lock_Acquire_DateTime", "")
-                            },
-                            "Lock_Release_DateTime": {"S": date_time},
-                        },
-                    }
-                },
-                {
-                    "Update": {
-                        "TableName": lock_table_name,
-                        "Key": {"LockName": {"S": lock_name}},
-                        "UpdateExpression": "SET HeldBy = :empty_string, JobId = :empty_string",
-                        "ExpressionAttributeValues": {
-                            ":held_by": {"S": service_name},
-                            ":empty_string": {"S": ""},
-                            ":job_id": {"S": job_id},
-                        },
-                        "ConditionExpression": "HeldBy = :held_by AND JobId = :job_id",
-                    }
-                },
+                release_log_item(
+                    log_table_name,
+                    lock_name,
+                    service_name,
+                    job_id,
+                    acquire_date_time,
+                    date_time,
+                ),
+                lock_item,
+            ]
+            + [
+                intention_release_update_item(lock_table_name, ancestor_name, lock_name)
+                for ancestor_name in ancestor_lock_names(lock_name)
+                if hierarchical
             ]
         )
 
@@ -215,10 +1619,23 @@ def release_lock():
             "%s released the following lock: %s with JobId: %s"
             % (service_name, lock_name, job_id)
         )
-        return response
+        return format_response(response)
 
     except ClientError as e:
         logger.debug(str(e))
+        # A retry of a release that went through is answered as if it went through again
+        if idempotency_key is not None and replayed_release(
+            lock_table_name, lock_name, idempotency_key
+        ):
+            return format_response(
+                {
+                    "ResponseMetadata": {
+                        "Replayed": True,
+                        "Message": "%s released the following lock: %s with JobId: %s"
+                        % (service_name, lock_name, job_id),
+                    }
+                }
+            )
         return Response(
             body={"Message": "Unable to release lock"},
             status_code=409,
@@ -233,6 +1650,433 @@ def release_lock():
         )
 
 
+@lockapi.route("/renew", methods=["POST"])
+def renew_lock():
+    api_data = lockapi.current_request.json_body
+    required_fields = [
+        "LockName",
+        "ServiceName",
+        "JobId",
+        "LockTableName",
+        "LeaseDuration",
+    ]
+    check_fields(api_data, required_fields)
+
+    service_name, lock_name, job_id, lock_table_name = (
+        api_data["ServiceName"],
+        api_data["LockName"],
+        api_data["JobId"],
+        api_data["LockTableName"],
+    )
+    now = time.time()
+    lease_expiry = get_lease_expiry(get_lease_duration(api_data), now)
+    fencing_token = get_fencing_token(api_data)
+    mode = get_mode(api_data)
+    if mode == SHARED_MODE and fencing_token is not None:
+        raise BadRequestError("Shared holders aren't given a FencingToken")
+
+    if mode == SEMAPHORE_MODE:
+        renew_item = semaphore_renew_update_item(
+            lock_table_name, lock_name, service_name, job_id, lease_expiry, fencing_token
+        )
+    elif mode == SHARED_MODE:
+        renew_item = shared_renew_update_item(
+            lock_table_name, lock_name, service_name, job_id, lease_expiry
+        )
+    else:
+        renew_item = renew_update_item(
+            lock_table_name,
+            lock_name,
+            service_name,
+            job_id,
+            lease_expiry,
+            fencing_token,
+        )
+
+    client = SingletonDynamoDBClient.getInstance()
+
+    try:
+        # Only the current holder can extend its lease. Once a lease has run out
+        # and the lock was taken over, the JobId no longer matches. The update
+        # hands back the row so the holder learns whether it should yield.
+        response = client.update_item(ReturnValues="ALL_NEW", **renew_item["Update"])
+        row_dict = dictify_resp([{"Item": response.pop("Attributes")}])
+
+        response["ResponseMetadata"]["LeaseExpiry"] = lease_expiry
+        response["ResponseMetadata"]["YieldRequested"] = yield_requested(row_dict, now)
+        response["ResponseMetadata"]["Message"] = (
+            "%s renewed the following lock: %s with JobId: %s"
+            % (service_name, lock_name, job_id)
+        )
+        return format_response(response)
+    except ClientError as e:
+        logger.debug(str(e))
+        return Response(
+            body={"Message": "Unable to renew lock"},
+            status_code=409,
+            headers={"Content-Type": "application/json"},
+        )
+    except Exception as e:
+        logger.debug(str(e))
+        return Response(
+            body={"Message": "Unexpected exception occurred during the request"},
+            status_code=500,
+            headers={"Content-Type": "application/json"},
+        )
+
+
+def queue_depth(row_dict):
+    """Returns how many tickets of a lock row's queue are still waiting for their turn."""
+
+    if "QueueHead" not in row_dict:
+        return 0
+    return max(0, int(row_dict["QueueTail"]) - int(row_dict["QueueHead"]) + 1)
+
+
+def enqueue_update(client, lock_table_name, lock_name, queue_was_empty):
+    """Draws the next ticket of lock_name's queue, if the queue is as empty as expected.
+
+    Raises ConditionalCheckFailedException if the queue isn't, or the lock doesn't exist.
+    """
+
+    update_expression = "SET QueueTail = if_not_exists(QueueTail, :zero) + :one, QueueHead = if_not_exists(QueueHead, :one)"
+    expression_attribute_values = {":zero": {"N": "0"}, ":one": {"N": "1"}}
+    if queue_was_empty:
+        update_expression += ", QueueHeadExpiry = :queue_head_expiry"
+        expression_attribute_values[":queue_head_expiry"] = {
+            "N": str(time.time() + QUEUE_HEAD_GRACE_PERIOD)
+        }
+        condition_expression = "attribute_exists(LockName) AND (attribute_not_exists(QueueHead) OR QueueHead > QueueTail)"
+    else:
+        condition_expression = "attribute_exists(LockName) AND QueueHead <= QueueTail"
+    return client.update_item(
+        TableName=lock_table_name,
+        Key={"LockName": {"S": lock_name}},
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_attribute_values,
+        ConditionExpression=condition_expression,
+        ReturnValues="ALL_NEW",
+    )
+
+
+@lockapi.route("/enqueue", methods=["POST"])
+def enqueue_lock():
+    api_data = lockapi.current_request.json_body
+    required_fields = ["ServiceName", "LockName", "LockTableName"]
+    check_fields(api_data, required_fields)
+
+    service_name, lock_name, lock_table_name = (
+        api_data["ServiceName"],
+        api_data["LockName"],
+        api_data["LockTableName"],
+    )
+
+    client = SingletonDynamoDBClient.getInstance()
+
+    try:
+        # A transaction can't hand back the ticket it drew, so this is a plain update.
+        # A ticket drawn into an empty queue is at the head straight away, and its turn
+        # starts now rather than whenever the last head's turn did. Each update only
+        # applies to one of the two cases, so the other is tried if it doesn't.
+        attempts = (False, True) * ENQUEUE_ROUNDS
+        for attempt, queue_was_empty in enumerate(attempts):
+            try:
+                response = enqueue_update(
+                    client, lock_table_name, lock_name, queue_was_empty
+                )
+                break
+            except ClientError as e:
+                if (
+                    attempt == len(attempts) - 1
+                    or e.response["Error"]["Code"] != "ConditionalCheckFailedException"
+                ):
+                    raise
+                logger.debug(str(e))
+        ticket = int(response["Attributes"]["QueueTail"]["N"])
+        queue_head = int(response["Attributes"]["QueueHead"]["N"])
+        del response["Attributes"]
+
+        response["ResponseMetadata"]["Ticket"] = ticket
+        response["ResponseMetadata"]["Position"] = ticket - queue_head
+        response["ResponseMetadata"]["Message"] = (
+            "%s joined the queue for the following lock: %s with Ticket: %s"
+            % (service_name, lock_name, ticket)
+        )
+        return format_response(response)
+    except ClientError as e:
+        logger.debug(str(e))
+        return Response(
+            body={"Message": "Unable to join the lock queue"},
+            status_code=409,
+            headers={"Content-Type": "application/json"},
+        )
+    except Exception as e:
+        logger.debug(str(e))
+        return Response(
+            body={"Message": "Unexpected exception occurred during the request"},
+            status_code=500,
+            headers={"Content-Type": "application/json"},
+        )
+
+
+@lockapi.route("/lock_status", methods=["POST"])
+def lock_status():
+    api_data = lockapi.current_request.json_body
+    required_fields = ["LockName", "LockTableName"]
+    check_fields(api_data, required_fields)
+
+    lock_name, lock_table_name = (api_data["LockName"], api_data["LockTableName"])
+
+    try:
+        read_resp = retrieve_tables_values(lock_name, lock_table_name)
+        if read_resp == [{}]:
+            raise ValidationException("Lock doesn't exist")
+        row_dict = dictify_resp(read_resp)
+
+        # JobId is left out as it is what lets a holder release the lock
+        return {
+            "LockName": lock_name,
+            "HeldBy": row_dict.get("HeldBy", ""),
+            "LeaseExpiry": (
+                float(row_dict["LeaseExpiry"]) if "LeaseExpiry" in row_dict else None
+            ),
+            "QueueHead": (
+                int(row_dict["QueueHead"]) if "QueueHead" in row_dict else None
+            ),
+            "QueueDepth": queue_depth(row_dict),
+            "YieldRequested": yield_requested(row_dict, time.time()),
+            "ReaderCount": int(row_dict.get("ReaderCount", 0)),
+            "HeldBelow": sorted(row_dict.get("Intentions", {})),
+            "Permits": int(row_dict["Permits"]) if "Permits" in row_dict else None,
+            "HolderCount": (
+                int(row_dict["HolderCount"]) if "HolderCount" in row_dict else None
+            ),
+        }
+    except ValidationException as e:
+        logger.debug(str(e))
+        return Response(
+            body={"Message": str(e)},
+            status_code=400,
+            headers={"Content-Type": "application/json"},
+        )
+    except Exception as e:
+        logger.debug(str(e))
+        return Response(
+            body={"Message": "Unexpected exception occurred during the request"},
+            status_code=500,
+            headers={"Content-Type": "application/json"},
+        )
+
+
+@lockapi.route("/acquire_batch", methods=["POST"])
+def acquire_batch():
+    api_data = lockapi.current_request.json_body
+    required_fields = ["ServiceName", "LockNames", "LockTableName", "ServiceTableName"]
+    check_fields(api_data, required_fields)
+
+    service_name, lock_names, lock_table_name, service_table_name = (
+        api_data["ServiceName"],
+        api_data["LockNames"],
+        api_data["LockTableName"],
+        api_data["ServiceTableName"],
+    )
+    # One item of the transaction is taken by the service check
+    check_lock_names(lock_names, MAX_TRANSACTION_ITEMS - 1)
+
+    now = time.time()
+    lease_expiry = get_lease_expiry(get_lease_duration(api_data), now)
+
+    client = SingletonDynamoDBClient.getInstance()
+    date_time = str(datetime.utcnow())
+    job_ids = {lock_name: str(uuid.uuid4()) for lock_name in lock_names}
+
+    try:
+        # Either every lock is acquired or none of them are
+        response = checked_transact_write_items(
+            client,
+            service_table_name,
+            service_name,
+            [
+                acquire_update_item(
+                    lock_table_name,
+                    lock_name,
+                    service_name,
+                    date_time,
+                    job_ids[lock_name],
+                    now,
+                    lease_expiry,
+                )
+                for lock_name in lock_names
+            ],
+        )
+        response["ResponseMetadata"]["JobIds"] = job_ids
+        # Every lock counts its own acquires, so each one has its own token
+        response["ResponseMetadata"]["FencingTokens"] = acquired_fencing_tokens(
+            client, lock_table_name, job_ids
+        )
+        response["ResponseMetadata"]["LockAcquireDateTime"] = date_time
+        response["ResponseMetadata"]["LeaseExpiry"] = lease_expiry
+        response["ResponseMetadata"][
+            "Message"
+        ] = "%s acquired the following locks: %s" % (service_name, lock_names)
+
+        return format_response(response)
+    except ClientError as e:
+        logger.debug(str(e))
+        if service_check_failed(e):
+            return Response(
+                body={"Message": "Service doesn't exist"},
+                status_code=400,
+                headers={"Content-Type": "application/json"},
+            )
+        return Response(
+            body={"Message": "Unable to acquire locks"},
+            status_code=409,
+            headers={"Content-Type": "application/json"},
+        )
+    except Exception as e:
+        logger.debug(str(e))
+        return Response(
+            body={"Message": "Unexpected exception occurred during the request"},
+            status_code=500,
+            headers={"Content-Type": "application/json"},
+        )
+
+
+@lockapi.route("/release_batch", methods=["POST"])
+def release_batch():
+    api_data = lockapi.current_request.json_body
+    required_fields = ["ServiceName", "Locks", "LockTableName", "LogTableName"]
+    check_fields(api_data, required_fields)
+
+    service_name, locks, lock_table_name, log_table_name = (
+        api_data["ServiceName"],
+        api_data["Locks"],
+        api_data["LockTableName"],
+        api_data["LogTableName"],
+    )
+    if not isinstance(locks, list) or not all(
+        isinstance(lock, dict) and "LockName" in lock and "JobId" in lock
+        for lock in locks
+    ):
+        raise BadRequestError("Locks must be a list of LockName and JobId pairs")
+
+    # Every lock needs a log Put and a lock Update
+    lock_names = [lock["LockName"] for lock in locks]
+    check_lock_names(lock_names, MAX_TRANSACTION_ITEMS // 2)
+    fencing_tokens = [get_fencing_token(lock) for lock in locks]
+    hierarchical_names = {
+        lock["LockName"] for lock in locks if get_hierarchical(lock)
+    }
+
+    client = SingletonDynamoDBClient.getInstance()
+
+    try:
+
+        # One read fetches the acquire times the caller didn't send for the log table,
+        # and whether locks that may be in a hierarchy were acquired as one
+        acquire_date_times = {
+            lock["LockName"]: lock["LockAcquireDateTime"]
+            for lock in locks
+            if "LockAcquireDateTime" in lock
+        }
+        read_lock_names = [
+            lock_name
+            for lock_name in lock_names
+            if lock_name not in acquire_date_times
+            or (
+                LOCK_NAME_SEPARATOR in lock_name
+                and lock_name not in hierarchical_names
+            )
+        ]
+        if len(read_lock_names) > 0:
+            read_resp = client.transact_get_items(
+                TransactItems=[
+                    {
+                        "Get": {
+                            "TableName": lock_table_name,
+                            "Key": {"LockName": {"S": lock_name}},
+                        }
+                    }
+                    for lock_name in read_lock_names
+                ]
+            )
+            job_ids = {lock["LockName"]: lock["JobId"] for lock in locks}
+            for lock_name, item in zip(read_lock_names, read_resp["Responses"]):
+                row_dict = dictify_resp([item])
+                acquire_date_times.setdefault(
+                    lock_name, row_dict.get("Lock_Acquire_DateTime", "")
+                )
+                # The marks above a hierarchical lock go with it, as with /release
+                if (
+                    row_dict.get("Hierarchical") is True
+                    and row_dict.get("JobId") == job_ids[lock_name]
+                ):
+                    hierarchical_names.add(lock_name)
+
+        date_time = str(datetime.utcnow())
+
+        transact_items = []
+        for lock, fencing_token in zip(locks, fencing_tokens):
+            transact_items.append(
+                release_log_item(
+                    log_table_name,
+                    lock["LockName"],
+                    service_name,
+                    lock["JobId"],
+                    acquire_date_times[lock["LockName"]],
+                    date_time,
+                )
+            )
+            transact_items.append(
+                release_update_item(
+                    lock_table_name,
+                    lock["LockName"],
+                    service_name,
+                    lock["JobId"],
+                    fencing_token,
+                )
+            )
+            if lock["LockName"] in hierarchical_names:
+                transact_items.extend(
+                    intention_release_update_item(
+                        lock_table_name, ancestor_name, lock["LockName"]
+                    )
+                    for ancestor_name in ancestor_lock_names(lock["LockName"])
+                )
+        if len(transact_items) > MAX_TRANSACTION_ITEMS:
+            return Response(
+                body={
+                    "Message": "Releasing these locks and the marks above them takes more than %s items"
+                    % MAX_TRANSACTION_ITEMS
+                },
+                status_code=400,
+                headers={"Content-Type": "application/json"},
+            )
+
+        response = client.transact_write_items(TransactItems=transact_items)
+
+        response["ResponseMetadata"]["Message"] = (
+            "%s released the following locks: %s" % (service_name, lock_names)
+        )
+        return format_response(response)
+
+    except ClientError as e:
+        logger.debug(str(e))
+        return Response(
+            body={"Message": "Unable to release locks"},
+            status_code=409,
+            headers={"Content-Type": "application/json"},
+        )
+    except Exception as e:
+        logger.debug(str(e))
+        return Response(
+            body={"Message": "Unexpected exception occurred during the request"},
+            status_code=500,
+            headers={"Content-Type": "application/json"},
+        )
+
+
 @lockapi.route("/register_lock", methods=["POST"])
 def register_lock():
     api_data = lockapi.current_request.json_body
@@ -241,22 +2085,39 @@ def register_lock():
 
     lock_name, lock_table_name = (api_data["LockName"], api_data["LockTableName"])
 
+    # Locks registered with Permits are semaphores that many services can hold at once
+    permits = api_data.get("Permits")
+    if permits is not None and (
+        isinstance(permits, bool) or not isinstance(permits, int) or permits < 1
+    ):
+        raise BadRequestError("Permits must be a positive integer")
+
     client = SingletonDynamoDBClient.getInstance()
 
     try:
         date_time = str(datetime.utcnow())
 
+        item = {
+            "LockName": {"S": lock_name},
+            "HeldBy": {"S": ""},
+            "Lock_Acquire_DateTime": {"S": date_time},
+            "JobId": {"S": ""},
+            "Intentions": {"M": {}},
+        }
+        if permits is None:
+            item["Readers"] = {"M": {}}
+        else:
+            item["Permits"] = {"N": str(permits)}
+            item["HolderCount"] = {"N": "0"}
+            item["Holders"] = {"M": {}}
+            item["HolderTokens"] = {"M": {}}
+
         response = client.transact_write_items(
             TransactItems=[
                 {
                     "Put": {
                         "TableName": lock_table_name,
-                        "Item": {
-                            "LockName": {"S": lock_name},
-                            "HeldBy": {"S": ""},
-                            "Lock_Acquire_DateTime": {"S": date_time},
-                            "JobId": {"S": ""},
-                        },
+                        "Item": item,
                         "ConditionExpression": "attribute_not_exists(LockName)",
                     }
                 }
@@ -264,7 +2125,7 @@ def register_lock():
         )
         response["ResponseMetadata"]["Message"] = "Registered Lock: %s" % lock_name
 
-        return response
+        return format_response(response)
     except ClientError as e:
         logger.debug(str(e))
         return Response(
@@ -291,22 +2152,33 @@ def deregister_lock():
 
     client = SingletonDynamoDBClient.getInstance()
 
+    delete_item = {
+        "Delete": {
+            "TableName": lock_table_name,
+            "Key": {"LockName": {"S": lock_name}},
+            "ExpressionAttributeValues": {
+                ":empty_string": {"S": ""},
+                ":zero": {"N": "0"},
+            },
+            "ConditionExpression": "HeldBy = :empty_string AND JobId = :empty_string AND (attribute_not_exists(HolderCount) OR HolderCount = :zero) AND (attribute_not_exists(ReaderCount) OR ReaderCount = :zero) AND (attribute_not_exists(Intentions) OR size(Intentions) = :zero)",
+            "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+        }
+    }
+
     try:
-        response = client.transact_write_items(
-            TransactItems=[
-                {
-                    "Delete": {
-                        "TableName": lock_table_name,
-                        "Key": {"LockName": {"S": lock_name}},
-                        "ExpressionAttributeValues": {":empty_string": {"S": ""}},
-                        "ConditionExpression": "HeldBy = :empty_string AND JobId = :empty_string",
-                    }
-                }
-            ]
-        )
+        try:
+            response = client.transact_write_items(TransactItems=[delete_item])
+        except ClientError as e:
+            # Holders that are gone don't keep the lock registered
+            row = cancelled_lock_row(e, lock_name)
+            if row is None or not prune_stale_holders(
+                client, lock_table_name, lock_name, row, time.time()
+            ):
+                raise
+            response = client.transact_write_items(TransactItems=[delete_item])
         response["ResponseMetadata"]["Message"] = "Deregistered Lock: %s" % lock_name
 
-        return response
+        return format_response(response)
     except ClientError as e:
         logger.debug(str(e))
         return Response(
@@ -349,11 +2221,12 @@ def register_service():
                 }
             ]
         )
+        service_registry.discard(service_table_name, service_name)
         response["ResponseMetadata"]["Message"] = (
             "Registered Service: %s" % service_name
         )
 
-        return response
+        return format_response(response)
     except ClientError as e:
         logger.debug(str(e))
         return Response(
@@ -398,10 +2271,11 @@ def deregister_service():
                 }
             ]
         )
+        service_registry.discard(service_table_name, service_name)
         response["ResponseMetadata"]["Message"] = (
             "Deregistered Service: %s" % service_name
         )
-        return response
+        return format_response(response)
     except ClientError as e:
         logger.debug(str(e))
         return Response(
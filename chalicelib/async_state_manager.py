@@ -0,0 +1,414 @@
+"""Asyncio client for the lock API.
+
+AsyncLockClient makes the same requests as LockClient from one event loop thread.
+Its requests share a pool of kept-alive HTTP/1.1 connections built on asyncio
+streams, so it needs nothing beyond the standard library and no thread per request.
+Like requests, the pool goes through the proxies set in HTTP_PROXY, HTTPS_PROXY and
+NO_PROXY.
+"""
+
+import asyncio
+import base64
+import gzip
+import json
+import ssl
+
+from contextlib import asynccontextmanager
+from urllib.parse import unquote, urljoin, urlsplit
+from urllib.request import getproxies, proxy_bypass
+
+from .state_manager import BaseLockClient, LockNotAcquiredError
+
+# Connections an AsyncLockClient opens to the API at most
+DEFAULT_MAX_CONNECTIONS = 100
+
+# Errors after which a request may go through on a new connection
+CONNECTION_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError)
+
+# Responses that never have a body
+BODILESS_STATUS_CODES = (204, 304)
+
+
+class RequestNotSentError(ConnectionError):
+    """Raised when a request failed before any of it was written to a connection."""
+
+
+class AsyncResponse:
+    """The parts of a requests.Response that the lock clients and their callers use."""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+async def read_head(reader):
+    """Reads the status line and headers of one HTTP/1.1 response from reader."""
+
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("Connection closed before the response")
+    version, status_code = status_line.decode("latin-1").split(None, 2)[:2]
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return version, int(status_code), headers
+
+
+async def read_response(reader):
+    """Reads one HTTP/1.1 response from reader, skipping any informational ones before it.
+
+    Returns the response and whether its connection may carry another request.
+    """
+
+    version, status_code, headers = await read_head(reader)
+    # A 100 Continue or 103 Early Hints comes before the response that answers the request
+    while 100 <= status_code < 200:
+        version, status_code, headers = await read_head(reader)
+
+    connection = headers.get("connection", "").lower()
+    keep_alive = (
+        connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+    )
+    if status_code in BODILESS_STATUS_CODES:
+        content = b""
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # Skip any trailers up to the blank line that ends the response
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        content = b"".join(chunks)
+    elif "content-length" in headers:
+        content = await reader.readexactly(int(headers["content-length"]))
+    else:
+        content = await reader.read()
+        keep_alive = False
+    if headers.get("content-encoding", "").lower() == "gzip":
+        content = gzip.decompress(content)
+    return AsyncResponse(status_code, headers, content), keep_alive
+
+
+def proxy_url(scheme, host):
+    """Returns the URL of the proxy requests to host go through, or None to go direct."""
+
+    proxy = getproxies().get(scheme)
+    if proxy is None or proxy_bypass(host):
+        return None
+    return urlsplit(proxy if "://" in proxy else "http://" + proxy)
+
+
+def proxy_headers(proxy):
+    """Returns the Proxy-Authorization header for the credentials in a proxy URL."""
+
+    if proxy.username is None:
+        return {}
+    credentials = "%s:%s" % (unquote(proxy.username), unquote(proxy.password or ""))
+    return {
+        "Proxy-Authorization": "Basic "
+        + base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+    }
+
+
+def is_stale(connection):
+    """Checks if the server has closed an idle connection since it was last used."""
+
+    reader, writer = connection
+    return reader.at_eof() or reader.exception() is not None or writer.is_closing()
+
+
+class ConnectionPool:
+    """Kept-alive connections to one API host, handed to one request at a time.
+
+    The pool never sends a request twice. A request that fails before it is written
+    raises RequestNotSentError, so the caller knows it can be sent again whatever it
+    does, while a failure after that raises the error as it came.
+    """
+
+    def __init__(self, api_url, max_connections=DEFAULT_MAX_CONNECTIONS):
+        url = urlsplit(api_url)
+        self.host = url.hostname
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.port = url.port or (443 if self.ssl else 80)
+        self.host_header = url.netloc
+        self.origin = "%s://%s" % (url.scheme, url.netloc)
+        self.proxy = proxy_url(url.scheme, self.host)
+        self.idle = []
+        self.max_connections = max_connections
+        self.slots = None
+
+    async def open_connection(self):
+        """Opens a connection to the API, through a proxy if one is set."""
+
+        if self.proxy is None:
+            return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+        reader, writer = await asyncio.open_connection(
+            self.proxy.hostname, self.proxy.port or 80
+        )
+        if self.ssl is None:
+            # Plain HTTP requests go to the proxy with the API's URL in full
+            return reader, writer
+
+        # HTTPS goes through a CONNECT tunnel, with TLS to the API inside it
+        authority = "%s:%s" % (self.host, self.port)
+        writer.write(
+            (
+                "CONNECT %s HTTP/1.1\r\nHost: %s\r\n%s\r\n"
+                % (
+                    authority,
+                    authority,
+                    "".join(
+                        "%s: %s\r\n" % header
+                        for header in proxy_headers(self.proxy).items()
+                    ),
+                )
+            ).encode("latin-1")
+        )
+        await writer.drain()
+        version, status_code, headers = await read_head(reader)
+        if status_code != 200:
+            writer.close()
+            raise ConnectionRefusedError(
+                "Proxy refused to connect to %s: %s" % (authority, status_code)
+            )
+
+        loop = asyncio.get_running_loop()
+        tls_reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(tls_reader)
+        transport = await loop.start_tls(
+            writer.transport, protocol, self.ssl, server_hostname=self.host
+        )
+        return tls_reader, asyncio.StreamWriter(transport, protocol, tls_reader, loop)
+
+    async def connection(self, connect_timeout):
+        """Returns an idle connection the server hasn't closed, or else a new one."""
+
+        while self.idle:
+            connection = self.idle.pop()
+            if not is_stale(connection):
+                return connection
+            connection[1].close()
+        try:
+            return await asyncio.wait_for(self.open_connection(), connect_timeout)
+        except CONNECTION_ERRORS as e:
+            raise RequestNotSentError(
+                "Unable to connect to %s: %s" % (self.host_header, e)
+            ) from e
+
+    async def post(self, path, body, timeouts, headers=None):
+        connect_timeout, read_timeout = timeouts
+        headers = dict(headers or {})
+        target = path
+        if self.proxy is not None and self.ssl is None:
+            target = self.origin + path
+            headers.update(proxy_headers(self.proxy))
+        request = (
+            "POST %s HTTP/1.1\r\n"
+            "Host: %s\r\n"
+            "Content-Type: application/json\r\n"
+            "Content-Length: %s\r\n"
+            "Accept-Encoding: gzip\r\n"
+            "%s"
+            "\r\n"
+            % (
+                target,
+                self.host_header,
+                len(body),
+                "".join("%s: %s\r\n" % header for header in headers.items()),
+            )
+        ).encode("latin-1") + body
+
+        # Created on first use, so it belongs to the loop the requests run on
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_connections)
+        async with self.slots:
+            reader, writer = await self.connection(connect_timeout)
+            try:
+                writer.write(request)
+                await writer.drain()
+                response, keep_alive = await asyncio.wait_for(
+                    read_response(reader), read_timeout
+                )
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+            return response
+
+    def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+
+
+class AsyncLockClient(BaseLockClient):
+    """Acquires and releases locks for one service from asyncio code.
+
+    Requests are retried like LockClient's and share up to max_connections
+    kept-alive connections, so one event loop can keep hundreds of them in flight.
+
+        async with AsyncLockClient(api_url, "Orchestrator", "SlingLockTable",
+                                   "SlingRegisteredServices", "SlingLogTable") as client:
+            async with client.lock("MyLock") as acquired:
+                ...
+    """
+
+    def __init__(self, *args, max_connections=DEFAULT_MAX_CONNECTIONS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ConnectionPool(self.api_url, max_connections)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+
+    async def post(
+        self, route, params, retry_conflicts=False, extra_read_timeout=0, idempotent=True
+    ):
+        """Posts params to route, retrying failures that may pass on another attempt.
+
+        Requests that aren't idempotent are only sent again if they were never written
+        to a connection, as they may have reached the API otherwise.
+        """
+
+        path = urlsplit(urljoin(self.api_url, route)).path
+        body = json.dumps(params).encode("utf-8")
+        timeouts = self.timeouts(extra_read_timeout)
+        for attempt in range(self.max_attempts):
+            last_attempt = attempt == self.max_attempts - 1
+            try:
+                response = await self.pool.post(path, body, timeouts, self.headers)
+            except CONNECTION_ERRORS as e:
+                if last_attempt or not (
+                    idempotent or isinstance(e, RequestNotSentError)
+                ):
+                    raise
+            else:
+                retryable = self.retryable(
+                    response.status_code, retry_conflicts, idempotent
+                )
+                if not retryable or last_attempt:
+                    return response
+            await asyncio.sleep(self.backoff(attempt))
+
+    async def acquire(self, lock_name, **acquire_options):
+        """Acquires lock_name, taking the same options as LockClient.acquire."""
+
+        route, params, options = self.acquire_request(lock_name, **acquire_options)
+        return self.check(
+            await self.post(route, params, **options),
+            "Unable to acquire lock: %s" % lock_name,
+            LockNotAcquiredError,
+        )
+
+    async def release(self, lock_name, acquired, mode=None, hierarchical=False):
+        """Releases lock_name, given the ResponseMetadata acquire returned for it."""
+
+        route, params, options = self.release_request(
+            lock_name, acquired, mode, hierarchical
+        )
+        return self.check(
+            await self.post(route, params, **options),
+            "Unable to release lock: %s" % lock_name,
+        )
+
+    async def renew(self, lock_name, acquired, lease_duration, mode=None):
+        """Extends the lease on lock_name, given the ResponseMetadata acquire returned."""
+
+        route, params, options = self.renew_request(
+            lock_name, acquired, lease_duration, mode
+        )
+        return self.check(
+            await self.post(route, params, **options),
+            "Unable to renew lock: %s" % lock_name,
+        )
+
+    async def register_lock(self, lock_name, permits=None):
+        """Registers lock_name, as a semaphore with that many permits if permits is set."""
+
+        params = {"LockName": lock_name, "LockTableName": self.lock_table_name}
+        if permits is not None:
+            params["Permits"] = permits
+        return self.check(
+            await self.post("register_lock", params, idempotent=False),
+            "Unable to register lock: %s" % lock_name,
+        )
+
+    async def register_service(self):
+        """Registers the client's service so it can acquire locks."""
+
+        params = {
+            "ServiceName": self.service_name,
+            "ServiceTableName": self.service_table_name,
+        }
+        return self.check(
+            await self.post("register_service", params, idempotent=False),
+            "Unable to register service: %s" % self.service_name,
+        )
+
+    async def acquire_many(self, lock_names, return_exceptions=False, **acquire_options):
+        """Acquires every lock in lock_names concurrently, like asyncio.gather.
+
+        Returns the ResponseMetadata of each acquire in the order of lock_names. If any
+        acquire fails, the locks that were acquired are released and its error is
+        raised, unless return_exceptions is set, in which case the errors are returned
+        in place of their results and nothing is released. Unlike the acquire_batch
+        route, the locks aren't acquired in one transaction.
+        """
+
+        results = await asyncio.gather(
+            *[self.acquire(lock_name, **acquire_options) for lock_name in lock_names],
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if return_exceptions or not errors:
+            return results
+
+        mode = acquire_options.get("mode")
+        hierarchical = acquire_options.get("hierarchical", False)
+        await asyncio.gather(
+            *[
+                self.release(lock_name, result, mode, hierarchical)
+                for lock_name, result in zip(lock_names, results)
+                if not isinstance(result, BaseException)
+            ],
+            return_exceptions=True,
+        )
+        raise errors[0]
+
+    @asynccontextmanager
+    async def lock(self, lock_name, mode=None, hierarchical=False, **acquire_options):
+        """Holds lock_name for the body of an async with statement, releasing it however it exits."""
+
+        acquired = await self.acquire(
+            lock_name, mode=mode, hierarchical=hierarchical, **acquire_options
+        )
+        try:
+            yield acquired
+        finally:
+            await self.release(lock_name, acquired, mode=mode, hierarchical=hierarchical)
@@ -0,0 +1,138 @@
+"""Conditional request cache for the GitHub API.
+
+GitHub answers a request that carries the ETag or Last-Modified of the response it
+last gave with a 304 Not Modified, which doesn't count against the rate limit.
+ConditionalRequestAdapter sends those headers for GET requests it has a cached
+response for, and answers a 304 with the cached response, so callers such as
+github3 see the same 200 they would have without the cache.
+"""
+
+import base64
+import json
+import logging
+import os
+import threading
+
+from collections import OrderedDict
+
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+# Headers that describe the body as it came over the wire, which the cache doesn't keep
+WIRE_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+
+class FileResponseCache:
+    """Responses kept in a JSON file, forgetting the least recently used past max_entries.
+
+    Lambda keeps /tmp between invocations of a warm container, so a cache file there
+    lasts as long as the container does.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self.entries.update(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.debug("Starting with an empty GitHub cache: %s", str(e))
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+            return entry
+
+    def set(self, url, entry):
+        with self.lock:
+            self.entries[url] = entry
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self):
+        """Writes the cache to its file, replacing the old one only once it is complete."""
+
+        with self.lock:
+            temporary_path = "%s.%s" % (self.path, os.getpid())
+            with open(temporary_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(temporary_path, self.path)
+
+
+def cache_entry(response):
+    """Returns what the cache keeps of response, or None if GitHub can't revalidate it."""
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag is None and last_modified is None:
+        return None
+    return {
+        "etag": etag,
+        "last_modified": last_modified,
+        "headers": {
+            name: value
+            for name, value in response.headers.items()
+            if name.lower() not in WIRE_HEADERS
+        },
+        "content": base64.b64encode(response.content).decode("ascii"),
+    }
+
+
+class ConditionalRequestAdapter(HTTPAdapter):
+    """Transport adapter that revalidates cached GET responses instead of refetching them.
+
+        session.mount("https://api.github.com/", ConditionalRequestAdapter(cache))
+    """
+
+    def __init__(self, cache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != "GET" or stream:
+            return super().send(request, stream=stream, **kwargs)
+
+        entry = self.cache.get(request.url)
+        if entry is not None:
+            if entry["etag"] is not None:
+                request.headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] is not None:
+                request.headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = super().send(request, stream=stream, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            return self.cached_response(request, entry, response)
+        if response.status_code == 200:
+            new_entry = cache_entry(response)
+            if new_entry is not None:
+                self.cache.set(request.url, new_entry)
+        return response
+
+    def cached_response(self, request, entry, not_modified):
+        """Builds the 200 response a 304 stands for, with the 304's fresher headers."""
+
+        response = Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.headers.update(
+            (name, value)
+            for name, value in not_modified.headers.items()
+            if name.lower() not in WIRE_HEADERS
+        )
+        response._content = base64.b64decode(entry["content"])
+        response.encoding = not_modified.encoding or "utf-8"
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = not_modified.elapsed
+        not_modified.close()
+        return response
@@ -0,0 +1,99 @@
+"""Reports how long a cold start spends loading app.py for each set of blueprints.
+
+Each set is loaded in a new interpreter with python -X importtime, as Lambda loads
+it in a new container. Run it from anywhere with:
+
+    python -m chalicelib.import_report --top 10 --budget 400
+
+It exits with status 1 when loading any set takes longer than the budget, in
+milliseconds, so it can fail a build that slows cold starts down.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Sets of blueprints a deployment of app.py can serve, as SLING_BLUEPRINTS names them
+BLUEPRINT_SETS = ("lockapi", "prmbot", "lockapi,prmbot")
+
+
+def parse_import_times(output):
+    """Returns (module, self_us, cumulative_us) for each import in -X importtime output."""
+
+    times = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            # The header naming the columns
+            continue
+        times.append((module.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def import_times(blueprints, module="app"):
+    """Imports module in a new interpreter serving blueprints and returns its import times."""
+
+    env = dict(os.environ, SLING_BLUEPRINTS=blueprints)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        cwd=PROJECT_DIR,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(
+            "Unable to import %s for %s: %s" % (module, blueprints, result.stderr)
+        )
+    return parse_import_times(result.stderr)
+
+
+def report(blueprints, times, top=10):
+    """Formats the total import time and the slowest imports by their own time."""
+
+    total_us = sum(self_us for _, self_us, _ in times)
+    lines = [
+        "%s: %.1f ms over %s modules"
+        % (blueprints, total_us / 1000, len(times))
+    ]
+    slowest = sorted(times, key=lambda time: -time[1])[:top]
+    for module, self_us, cumulative_us in slowest:
+        lines.append(
+            "    %8.1f ms self %8.1f ms cumulative  %s"
+            % (self_us / 1000, cumulative_us / 1000, module)
+        )
+    return "\n".join(lines), total_us / 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report Sling's import times")
+    parser.add_argument(
+        "--blueprints",
+        action="append",
+        help="Comma separated blueprints to load. Defaults to each deployable set",
+    )
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument(
+        "--budget", type=float, help="Milliseconds any set may take to load"
+    )
+    args = parser.parse_args(argv)
+
+    over_budget = False
+    for blueprints in args.blueprints or BLUEPRINT_SETS:
+        text, total_ms = report(blueprints, import_times(blueprints), args.top)
+        print(text)
+        if args.budget is not None and total_ms > args.budget:
+            print("    Over the %.1f ms budget" % args.budget)
+            over_budget = True
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
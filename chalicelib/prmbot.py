@@ -1,15 +1,18 @@
 import logging
 import json
-import requests
 import base64
+import hashlib
+import hmac
 import os
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
-from github3 import login, GitHubError
-from chalice import Blueprint
-from urllib3.exceptions import NewConnectionError
+from chalice import Blueprint, Response
 
-from .state_manager import state_manager_acquire, state_manager_release
+# github3, requests and the lock client are imported by the functions that use them,
+# so an app that also serves the lock API doesn't load them on every cold start
 
 prmbot = Blueprint(__name__)
 
@@ -22,6 +25,93 @@ logger.addHandler(console)
 # Environmental Variables
 PRM_BOT_RUNTIME = os.environ.get("PRM_BOT_RUNTIME", 300)
 
+# Pull requests whose reviews are fetched at once, unless the config sets review_workers
+DEFAULT_REVIEW_WORKERS = 8
+
+# How the bot finds mergeable pull requests, as set by the discovery config key. REST
+# lists every open pull request and fetches reviews for each labelled one, while
+# GraphQL fetches labelled pull requests with their reviews a page at a time.
+REST_DISCOVERY = "rest"
+GRAPHQL_DISCOVERY = "graphql"
+
+GITHUB_API_URL = "https://api.github.com/"
+GRAPHQL_URL = GITHUB_API_URL + "graphql"
+
+# GitHub events the webhook route acts on. Label events are about the repository's
+# labels rather than a pull request, so relabelled pull requests come in as
+# pull_request events and label events are only acknowledged.
+WEBHOOK_EVENTS = ("pull_request", "pull_request_review", "label")
+
+# Where the bot keeps its verdicts on each pull request between runs, unless the
+# config sets scan_cursor_path. An empty path checks every pull request every run.
+DEFAULT_SCAN_CURSOR_PATH = "/tmp/sling_scan_cursor.json"
+
+# Where the bot keeps GitHub responses to revalidate with ETags, and how many it keeps,
+# unless the config sets github_cache_path or github_cache_entries. 0 entries turns it off.
+DEFAULT_GITHUB_CACHE_PATH = "/tmp/sling_github_cache.json"
+DEFAULT_GITHUB_CACHE_ENTRIES = 1000
+
+# GitHub gives up on a webhook delivery after 10 seconds, so the webhook route makes a
+# single attempt at each lock API request, with this (connect, read) timeout
+WEBHOOK_LOCK_TIMEOUT = (1, 3)
+
+# Pull requests per GraphQL page, which GitHub caps at 100
+GRAPHQL_PAGE_SIZE = 50
+
+MERGEABLE_PR_QUERY = """
+query($owner: String!, $name: String!, $labels: [String!], $pageSize: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, labels: $labels, first: $pageSize, after: $cursor) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        number
+        databaseId
+        reviews(first: $pageSize) {
+          pageInfo {
+            hasNextPage
+            endCursor
+          }
+          nodes {
+            state
+            authorAssociation
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+# Follows the reviews of one pull request past the page MERGEABLE_PR_QUERY returned
+PR_REVIEWS_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $pageSize: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      reviews(first: $pageSize, after: $cursor) {
+        pageInfo {
+          hasNextPage
+          endCursor
+        }
+        nodes {
+          state
+          authorAssociation
+        }
+      }
+    }
+  }
+}
+"""
+
+# A review from a GraphQL response, with the attributes has_valid_review reads
+GraphQLReview = namedtuple("GraphQLReview", ["state", "author_association"])
+
+
+class GraphQLError(Exception):
+    """Raised when GitHub answers a GraphQL query with errors."""
+
 
 def get_secret(secret_name, region_name):
     """Grabs the values from AWS Secrets Manager"""
@@ -85,22 +175,152 @@ def has_valid_review(reviews, pr_id):
     return False
 
 
-def get_mergeable_pr(pr_generator, config):
-    """Returns a list of pull requests that are ready to be merged"""
+def is_approved(pull_req):
+    """Fetches the reviews of a pull request and checks if one makes it mergeable.
+
+    A pull request whose reviews can't be fetched is logged, and None is returned.
+    """
+
+    import requests
+    from github3 import GitHubError
+
+    try:
+        # reviews() pages through the reviews lazily, so they are fetched here
+        return has_valid_review(pull_req.reviews(), pull_req.id)
+    except (requests.exceptions.RequestException, GitHubError) as e:
+        logger.warning(f"Unable to fetch reviews of pull request #{pull_req.id}: {str(e)}")
+        return None
+
+
+def pr_version(pull_req):
+    """Returns the number, updated_at and head SHA that tell versions of a pull request apart."""
 
-    mergeable_pr = []
-    for pull_req in pr_generator:
-        labels = pull_req.labels
-        if has_valid_label(labels, config["merge_label"]):
-            reviews = pull_req.reviews()
-            if has_valid_review(reviews, pull_req.id):
-                mergeable_pr.append(pull_req)
-    return mergeable_pr
+    return pull_req.number, pull_req.updated_at.isoformat(), pull_req.head.sha
+
+
+def get_mergeable_pr(pr_generator, config, scan_cursor=None):
+    """Returns a list of pull requests that are ready to be merged
+
+    Reviews of the labelled pull requests are fetched by up to review_workers threads
+    at once. The list keeps the order of pr_generator. With a scan_cursor, pull
+    requests that haven't changed since its last run reuse its verdicts instead.
+    """
+
+    labelled_pr = [
+        pull_req
+        for pull_req in pr_generator
+        if has_valid_label(pull_req.labels, config["merge_label"])
+    ]
+
+    # None marks the pull requests whose reviews have to be fetched
+    approvals = [
+        None if scan_cursor is None else scan_cursor.verdict(*pr_version(pull_req))
+        for pull_req in labelled_pr
+    ]
+    changed = [index for index, approved in enumerate(approvals) if approved is None]
+
+    review_workers = min(
+        config.get("review_workers", DEFAULT_REVIEW_WORKERS), len(changed)
+    )
+    changed_pr = [labelled_pr[index] for index in changed]
+    if review_workers > 1:
+        with ThreadPoolExecutor(max_workers=review_workers) as executor:
+            changed_approvals = list(executor.map(is_approved, changed_pr))
+    else:
+        changed_approvals = [is_approved(pull_req) for pull_req in changed_pr]
+    for index, approved in zip(changed, changed_approvals):
+        approvals[index] = approved
+
+    if scan_cursor is not None:
+        for pull_req, approved in zip(labelled_pr, approvals):
+            # Pull requests whose reviews couldn't be fetched are checked again next run
+            if approved is not None:
+                scan_cursor.record(*pr_version(pull_req), approved)
+
+    return [pull_req for pull_req, approved in zip(labelled_pr, approvals) if approved]
+
+
+def graphql_query(session, query, variables):
+    """Runs a GraphQL query and returns the repository it read."""
+
+    response = session.post(GRAPHQL_URL, json={"query": query, "variables": variables})
+    response.raise_for_status()
+    body = response.json()
+    if body.get("errors"):
+        raise GraphQLError(
+            "; ".join(error.get("message", "") for error in body["errors"])
+        )
+    return body["data"]["repository"]
+
+
+def labelled_pr_nodes(session, config):
+    """Yields the open pull requests labelled with the merge_label, a GraphQL page at a time."""
+
+    variables = {
+        "owner": config["repo_owner"],
+        "name": config["repo_name"],
+        "labels": [config["merge_label"]],
+        "pageSize": GRAPHQL_PAGE_SIZE,
+    }
+    cursor = None
+    while True:
+        pull_requests = graphql_query(
+            session, MERGEABLE_PR_QUERY, dict(variables, cursor=cursor)
+        )["pullRequests"]
+        yield from pull_requests["nodes"]
+        if not pull_requests["pageInfo"]["hasNextPage"]:
+            return
+        cursor = pull_requests["pageInfo"]["endCursor"]
+
+
+def pr_node_reviews(session, config, node):
+    """Yields every review of a pull request node, fetching the pages after its first.
+
+    Like pull_req.reviews() on the REST path, this is every review rather than the
+    latest of each author, so both paths reach the same verdict.
+    """
+
+    reviews = node["reviews"]
+    while True:
+        for review in reviews["nodes"]:
+            yield GraphQLReview(review["state"], review["authorAssociation"])
+        if not reviews["pageInfo"]["hasNextPage"]:
+            return
+        reviews = graphql_query(
+            session,
+            PR_REVIEWS_QUERY,
+            {
+                "owner": config["repo_owner"],
+                "name": config["repo_name"],
+                "number": node["number"],
+                "pageSize": GRAPHQL_PAGE_SIZE,
+                "cursor": reviews["pageInfo"]["endCursor"],
+            },
+        )["pullRequest"]["reviews"]
+
+
+def get_mergeable_pr_graphql(github_client, repository, config):
+    """Returns a list of pull requests that are ready to be merged, found with GraphQL
+
+    Labels and reviews come from one paginated query, so only the pull requests that
+    are mergeable are fetched over REST, to merge them. The verdict is the same one
+    get_mergeable_pr reaches for each pull request.
+    """
+
+    session = github_client.session
+    return [
+        repository.pull_request(node["number"])
+        for node in labelled_pr_nodes(session, config)
+        if has_valid_review(pr_node_reviews(session, config, node), node["databaseId"])
+    ]
 
 
 def merge_pull_req(mergeable_pr_list, config):
     """Merges qualified pull requests and returns list of pull requests that somehow fail to merge"""
 
+    import requests
+    from github3 import GitHubError
+
     failed_mergeable_pr = []
     for pull_req in mergeable_pr_list:
         pr_id = pull_req.id
@@ -118,56 +338,57 @@ def merge_pull_req(mergeable_pr_list, config):
     return failed_mergeable_pr
 
 
-@prmbot.schedule(f"rate({PRM_BOT_RUNTIME} minutes)")
-def prm_bot(event):
+def merge_with_lock(mergeable_pr, config, wait=True):
+    """Merges mergeable_pr while holding the lock named in config
 
-    # Config File Settings
-    config_path = "chalicelib/settings/config.json"
-    config = get_config(config_path)
-
-    # GitHub Login Credentials
-    secret_name = config["secret_name"]
-    region_name = config["region_name"]
-
-    github_credentials = get_secret(secret_name, region_name)
-    github_username = github_credentials["github_username"]
-    github_password = github_credentials["github_password"]
-
-    # Get GitHub Repository
-    github_client = login(github_username, password=github_password)
-    repository = github_client.repository(config["repo_owner"], config["repo_name"])
+    Returns None if every pull request merged, or else a dict with the message and
+    the HTTP status_code that describe the failure. Without wait, the lock is tried
+    once, without waiting for it to free up, and lock API requests aren't retried.
+    """
 
-    # Find all mergeable PR
-    pull_req_generator = repository.pull_requests()
-    mergeable_pr = get_mergeable_pr(pull_req_generator, config)
+    import requests
+    from urllib3.exceptions import NewConnectionError
 
-    if len(mergeable_pr) == 0:
-        logger.warning("Nothing to do here")
-        return "Nothing to do here"
+    from .state_manager import LockClient, LockClientError, LockNotAcquiredError
 
     service_name = config["service_name"]
     lock_name = config["lock_name"]
     lock_table_name = config["lock_table_name"]
     service_table_name = config["service_table_name"]
     log_table_name = config["log_table_name"]
+    # A lease frees the lock even if this invocation dies before releasing it
+    lease_duration = config.get("lease_duration")
+    # When set, the API holds the request open until the lock frees up or this many seconds pass
+    acquire_wait_timeout = config.get("acquire_wait_timeout")
+    # Bots for urgent work, such as hotfixes, get ahead of routine runs for the same lock
+    priority = config.get("priority")
 
     # Find API Route and strip possible leading or trailing white spaces
     api_route = config["api_route"].strip()
     if not api_route:
         logger.critical("No REST API URL found in config. ")
         return {
-            "message": "Endpoint configured incorrectly or inaccessible. Please contact service administrator"
+            "message": "Endpoint configured incorrectly or inaccessible. Please contact service administrator",
+            "status_code": 500,
         }
+    client_options = {} if wait else {"timeout": WEBHOOK_LOCK_TIMEOUT, "max_attempts": 1}
+    client = LockClient(
+        api_route,
+        service_name,
+        lock_table_name,
+        service_table_name,
+        log_table_name,
+        **client_options,
+    )
     try:
-        acquire_lock_resp = state_manager_acquire(
-            api_route, service_name, lock_name, lock_table_name, service_table_name
-        )
-        if acquire_lock_resp.status_code == 200:
-
-            # Grab JobId for later release of lock
-            job_id = acquire_lock_resp.json()["ResponseMetadata"]["JobId"]
-
-            logger.warning("Acquired lock successfully. JobID: %s", job_id)
+        # The lock is released when the block exits, even if merging raises
+        with client.lock(
+            lock_name,
+            lease_duration=lease_duration,
+            wait_timeout=(acquire_wait_timeout or None) if wait else None,
+            priority=priority,
+        ) as acquired:
+            logger.warning("Acquired lock successfully. JobID: %s", acquired["JobId"])
 
             # Merge the pull requests. We should know which ones failed.
             failed_mergeable_pr = merge_pull_req(mergeable_pr, config)
@@ -179,33 +400,175 @@ def prm_bot(event):
             logger.warning(
                 "Failed to merge the following pull requests: %s", failed_mergeable_pr
             )
-
-            release_lock_resp = state_manager_release(
-                api_route,
-                service_name,
-                lock_name,
-                job_id,
-                lock_table_name,
-                log_table_name,
-            )
-
-            if release_lock_resp.status_code == 200:
-                logger.warning("Released lock successfully")
-            else:
-                # CloudWatch Alarms Catches this and reports it
-                message = "For JobId: {0} :Failed to release lock: {1}".format(
-                    job_id, release_lock_resp.json()["Message"]
-                )
-                logger.critical(message)
-        else:
-            # CloudWatch Alarms Catches this and reports it
-            message = "Failed to acquire lock"
-            logger.warning(message)
+        logger.warning("Released lock successfully")
+    except LockNotAcquiredError:
+        # CloudWatch Alarms Catches this and reports it
+        logger.warning("Failed to acquire lock")
+        return {"message": "Failed to acquire lock: %s" % lock_name, "status_code": 409}
+    except LockClientError as e:
+        # CloudWatch Alarms Catches this and reports it
+        logger.critical("%s: %s", e, e.response.text)
+        return {"message": str(e), "status_code": 502}
     except (
         requests.exceptions.ConnectionError,
         requests.exceptions.RequestException,
         NewConnectionError,
     ) as e:
         logger.critical(f"The following exception occurred: {str(e)}")
+        return {"message": "Lock API unavailable", "status_code": 503}
     except Exception as e:
         logger.critical(str(e))
+        return {"message": "Unable to merge pull requests", "status_code": 500}
+
+    if failed_mergeable_pr:
+        return {
+            "message": "Unable to merge pull requests: %s"
+            % ", ".join("#%s" % pull_req.number for pull_req in failed_mergeable_pr),
+            "status_code": 502,
+        }
+
+
+@prmbot.schedule(f"rate({PRM_BOT_RUNTIME} minutes)")
+def prm_bot(event):
+    from github3 import login
+
+    from .github_cache import ConditionalRequestAdapter, FileResponseCache
+    from .scan_cursor import ScanCursor
+
+    # Config File Settings
+    config_path = "chalicelib/settings/config.json"
+    config = get_config(config_path)
+
+    # GitHub Login Credentials
+    secret_name = config["secret_name"]
+    region_name = config["region_name"]
+
+    github_credentials = get_secret(secret_name, region_name)
+    github_username = github_credentials["github_username"]
+    github_password = github_credentials["github_password"]
+
+    # Get GitHub Repository
+    github_client = login(github_username, password=github_password)
+    github_cache = None
+    github_cache_entries = config.get(
+        "github_cache_entries", DEFAULT_GITHUB_CACHE_ENTRIES
+    )
+    if github_cache_entries > 0:
+        # Unchanged pull request lists and reviews come back as 304s from the cache
+        github_cache = FileResponseCache(
+            config.get("github_cache_path", DEFAULT_GITHUB_CACHE_PATH),
+            github_cache_entries,
+        )
+        github_client.session.mount(
+            GITHUB_API_URL, ConditionalRequestAdapter(github_cache)
+        )
+    repository = github_client.repository(config["repo_owner"], config["repo_name"])
+
+    # Find all mergeable PR
+    if config.get("discovery", REST_DISCOVERY) == GRAPHQL_DISCOVERY:
+        mergeable_pr = get_mergeable_pr_graphql(github_client, repository, config)
+    else:
+        scan_cursor = None
+        scan_cursor_path = config.get("scan_cursor_path", DEFAULT_SCAN_CURSOR_PATH)
+        if scan_cursor_path:
+            scan_cursor = ScanCursor(
+                scan_cursor_path, "%s/%s" % (config["repo_owner"], config["repo_name"])
+            )
+        pull_req_generator = repository.pull_requests()
+        mergeable_pr = get_mergeable_pr(pull_req_generator, config, scan_cursor)
+        if scan_cursor is not None:
+            try:
+                scan_cursor.save()
+            except OSError as e:
+                logger.warning(f"Unable to save the scan cursor: {str(e)}")
+    if github_cache is not None:
+        try:
+            github_cache.save()
+        except OSError as e:
+            logger.warning(f"Unable to save the GitHub cache: {str(e)}")
+
+    if len(mergeable_pr) == 0:
+        logger.warning("Nothing to do here")
+        return "Nothing to do here"
+
+    return merge_with_lock(mergeable_pr, config)
+
+
+def valid_signature(secret, body, signature):
+    """Checks the X-Hub-Signature-256 GitHub sent with a webhook delivery of body."""
+
+    if not secret or not signature:
+        return False
+    expected = "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def webhook_response(message, status_code=200):
+    return Response(
+        body={"Message": message},
+        status_code=status_code,
+        headers={"Content-Type": "application/json"},
+    )
+
+
+@prmbot.route("/webhook", methods=["POST"])
+def prm_bot_webhook():
+    """Merges the pull request a GitHub webhook event is about, if it is now mergeable
+
+    The scheduled run still sweeps every pull request, catching any event that was missed.
+    """
+
+    from github3 import login
+
+    request = prmbot.current_request
+
+    # Config File Settings
+    config_path = "chalicelib/settings/config.json"
+    config = get_config(config_path)
+
+    github_credentials = get_secret(config["secret_name"], config["region_name"])
+    if not valid_signature(
+        github_credentials.get("webhook_secret"),
+        request.raw_body,
+        request.headers.get("X-Hub-Signature-256"),
+    ):
+        logger.warning("Rejected a webhook delivery with an invalid signature")
+        return webhook_response("Invalid signature", 401)
+
+    event = request.headers.get("X-GitHub-Event")
+    if event == "ping":
+        return webhook_response("pong")
+    if event not in WEBHOOK_EVENTS:
+        return webhook_response("Unsupported event: %s" % event, 400)
+
+    payload = json.loads(request.raw_body)
+    pull_request = payload.get("pull_request")
+    repository_name = payload.get("repository", {}).get("full_name", "")
+    if (
+        pull_request is None
+        or repository_name.lower()
+        != ("%s/%s" % (config["repo_owner"], config["repo_name"])).lower()
+    ):
+        return webhook_response("Nothing to do here")
+
+    # The payload carries the labels, so only labelled pull requests reach GitHub
+    if pull_request["state"] != "open" or not has_valid_label(
+        pull_request["labels"], config["merge_label"]
+    ):
+        return webhook_response("Nothing to do here")
+
+    github_client = login(
+        github_credentials["github_username"],
+        password=github_credentials["github_password"],
+    )
+    repository = github_client.repository(config["repo_owner"], config["repo_name"])
+    pull_req = repository.pull_request(pull_request["number"])
+    if not is_approved(pull_req):
+        return webhook_response("Nothing to do here")
+
+    # Waiting for the lock could outlast GitHub's delivery timeout, and a pull request
+    # left unmerged because the lock was held is merged by the scheduled run
+    failure = merge_with_lock([pull_req], config, wait=False)
+    if failure is not None:
+        return webhook_response(failure["message"], failure["status_code"])
+    return webhook_response("Evaluated pull request #%s" % pull_request["number"])
@@ -0,0 +1,78 @@
+"""Remembers what the bot decided about each pull request between runs.
+
+A pull request's reviews only change along with its updated_at, and its commits
+with its head SHA. So a pull request that hasn't been updated since the last run's
+cursor and still has the same head keeps the verdict it got then, and only pull
+requests that changed since have their reviews fetched again.
+"""
+
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ScanCursor:
+    """The newest updated_at the bot has seen in a repository, and its verdicts by PR number.
+
+    Cursors of every repository are kept in one JSON file at path.
+    """
+
+    def __init__(self, path, repository_name):
+        self.path = path
+        self.repository_name = repository_name
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                state = json.load(f).get(repository_name, {})
+        except (OSError, ValueError) as e:
+            logger.debug("Starting a new scan cursor: %s", str(e))
+            state = {}
+        self.updated_at = state.get("updated_at")
+        self.verdicts = state.get("verdicts", {})
+        self.next_updated_at = self.updated_at
+        self.next_verdicts = {}
+
+    def verdict(self, number, updated_at, head_sha):
+        """Returns the earlier verdict on a pull request, or None if it has to be checked again.
+
+        Pull requests updated at the cursor itself are checked again, as they may have
+        changed after the last run listed them within the same second.
+        """
+
+        verdict = self.verdicts.get(str(number))
+        if (
+            verdict is None
+            or self.updated_at is None
+            or updated_at >= self.updated_at
+            or verdict["head_sha"] != head_sha
+        ):
+            return None
+        return verdict["approved"]
+
+    def record(self, number, updated_at, head_sha, approved):
+        """Keeps a verdict for the next run. Pull requests not recorded are forgotten."""
+
+        with self.lock:
+            self.next_verdicts[str(number)] = {"head_sha": head_sha, "approved": approved}
+            if self.next_updated_at is None or updated_at > self.next_updated_at:
+                self.next_updated_at = updated_at
+
+    def save(self):
+        """Writes this run's cursor and verdicts, keeping other repositories' cursors."""
+
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        state[self.repository_name] = {
+            "updated_at": self.next_updated_at,
+            "verdicts": self.next_verdicts,
+        }
+        temporary_path = "%s.%s" % (self.path, os.getpid())
+        with open(temporary_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,125 @@
+"""Serves the lock API from a long-running HTTP server instead of API Gateway and Lambda.
+
+Requests and responses match the deployed routes, so state_manager clients only need
+the server's url as their api_url. Run it with:
+
+    python -m chalicelib.server --host 0.0.0.0 --port 8000
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+
+from chalice.config import Config
+from chalice.local import ChaliceRequestHandler, LocalChalice, LocalDevServer
+
+from .api import SingletonDynamoDBClient, lockapi
+from .storage import LocalClient, create_tables
+
+
+logger = logging.getLogger(__name__)
+
+# Logger prints to console
+console = logging.StreamHandler()
+logger.addHandler(console)
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "settings", "config.json")
+
+# Environmental Variables
+SERVER_HOST = os.environ.get("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", 8000))
+
+# Bytes a response body needs before it is gzipped. Single lock responses stay
+# under it, while batch responses for many locks go over it.
+GZIP_MIN_SIZE = int(os.environ.get("GZIP_MIN_SIZE", 1024))
+
+
+def accepts_gzip(accept_encoding):
+    """Checks if an Accept-Encoding header value allows a gzipped response."""
+
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+class LockRequestHandler(ChaliceRequestHandler):
+    # Headers and body go out in separate writes, which Nagle's algorithm would
+    # otherwise hold back until the client acknowledges the first one
+    disable_nagle_algorithm = True
+
+    def _send_http_response_with_body(self, code, headers, body):
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        if len(body) >= GZIP_MIN_SIZE and accepts_gzip(
+            self.headers.get("Accept-Encoding", "")
+        ):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+            headers["Vary"] = "Accept-Encoding"
+        super()._send_http_response_with_body(code, headers, body)
+
+
+def create_app():
+    """Returns an app serving the lock API.
+
+    LocalChalice keeps the current request per thread, so one app can serve every
+    connection the threaded server accepts. Chalice blueprints can only be
+    registered to one app, so this is for processes that don't also load app.py.
+    """
+
+    app = LocalChalice(app_name="state_management")
+
+    # Blueprints confirmed to be fully supported
+    app.experimental_feature_flags.update(["BLUEPRINTS"])
+    app.register_blueprint(lockapi)
+    return app
+
+
+def make_server(host, port, config_path=None):
+    """Returns a server for the lock API that is ready to serve_forever.
+
+    The storage client is created up front, so every request reuses its connections.
+    Local backends also get the tables named in the config at config_path.
+    """
+
+    client = SingletonDynamoDBClient.getInstance()
+    if isinstance(client, LocalClient):
+        with open(config_path or CONFIG_PATH, "r") as f:
+            config = json.load(f)
+        create_tables(
+            client,
+            config["lock_table_name"],
+            config["service_table_name"],
+            config["log_table_name"],
+        )
+
+    # Each connection is served by its own thread and kept alive between requests
+    return LocalDevServer(
+        create_app(), Config(), host, port, handler_cls=LockRequestHandler
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the Sling lock API")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument(
+        "--config",
+        default=CONFIG_PATH,
+        help="Config naming the tables local storage backends create",
+    )
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, args.config)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.warning("Shutting down")
+
+
+if __name__ == "__main__":
+    main()
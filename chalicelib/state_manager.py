@@ -1,34 +1,525 @@
+import random
+import time
+import uuid
+from contextlib import contextmanager
+
 import requests
 from urllib.parse import urljoin
+from urllib3.exceptions import NewConnectionError
 
-## Acquire Lock
-def state_manager_acquire(
-    api_url, service_name, lock_name, lock_table_name, service_table_name
+# Seconds to wait for a connection to the API and for its response
+DEFAULT_TIMEOUT = (3.05, 10)
+
+# Attempts a LockClient makes at a request before giving up
+DEFAULT_MAX_ATTEMPTS = 5
+
+# Seconds between attempts start around the base and back off up to the cap
+DEFAULT_BACKOFF_BASE = 0.1
+DEFAULT_BACKOFF_CAP = 2.0
+
+# Header that asks the lock API for compact responses
+RESPONSE_FORMAT_HEADER = "X-Sling-Response-Format"
+
+
+def acquire_params(
+    service_name,
+    lock_name,
+    lock_table_name,
+    service_table_name,
+    lease_duration=None,
+    ticket=None,
+    mode=None,
+    hierarchical=False,
+    priority=None,
+    idempotency_key=None,
 ):
-    url = urljoin(api_url, "acquire")
+    """Builds the body of an acquire or acquire_wait request."""
+
     params = {
         "LockName": lock_name,
         "ServiceName": service_name,
         "LockTableName": lock_table_name,
         "ServiceTableName": service_table_name,
     }
+    # Without a lease the lock is held until it is released
+    if lease_duration is not None:
+        params["LeaseDuration"] = lease_duration
+    # Queued callers only get the lock when their ticket reaches the head of the queue
+    if ticket is not None:
+        params["Ticket"] = ticket
+    # Semaphore locks are held with mode "semaphore", everything else is exclusive
+    if mode is not None:
+        params["Mode"] = mode
+    # Hierarchical locks mark every lock above them, as in repo for repo/main
+    if hierarchical:
+        params["Hierarchical"] = True
+    # A higher priority keeps lower priorities out until it gets the lock
+    if priority is not None:
+        params["Priority"] = priority
+    # Resending the same key after a timeout returns the first attempt's result
+    if idempotency_key is not None:
+        params["IdempotencyKey"] = idempotency_key
+    return params
+
+
+def release_params(
+    service_name,
+    lock_name,
+    job_id,
+    lock_table_name,
+    log_table_name,
+    lock_acquire_date_time=None,
+    fencing_token=None,
+    mode=None,
+    hierarchical=False,
+    idempotency_key=None,
+):
+    """Builds the body of a release request."""
+
+    params = {
+        "LockName": lock_name,
+        "ServiceName": service_name,
+        "JobId": job_id,
+        "LockTableName": lock_table_name,
+        "LogTableName": log_table_name,
+    }
+    # Passing the acquire time back lets the API release without reading the lock
+    if lock_acquire_date_time is not None:
+        params["LockAcquireDateTime"] = lock_acquire_date_time
+    # With a fencing token the release is refused once the lock has been taken over
+    if fencing_token is not None:
+        params["FencingToken"] = fencing_token
+    if mode is not None:
+        params["Mode"] = mode
+    if hierarchical:
+        params["Hierarchical"] = True
+    if idempotency_key is not None:
+        params["IdempotencyKey"] = idempotency_key
+    return params
+
+
+def renew_params(
+    service_name,
+    lock_name,
+    job_id,
+    lock_table_name,
+    lease_duration,
+    fencing_token=None,
+    mode=None,
+):
+    """Builds the body of a renew request."""
+
+    params = {
+        "LockName": lock_name,
+        "ServiceName": service_name,
+        "JobId": job_id,
+        "LockTableName": lock_table_name,
+        "LeaseDuration": lease_duration,
+    }
+    if fencing_token is not None:
+        params["FencingToken"] = fencing_token
+    # Shared holders renew their own lease, kept apart from the exclusive holder's
+    if mode is not None:
+        params["Mode"] = mode
+    return params
+
+
+## Acquire Lock
+def state_manager_acquire(
+    api_url,
+    service_name,
+    lock_name,
+    lock_table_name,
+    service_table_name,
+    lease_duration=None,
+    ticket=None,
+    mode=None,
+    hierarchical=False,
+    priority=None,
+    idempotency_key=None,
+):
+    url = urljoin(api_url, "acquire")
+    params = acquire_params(
+        service_name,
+        lock_name,
+        lock_table_name,
+        service_table_name,
+        lease_duration,
+        ticket,
+        mode,
+        hierarchical,
+        priority,
+        idempotency_key,
+    )
     response = requests.post(url=url, json=params)
 
     return response
 
 
-## Release Lock
-def state_manager_release(
-    api_url, service_name, lock_name, job_id, lock_table_name, log_table_name
+## Acquire Lock, waiting up to wait_timeout seconds for it to be released
+def state_manager_acquire_wait(
+    api_url,
+    service_name,
+    lock_name,
+    lock_table_name,
+    service_table_name,
+    wait_timeout,
+    lease_duration=None,
+    ticket=None,
+    mode=None,
+    hierarchical=False,
+    priority=None,
+    idempotency_key=None,
 ):
-    url = urljoin(api_url, "release")
+    url = urljoin(api_url, "acquire_wait")
+    params = acquire_params(
+        service_name,
+        lock_name,
+        lock_table_name,
+        service_table_name,
+        lease_duration,
+        ticket,
+        mode,
+        hierarchical,
+        priority,
+        idempotency_key,
+    )
+    params["WaitTimeout"] = wait_timeout
+    response = requests.post(url=url, json=params)
+
+    return response
+
+
+## Join a Lock's Queue
+def state_manager_enqueue(api_url, service_name, lock_name, lock_table_name):
+    url = urljoin(api_url, "enqueue")
     params = {
         "LockName": lock_name,
         "ServiceName": service_name,
-        "JobId": job_id,
         "LockTableName": lock_table_name,
-        "LogTableName": log_table_name,
     }
     response = requests.post(url=url, json=params)
 
     return response
+
+
+## Release Lock
+def state_manager_release(
+    api_url,
+    service_name,
+    lock_name,
+    job_id,
+    lock_table_name,
+    log_table_name,
+    lock_acquire_date_time=None,
+    fencing_token=None,
+    mode=None,
+    hierarchical=False,
+    idempotency_key=None,
+):
+    url = urljoin(api_url, "release")
+    params = release_params(
+        service_name,
+        lock_name,
+        job_id,
+        lock_table_name,
+        log_table_name,
+        lock_acquire_date_time,
+        fencing_token,
+        mode,
+        hierarchical,
+        idempotency_key,
+    )
+    response = requests.post(url=url, json=params)
+
+    return response
+
+
+## Renew Lock
+def state_manager_renew(
+    api_url,
+    service_name,
+    lock_name,
+    job_id,
+    lock_table_name,
+    lease_duration,
+    fencing_token=None,
+    mode=None,
+):
+    url = urljoin(api_url, "renew")
+    params = renew_params(
+        service_name,
+        lock_name,
+        job_id,
+        lock_table_name,
+        lease_duration,
+        fencing_token,
+        mode,
+    )
+    response = requests.post(url=url, json=params)
+
+    return response
+
+
+class LockClientError(Exception):
+    """Raised when the lock API turns down a request, with the last response it gave."""
+
+    def __init__(self, message, response):
+        super().__init__(message)
+        self.response = response
+
+
+class LockNotAcquiredError(LockClientError):
+    """Raised when the lock API doesn't hand over a lock, usually because it is held."""
+
+
+def failed_to_connect(error):
+    """Checks if a requests error was raised before the request was sent to the API."""
+
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(
+        reason, NewConnectionError
+    )
+
+
+class BaseLockClient:
+    """Settings and request bodies shared by LockClient and AsyncLockClient.
+
+    Requests time out after timeout seconds, given as a number or as a (connect, read)
+    pair as requests takes it. Failures are retried up to max_attempts times with
+    jittered exponential backoff. Exclusive acquires and releases carry an idempotency
+    key, so a retry of a request that went through is answered with the original
+    result, and they are retried after any connection error or 5xx response. Other
+    requests may have gone through when those happen, so they are only retried when
+    the connection couldn't be made. 409s from acquires are always retried. With
+    compact_responses, the ResponseMetadata the API returns holds only the fields
+    Sling sets.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        service_name,
+        lock_table_name,
+        service_table_name,
+        log_table_name,
+        timeout=DEFAULT_TIMEOUT,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        backoff_base=DEFAULT_BACKOFF_BASE,
+        backoff_cap=DEFAULT_BACKOFF_CAP,
+        compact_responses=False,
+    ):
+        self.api_url = api_url
+        self.service_name = service_name
+        self.lock_table_name = lock_table_name
+        self.service_table_name = service_table_name
+        self.log_table_name = log_table_name
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        # Compact responses leave out the DynamoDB metadata the clients never read
+        self.headers = (
+            {RESPONSE_FORMAT_HEADER: "compact"} if compact_responses else {}
+        )
+
+    def backoff(self, attempt):
+        """Returns the seconds to sleep before retry number attempt, with full jitter."""
+
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def timeouts(self, extra_read_timeout=0):
+        """Returns the (connect, read) timeouts for a request."""
+
+        connect_timeout, read_timeout = (
+            self.timeout if isinstance(self.timeout, tuple) else (self.timeout,) * 2
+        )
+        # The API holds waiting requests open, so the read timeout has to outlast it
+        return connect_timeout, read_timeout + extra_read_timeout
+
+    @staticmethod
+    def retryable(status_code, retry_conflicts, idempotent=True):
+        # A 409 from an acquire means nothing changed, a 5xx may come after a change
+        return (idempotent and status_code >= 500) or (
+            retry_conflicts and status_code == 409
+        )
+
+    @staticmethod
+    def idempotency_key(mode):
+        # The API only keeps idempotency keys for exclusive holders
+        return str(uuid.uuid4()) if mode in (None, "exclusive") else None
+
+    @staticmethod
+    def check(response, message, error_class=LockClientError):
+        if response.status_code != 200:
+            raise error_class(message, response)
+        return response.json()["ResponseMetadata"]
+
+    def acquire_request(
+        self,
+        lock_name,
+        lease_duration=None,
+        wait_timeout=None,
+        ticket=None,
+        mode=None,
+        hierarchical=False,
+        priority=None,
+    ):
+        """Returns the route, body and post options of an acquire."""
+
+        idempotency_key = self.idempotency_key(mode)
+        params = acquire_params(
+            self.service_name,
+            lock_name,
+            self.lock_table_name,
+            self.service_table_name,
+            lease_duration,
+            ticket,
+            mode,
+            hierarchical,
+            priority,
+            idempotency_key,
+        )
+        options = {"retry_conflicts": True, "idempotent": idempotency_key is not None}
+        if wait_timeout is None:
+            return "acquire", params, options
+        params["WaitTimeout"] = wait_timeout
+        return "acquire_wait", params, dict(options, extra_read_timeout=wait_timeout)
+
+    def release_request(self, lock_name, acquired, mode=None, hierarchical=False):
+        """Returns the route, body and post options of a release."""
+
+        idempotency_key = self.idempotency_key(mode)
+        params = release_params(
+            self.service_name,
+            lock_name,
+            acquired["JobId"],
+            self.lock_table_name,
+            self.log_table_name,
+            acquired.get("LockAcquireDateTime"),
+            acquired.get("FencingToken"),
+            mode,
+            hierarchical,
+            idempotency_key,
+        )
+        return "release", params, {"idempotent": idempotency_key is not None}
+
+    def renew_request(self, lock_name, acquired, lease_duration, mode=None):
+        """Returns the route, body and post options of a renew."""
+
+        params = renew_params(
+            self.service_name,
+            lock_name,
+            acquired["JobId"],
+            self.lock_table_name,
+            lease_duration,
+            acquired.get("FencingToken"),
+            mode,
+        )
+        return "renew", params, {}
+
+
+class LockClient(BaseLockClient):
+    """Acquires and releases locks for one service over a kept-alive session.
+
+        client = LockClient(api_url, "PRMBot", "SlingLockTable",
+                            "SlingRegisteredServices", "SlingLogTable")
+        with client.lock("MyLock", lease_duration=900) as acquired:
+            ...
+    """
+
+    def __init__(self, *args, session=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = session or requests.Session()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def post(
+        self, route, params, retry_conflicts=False, extra_read_timeout=0, idempotent=True
+    ):
+        """Posts params to route, retrying failures that may pass on another attempt.
+
+        Requests that aren't idempotent are only sent again if they never reached the API.
+        """
+
+        url = urljoin(self.api_url, route)
+        timeout = self.timeouts(extra_read_timeout)
+        for attempt in range(self.max_attempts):
+            last_attempt = attempt == self.max_attempts - 1
+            try:
+                response = self.session.post(
+                    url=url, json=params, headers=self.headers, timeout=timeout
+                )
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                if last_attempt or not (idempotent or failed_to_connect(e)):
+                    raise
+            else:
+                retryable = self.retryable(
+                    response.status_code, retry_conflicts, idempotent
+                )
+                if not retryable or last_attempt:
+                    return response
+            time.sleep(self.backoff(attempt))
+
+    def acquire(self, lock_name, **acquire_options):
+        """Acquires lock_name, returning the ResponseMetadata a release needs.
+
+        Takes the lease_duration, wait_timeout, ticket, mode, hierarchical and priority
+        options of the API. With wait_timeout, the API waits up to that many seconds
+        for the lock on each attempt. Raises LockNotAcquiredError if the lock couldn't
+        be acquired.
+        """
+
+        route, params, options = self.acquire_request(lock_name, **acquire_options)
+        return self.check(
+            self.post(route, params, **options),
+            "Unable to acquire lock: %s" % lock_name,
+            LockNotAcquiredError,
+        )
+
+    def release(self, lock_name, acquired, mode=None, hierarchical=False):
+        """Releases lock_name, given the ResponseMetadata acquire returned for it.
+
+        Raises LockClientError if the lock couldn't be released.
+        """
+
+        route, params, options = self.release_request(
+            lock_name, acquired, mode, hierarchical
+        )
+        return self.check(
+            self.post(route, params, **options), "Unable to release lock: %s" % lock_name
+        )
+
+    def renew(self, lock_name, acquired, lease_duration, mode=None):
+        """Extends the lease on lock_name, given the ResponseMetadata acquire returned."""
+
+        route, params, options = self.renew_request(
+            lock_name, acquired, lease_duration, mode
+        )
+        return self.check(
+            self.post(route, params, **options), "Unable to renew lock: %s" % lock_name
+        )
+
+    @contextmanager
+    def lock(self, lock_name, mode=None, hierarchical=False, **acquire_options):
+        """Holds lock_name for the body of a with statement, releasing it however it exits."""
+
+        acquired = self.acquire(
+            lock_name, mode=mode, hierarchical=hierarchical, **acquire_options
+        )
+        try:
+            yield acquired
+        finally:
+            self.release(lock_name, acquired, mode=mode, hierarchical=hierarchical)
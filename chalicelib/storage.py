@@ -0,0 +1,1101 @@
+"""Storage backends for the lock API.
+
+The lock API talks to its tables through the DynamoDB client calls it needs:
+transact_write_items, transact_get_items, update_item, get_item and batch_get_item,
+along with a few table and item calls used to set tables up. The local backends in this module answer
+those calls on the machine the API runs on. They evaluate the same condition and
+update expressions, so holders, queues, semaphores and intentions behave as they
+do on DynamoDB, and they fail with the same ClientErrors the routes already handle.
+
+The backends sit behind the DynamoDB client API, rather than an interface of lock
+operations, because DynamoDB is what the API runs on in production: each route's
+conditions are written once, against the store that has to enforce them, and the
+local backends are checked against those same routes by the tests that drive the
+API through them. An interface of lock operations would instead need every
+operation written once per backend, and DynamoDB's version would still be these
+expressions.
+
+The local backends only support the part of DynamoDB the routes use. Expressions
+may use comparisons, BETWEEN, IN, AND, OR and NOT, the attribute_exists,
+attribute_not_exists, begins_with, contains and size functions, and SET (with +,
+-, if_not_exists and list_append), REMOVE, ADD and DELETE. attribute_type, Query,
+Scan, indexes, ReturnValues other than NONE, ALL_OLD, ALL_NEW and UPDATED_NEW, and
+expression size limits aren't supported. An expression that uses them fails with a
+ValidationException naming what isn't supported, so a change to the routes that
+relies on them fails its local backend tests until this module is extended too.
+"""
+
+import abc
+import copy
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from decimal import Decimal, localcontext
+
+import boto3
+
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+logger = logging.getLogger(__name__)
+
+
+DYNAMODB_BACKEND = "dynamodb"
+MEMORY_BACKEND = "memory"
+SQLITE_BACKEND = "sqlite"
+STORAGE_BACKENDS = (DYNAMODB_BACKEND, MEMORY_BACKEND, SQLITE_BACKEND)
+
+# Environmental Variables
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", DYNAMODB_BACKEND)
+SQLITE_DATABASE = os.environ.get("SQLITE_DATABASE", "sling.db")
+
+# DynamoDB rejects transactions that touch more items than this
+MAX_TRANSACTION_ITEMS = 100
+
+# DynamoDB numbers carry up to 38 significant digits
+NUMBER_PRECISION = 38
+
+SET_TYPES = ("SS", "NS", "BS")
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "settings", "config.json")
+
+# Used for whatever the dynamodb_client section of the config leaves out. Lock
+# requests are small, so a stalled connection is given up on quickly and retried.
+DYNAMODB_CLIENT_DEFAULTS = {
+    "retry_mode": "adaptive",
+    "max_attempts": 3,
+    "connect_timeout": 1,
+    "read_timeout": 3,
+    "max_pool_connections": 50,
+    "tcp_keepalive": True,
+    "warm_up": False,
+}
+
+
+def get_config(config_path=CONFIG_PATH):
+    """Returns the config at config_path, or an empty one if there is no such file."""
+
+    try:
+        with open(config_path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.debug("File path: %s does not exist", config_path)
+        return {}
+
+
+def dynamodb_client_config(settings):
+    """Builds the botocore Config for the DynamoDB client from dynamodb_client settings.
+
+    Options the installed botocore doesn't know, such as tcp_keepalive before 1.27,
+    are left out.
+    """
+
+    settings = dict(DYNAMODB_CLIENT_DEFAULTS, **settings)
+    options = {
+        "retries": {
+            "mode": settings["retry_mode"],
+            "max_attempts": settings["max_attempts"],
+        },
+        "connect_timeout": settings["connect_timeout"],
+        "read_timeout": settings["read_timeout"],
+        "max_pool_connections": settings["max_pool_connections"],
+        "tcp_keepalive": settings["tcp_keepalive"],
+    }
+    return Config(
+        **{
+            option: value
+            for option, value in options.items()
+            if option in Config.OPTION_DEFAULTS
+        }
+    )
+
+
+def warm_up(client, table_name):
+    """Opens the client's first connection to DynamoDB before any request needs it.
+
+    Any response, even an error, leaves a connection in the pool, so errors are only logged.
+    """
+
+    try:
+        client.describe_table(TableName=table_name)
+    except (BotoCoreError, ClientError) as e:
+        logger.debug(str(e))
+
+
+def get_client(backend=None, sqlite_database=None, config=None):
+    """Returns a client for backend, which defaults to the STORAGE_BACKEND setting.
+
+    A DynamoDB client is tuned by the dynamodb_client section of config, which
+    defaults to chalicelib/settings/config.json. It is only warmed up inside Lambda,
+    so importing the API elsewhere, as tests and tools do, never waits on the network.
+    """
+
+    backend = backend or STORAGE_BACKEND
+    if backend == DYNAMODB_BACKEND:
+        config = get_config() if config is None else config
+        settings = config.get("dynamodb_client", {})
+        client = boto3.client("dynamodb", config=dynamodb_client_config(settings))
+        if (
+            settings.get("warm_up")
+            and "lock_table_name" in config
+            and "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+        ):
+            warm_up(client, config["lock_table_name"])
+        return client
+    if backend == MEMORY_BACKEND:
+        return MemoryClient()
+    if backend == SQLITE_BACKEND:
+        return SQLiteClient(sqlite_database or SQLITE_DATABASE)
+    raise ValueError(
+        "Storage backend must be one of the following: %s" % (STORAGE_BACKENDS,)
+    )
+
+
+def create_tables(client, lock_table_name, service_table_name, log_table_name):
+    """Creates whichever of Sling's tables don't exist yet, keyed as in the CDK stack."""
+
+    existing_tables = client.list_tables()["TableNames"]
+    for table_name, key_name in [
+        (lock_table_name, "LockName"),
+        (service_table_name, "ServiceName"),
+        (log_table_name, "JobId"),
+    ]:
+        if table_name not in existing_tables:
+            client.create_table(
+                TableName=table_name,
+                AttributeDefinitions=[{"AttributeName": key_name, "AttributeType": "S"}],
+                KeySchema=[{"AttributeName": key_name, "KeyType": "HASH"}],
+                BillingMode="PAY_PER_REQUEST",
+            )
+
+
+def client_error(code, message, operation_name, **extra):
+    """Builds the ClientError botocore would raise for a failed DynamoDB call."""
+
+    error_response = {"Error": {"Code": code, "Message": message}}
+    error_response.update(extra)
+    return ClientError(error_response, operation_name)
+
+
+class ExpressionError(Exception):
+    """Raised when an expression can't be parsed or refers to an unknown placeholder."""
+
+
+class UpdateError(Exception):
+    """Raised when an update can't be applied to the item it targets."""
+
+
+## Expressions
+TOKEN_RE = re.compile(
+    r"\s*(?:(<>|<=|>=|=|<|>|\(|\)|,|\.|\[|\]|\+|-)|([:#]?[A-Za-z0-9_]+))"
+)
+COMPARATORS = ("=", "<>", "<", "<=", ">", ">=")
+UPDATE_CLAUSES = ("SET", "REMOVE", "ADD", "DELETE")
+
+
+def tokenize(expression):
+    """Splits an expression into operators, names, placeholders and list indexes."""
+
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if match is None:
+            raise ExpressionError("Invalid expression: %s" % expression)
+        tokens.append(match.group(1) or match.group(2))
+        position = match.end()
+    return tokens
+
+
+def to_number(attribute_value):
+    return Decimal(attribute_value["N"])
+
+
+def from_number(number):
+    """Formats a Decimal the way DynamoDB returns numbers, as in 100 rather than 1E+2."""
+
+    with localcontext() as context:
+        context.prec = NUMBER_PRECISION
+        number = number.normalize()
+    return "{:f}".format(number)
+
+
+def values_equal(left, right):
+    (left_type, left_value), = left.items()
+    (right_type, right_value), = right.items()
+    if left_type != right_type:
+        return False
+    if left_type == "N":
+        return Decimal(left_value) == Decimal(right_value)
+    if left_type == "NS":
+        return {Decimal(v) for v in left_value} == {Decimal(v) for v in right_value}
+    if left_type in SET_TYPES:
+        return set(left_value) == set(right_value)
+    return left_value == right_value
+
+
+def compare(comparator, left, right):
+    """Compares two attribute values. Comparisons involving a missing value are false."""
+
+    if left is None or right is None:
+        return False
+    if comparator == "=":
+        return values_equal(left, right)
+    if comparator == "<>":
+        return not values_equal(left, right)
+
+    (left_type, left_value), = left.items()
+    (right_type, right_value), = right.items()
+    if left_type != right_type or left_type not in ("N", "S", "B"):
+        return False
+    if left_type == "N":
+        left_value, right_value = Decimal(left_value), Decimal(right_value)
+    if comparator == "<":
+        return left_value < right_value
+    if comparator == "<=":
+        return left_value <= right_value
+    if comparator == ">":
+        return left_value > right_value
+    return left_value >= right_value
+
+
+def resolve(item, path):
+    """Returns the attribute value at path inside item, or None if there isn't one."""
+
+    value = {"M": item}
+    for element in path:
+        if isinstance(element, int):
+            if "L" not in value or element >= len(value["L"]):
+                return None
+            value = value["L"][element]
+        else:
+            if "M" not in value or element not in value["M"]:
+                return None
+            value = value["M"][element]
+    return value
+
+
+def parent_container(item, path):
+    """Returns the map or list that holds the last element of path."""
+
+    container = resolve(item, path[:-1]) if len(path) > 1 else {"M": item}
+    if container is None:
+        raise UpdateError(
+            "The document path provided in the update expression is invalid for update"
+        )
+    if isinstance(path[-1], int):
+        if "L" not in container:
+            raise UpdateError("Only lists can be indexed by position")
+        return container["L"]
+    if "M" not in container:
+        raise UpdateError("Only maps can contain named attributes")
+    return container["M"]
+
+
+def set_path(item, path, value):
+    container = parent_container(item, path)
+    if isinstance(path[-1], int) and path[-1] >= len(container):
+        container.append(value)
+    else:
+        container[path[-1]] = value
+
+
+def remove_path(item, path):
+    container = parent_container(item, path)
+    if isinstance(path[-1], int):
+        if path[-1] < len(container):
+            del container[path[-1]]
+    else:
+        container.pop(path[-1], None)
+
+
+def set_values(attribute_value):
+    """Returns the type and the elements of a set attribute value."""
+
+    (value_type, values), = attribute_value.items()
+    if value_type not in SET_TYPES:
+        raise UpdateError("ADD and DELETE only accept numbers and sets")
+    return value_type, values
+
+
+class ExpressionParser:
+    """Parses condition and update expressions into functions of an item.
+
+    Attribute names and values are looked up in the request's ExpressionAttributeNames
+    and ExpressionAttributeValues as they are parsed.
+    """
+
+    def __init__(self, expression, attribute_names=None, attribute_values=None):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+        self.attribute_names = attribute_names or {}
+        self.attribute_values = attribute_values or {}
+
+    def peek(self, offset=0):
+        position = self.position + offset
+        return self.tokens[position] if position < len(self.tokens) else None
+
+    def peek_keyword(self):
+        token = self.peek()
+        return token.upper() if token is not None else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (
+            expected is not None and token.upper() != expected.upper()
+        ):
+            raise ExpressionError(
+                "Invalid expression, expected %s: %s" % (expected, self.expression)
+            )
+        self.position += 1
+        return token
+
+    def done(self):
+        if self.position != len(self.tokens):
+            raise ExpressionError(
+                "Invalid expression, unexpected %s: %s"
+                % (self.peek(), self.expression)
+            )
+
+    ## Conditions
+    def parse_condition(self):
+        condition = self.condition()
+        self.done()
+        return condition
+
+    def condition(self):
+        left = self.conjunction()
+        while self.peek_keyword() == "OR":
+            self.take()
+            right = self.conjunction()
+            left = (lambda l, r: lambda item: l(item) or r(item))(left, right)
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.peek_keyword() == "AND":
+            self.take()
+            right = self.negation()
+            left = (lambda l, r: lambda item: l(item) and r(item))(left, right)
+        return left
+
+    def negation(self):
+        if self.peek_keyword() == "NOT":
+            self.take()
+            condition = self.negation()
+            return lambda item: not condition(item)
+        return self.comparison()
+
+    def comparison(self):
+        if self.peek() == "(":
+            self.take("(")
+            condition = self.condition()
+            self.take(")")
+            return condition
+
+        function_name = self.peek().lower() if self.peek() else None
+        if self.peek(1) == "(" and function_name in (
+            "attribute_exists",
+            "attribute_not_exists",
+            "begins_with",
+            "contains",
+        ):
+            return self.condition_function()
+
+        left = self.operand()
+        keyword = self.peek_keyword()
+        if keyword in COMPARATORS:
+            comparator = self.take()
+            right = self.operand()
+            return lambda item: compare(comparator, left(item), right(item))
+        if keyword == "BETWEEN":
+            self.take()
+            low = self.operand()
+            self.take("AND")
+            high = self.operand()
+            return lambda item: compare(">=", left(item), low(item)) and compare(
+                "<=", left(item), high(item)
+            )
+        if keyword == "IN":
+            self.take()
+            self.take("(")
+            candidates = [self.operand()]
+            while self.peek() == ",":
+                self.take(",")
+                candidates.append(self.operand())
+            self.take(")")
+            return lambda item: any(
+                compare("=", left(item), candidate(item)) for candidate in candidates
+            )
+        raise ExpressionError("Invalid condition: %s" % self.expression)
+
+    def condition_function(self):
+        function_name = self.take().lower()
+        self.take("(")
+        path = self.path()
+        if function_name in ("attribute_exists", "attribute_not_exists"):
+            self.take(")")
+            exists = function_name == "attribute_exists"
+            return lambda item: (resolve(item, path) is not None) == exists
+
+        self.take(",")
+        operand = self.operand()
+        self.take(")")
+        if function_name == "begins_with":
+
+            def begins_with(item):
+                value, prefix = resolve(item, path), operand(item)
+                if value is None or prefix is None:
+                    return False
+                (value_type, value), = value.items()
+                (prefix_type, prefix), = prefix.items()
+                return (
+                    value_type == prefix_type
+                    and value_type in ("S", "B")
+                    and value.startswith(prefix)
+                )
+
+            return begins_with
+
+        def contains(item):
+            value, element = resolve(item, path), operand(item)
+            if value is None or element is None:
+                return False
+            (value_type, values), = value.items()
+            (element_type, element_value), = element.items()
+            if value_type in ("S", "B"):
+                return element_type == value_type and element_value in values
+            if value_type in SET_TYPES:
+                return value_type == element_type + "S" and any(
+                    values_equal({element_type: v}, element) for v in values
+                )
+            if value_type == "L":
+                return any(values_equal(v, element) for v in values)
+            return False
+
+        return contains
+
+    ## Operands
+    def operand(self):
+        token = self.peek()
+        if token is None:
+            raise ExpressionError("Invalid expression: %s" % self.expression)
+        if token.startswith(":"):
+            return self.value()
+        if token.lower() == "size" and self.peek(1) == "(":
+            self.take()
+            self.take("(")
+            path = self.path()
+            self.take(")")
+
+            def size(item):
+                value = resolve(item, path)
+                if value is None:
+                    return None
+                (value_type, values), = value.items()
+                if value_type in ("N", "BOOL", "NULL"):
+                    return None
+                return {"N": str(len(values))}
+
+            return size
+        path = self.path()
+        return lambda item: resolve(item, path)
+
+    def value(self):
+        placeholder = self.take()
+        if placeholder not in self.attribute_values:
+            raise ExpressionError(
+                "An expression attribute value used in expression is not defined: %s"
+                % placeholder
+            )
+        value = self.attribute_values[placeholder]
+        return lambda item: value
+
+    def name(self):
+        token = self.take()
+        if token.startswith(":"):
+            raise ExpressionError("Invalid attribute name: %s" % self.expression)
+        if token.startswith("#"):
+            if token not in self.attribute_names:
+                raise ExpressionError(
+                    "An expression attribute name used in the document path is not defined: %s"
+                    % token
+                )
+            return self.attribute_names[token]
+        return token
+
+    def path(self):
+        path = [self.name()]
+        while self.peek() in (".", "["):
+            if self.take() == ".":
+                path.append(self.name())
+            else:
+                index = self.take()
+                if not index.isdigit():
+                    raise ExpressionError("Invalid list index: %s" % self.expression)
+                path.append(int(index))
+                self.take("]")
+        return path
+
+    ## Updates
+    def parse_update(self):
+        """Returns a function that applies the update to a copy of an item and returns it."""
+
+        actions = []
+        seen_clauses = set()
+        while self.peek() is not None:
+            clause = self.take().upper()
+            if clause not in UPDATE_CLAUSES or clause in seen_clauses:
+                raise ExpressionError("Invalid update expression: %s" % self.expression)
+            seen_clauses.add(clause)
+            while True:
+                actions.append((clause, self.update_action(clause)))
+                if self.peek() != ",":
+                    break
+                self.take(",")
+        if not actions:
+            raise ExpressionError("Invalid update expression: %s" % self.expression)
+
+        clause_order = {clause: index for index, clause in enumerate(UPDATE_CLAUSES)}
+        actions.sort(key=lambda action: clause_order[action[0]])
+
+        def update(item):
+            # Every right-hand side sees the item as it was before the update
+            new_item = copy.deepcopy(item)
+            for clause, (path, operand) in actions:
+                value = operand(item) if operand is not None else None
+                if clause == "SET":
+                    set_path(new_item, path, value)
+                elif clause == "REMOVE":
+                    remove_path(new_item, path)
+                elif clause == "ADD":
+                    add_value(new_item, path, value)
+                else:
+                    delete_value(new_item, path, value)
+            return new_item
+
+        return update
+
+    def update_action(self, clause):
+        path = self.path()
+        if clause == "SET":
+            self.take("=")
+            return path, self.set_value()
+        if clause == "REMOVE":
+            return path, None
+        return path, self.value()
+
+    def set_value(self):
+        left = self.set_operand()
+        if self.peek() not in ("+", "-"):
+            return self.required(left)
+        operator = self.take()
+        right = self.set_operand()
+
+        def arithmetic(item):
+            left_value, right_value = self.required(left)(item), self.required(right)(
+                item
+            )
+            if "N" not in left_value or "N" not in right_value:
+                raise UpdateError(
+                    "An operand in the update expression has an incorrect data type"
+                )
+            with localcontext() as context:
+                context.prec = NUMBER_PRECISION
+                if operator == "+":
+                    result = to_number(left_value) + to_number(right_value)
+                else:
+                    result = to_number(left_value) - to_number(right_value)
+            return {"N": from_number(result)}
+
+        return arithmetic
+
+    def set_operand(self):
+        function_name = self.peek().lower() if self.peek() else None
+        if function_name == "if_not_exists" and self.peek(1) == "(":
+            self.take()
+            self.take("(")
+            path = self.path()
+            self.take(",")
+            default = self.set_operand()
+            self.take(")")
+
+            def if_not_exists(item):
+                value = resolve(item, path)
+                return value if value is not None else default(item)
+
+            return if_not_exists
+        if function_name == "list_append" and self.peek(1) == "(":
+            self.take()
+            self.take("(")
+            first = self.set_operand()
+            self.take(",")
+            second = self.set_operand()
+            self.take(")")
+
+            def list_append(item):
+                first_value = self.required(first)(item)
+                second_value = self.required(second)(item)
+                if "L" not in first_value or "L" not in second_value:
+                    raise UpdateError("list_append only accepts lists")
+                return {"L": first_value["L"] + second_value["L"]}
+
+            return list_append
+        return self.operand()
+
+    @staticmethod
+    def required(operand):
+        def value(item):
+            attribute_value = operand(item)
+            if attribute_value is None:
+                raise UpdateError(
+                    "The provided expression refers to an attribute that does not exist in the item"
+                )
+            return copy.deepcopy(attribute_value)
+
+        return value
+
+
+def add_value(item, path, value):
+    current = resolve(item, path)
+    if "N" in value:
+        if current is not None and "N" not in current:
+            raise UpdateError("ADD can only add a number to a number")
+        with localcontext() as context:
+            context.prec = NUMBER_PRECISION
+            total = to_number(value) + (to_number(current) if current else 0)
+        set_path(item, path, {"N": from_number(total)})
+        return
+
+    value_type, values = set_values(value)
+    if current is None:
+        set_path(item, path, {value_type: list(dict.fromkeys(values))})
+        return
+    current_type, current_values = set_values(current)
+    if current_type != value_type:
+        raise UpdateError("ADD can only add to a set of the same type")
+    set_path(item, path, {value_type: list(dict.fromkeys(current_values + values))})
+
+
+def delete_value(item, path, value):
+    current = resolve(item, path)
+    value_type, values = set_values(value)
+    if current is None:
+        return
+    current_type, current_values = set_values(current)
+    if current_type != value_type:
+        raise UpdateError("DELETE can only remove from a set of the same type")
+    remaining = [v for v in current_values if v not in values]
+    # DynamoDB has no empty sets, so removing the last element removes the attribute
+    if remaining:
+        set_path(item, path, {value_type: remaining})
+    else:
+        remove_path(item, path)
+
+
+def condition_passes(request, item):
+    """Evaluates the ConditionExpression of a request against item, which may be empty."""
+
+    if "ConditionExpression" not in request:
+        return True
+    return ExpressionParser(
+        request["ConditionExpression"],
+        request.get("ExpressionAttributeNames"),
+        request.get("ExpressionAttributeValues"),
+    ).parse_condition()(item)
+
+
+def updated_item(request, item, key):
+    """Returns item, or a new item holding key if there is none, with the update applied."""
+
+    update = ExpressionParser(
+        request["UpdateExpression"],
+        request.get("ExpressionAttributeNames"),
+        request.get("ExpressionAttributeValues"),
+    ).parse_update()
+    return update(item if item is not None else copy.deepcopy(key))
+
+
+## Clients
+def response_metadata():
+    return {"ResponseMetadata": {"HTTPStatusCode": 200, "RetryAttempts": 0}}
+
+
+class LocalClient(abc.ABC):
+    """Answers Sling's DynamoDB client calls from tables stored on this machine.
+
+    Subclasses provide transaction(), a context manager that yields a LocalTables
+    view of the storage. Everything written through the view is committed together
+    and no other transaction sees the tables change while it is open. Calls that
+    only read open it with write=False, so backends can let them run alongside writes.
+    """
+
+    @abc.abstractmethod
+    def transaction(self, write=True):
+        """Returns a context manager that yields a LocalTables view of the storage."""
+
+    def create_table(self, TableName, KeySchema, **kwargs):
+        key_names = [key["AttributeName"] for key in KeySchema]
+        with self.transaction() as tables:
+            if TableName in tables.table_names():
+                raise client_error(
+                    "ResourceInUseException",
+                    "Table already exists: %s" % TableName,
+                    "CreateTable",
+                )
+            tables.create_table(TableName, key_names)
+        response = response_metadata()
+        response["TableDescription"] = {
+            "TableName": TableName,
+            "KeySchema": KeySchema,
+            "TableStatus": "ACTIVE",
+        }
+        return response
+
+    def list_tables(self, **kwargs):
+        with self.transaction(write=False) as tables:
+            table_names = sorted(tables.table_names())
+        response = response_metadata()
+        response["TableNames"] = table_names
+        return response
+
+    def get_item(self, TableName, Key, **kwargs):
+        return self.call("GetItem", self.read_item, TableName, Key)
+
+    def put_item(self, TableName, Item, **kwargs):
+        request = dict(kwargs, TableName=TableName, Item=Item)
+        return self.call("PutItem", self.write_item, "Put", request)
+
+    def delete_item(self, TableName, Key, **kwargs):
+        request = dict(kwargs, TableName=TableName, Key=Key)
+        return self.call("DeleteItem", self.write_item, "Delete", request)
+
+    def update_item(self, TableName, Key, **kwargs):
+        request = dict(kwargs, TableName=TableName, Key=Key)
+        return self.call("UpdateItem", self.write_item, "Update", request)
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        return self.call("BatchGetItem", self.read_batch, RequestItems)
+
+    def transact_get_items(self, TransactItems, **kwargs):
+        return self.call("TransactGetItems", self.read_items, TransactItems)
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        return self.call("TransactWriteItems", self.write_items, TransactItems)
+
+    def call(self, operation_name, method, *args):
+        """Runs method, turning expression mistakes into the ValidationException DynamoDB raises."""
+
+        try:
+            return method(*args)
+        except (ExpressionError, UpdateError, KeyError, ValueError) as e:
+            raise client_error("ValidationException", str(e), operation_name)
+
+    def read_item(self, table_name, key):
+        with self.transaction(write=False) as tables:
+            item = tables.get(table_name, key)
+        response = response_metadata()
+        if item is not None:
+            response["Item"] = item
+        return response
+
+    def read_batch(self, request_items):
+        responses = {}
+        with self.transaction(write=False) as tables:
+            for table_name, request in request_items.items():
+                items = [tables.get(table_name, key) for key in request["Keys"]]
+                responses[table_name] = [item for item in items if item is not None]
+        response = response_metadata()
+        response["Responses"] = responses
+        response["UnprocessedKeys"] = {}
+        return response
+
+    def read_items(self, transact_items):
+        responses = []
+        with self.transaction(write=False) as tables:
+            for transact_item in transact_items:
+                request = transact_item["Get"]
+                item = tables.get(request["TableName"], request["Key"])
+                responses.append({"Item": item} if item is not None else {})
+        response = response_metadata()
+        response["Responses"] = responses
+        return response
+
+    def write_item(self, operation, request):
+        return_values = request.get("ReturnValues", "NONE")
+        if return_values not in ("NONE", "ALL_OLD", "ALL_NEW", "UPDATED_NEW"):
+            raise ValueError("Unsupported ReturnValues: %s" % return_values)
+
+        with self.transaction() as tables:
+            key = tables.key(request["TableName"], request.get("Key") or request["Item"])
+            old_item = tables.get(request["TableName"], key)
+            if not condition_passes(request, old_item or {}):
+                raise client_error(
+                    "ConditionalCheckFailedException",
+                    "The conditional request failed",
+                    operation + "Item",
+                )
+            new_item = self.new_item(operation, request, old_item, key)
+            tables.write(request["TableName"], key, new_item)
+
+        response = response_metadata()
+        returned_item = old_item if return_values == "ALL_OLD" else new_item
+        if return_values == "UPDATED_NEW" and new_item is not None:
+            # The attributes the update changed, whole rather than just their changed paths
+            returned_item = {
+                name: value
+                for name, value in new_item.items()
+                if (old_item or {}).get(name) != value
+            }
+        if return_values != "NONE" and returned_item is not None:
+            response["Attributes"] = returned_item
+        return response
+
+    def write_items(self, transact_items):
+        if not 0 < len(transact_items) <= MAX_TRANSACTION_ITEMS:
+            raise ValueError(
+                "Member must have length less than or equal to %s"
+                % MAX_TRANSACTION_ITEMS
+            )
+
+        with self.transaction() as tables:
+            writes = []
+            reasons = []
+            seen_keys = set()
+            for transact_item in transact_items:
+                (operation, request), = transact_item.items()
+                table_name = request["TableName"]
+                key = tables.key(table_name, request.get("Key") or request["Item"])
+                item_key = (table_name, json.dumps(key, sort_keys=True))
+                if item_key in seen_keys:
+                    raise ValueError(
+                        "Transaction request cannot include multiple operations on one item"
+                    )
+                seen_keys.add(item_key)
+
+                old_item = tables.get(table_name, key)
+                if not condition_passes(request, old_item or {}):
+                    reason = {
+                        "Code": "ConditionalCheckFailed",
+                        "Message": "The conditional request failed",
+                    }
+                    return_values = request.get(
+                        "ReturnValuesOnConditionCheckFailure", "NONE"
+                    )
+                    if return_values == "ALL_OLD" and old_item is not None:
+                        reason["Item"] = copy.deepcopy(old_item)
+                    reasons.append(reason)
+                    continue
+                if operation == "ConditionCheck":
+                    reasons.append({"Code": "None"})
+                    continue
+                try:
+                    new_item = self.new_item(operation, request, old_item, key)
+                except UpdateError as e:
+                    reasons.append({"Code": "ValidationError", "Message": str(e)})
+                    continue
+                reasons.append({"Code": "None"})
+                writes.append((table_name, key, new_item))
+
+            if any(reason["Code"] != "None" for reason in reasons):
+                raise client_error(
+                    "TransactionCanceledException",
+                    "Transaction cancelled, please refer cancellation reasons for specific reasons [%s]"
+                    % ", ".join(reason["Code"] for reason in reasons),
+                    "TransactWriteItems",
+                    CancellationReasons=reasons,
+                )
+            for table_name, key, new_item in writes:
+                tables.write(table_name, key, new_item)
+
+        return response_metadata()
+
+    @staticmethod
+    def new_item(operation, request, old_item, key):
+        """Returns the item an operation leaves behind, or None if it deletes it."""
+
+        if operation == "Put":
+            return copy.deepcopy(request["Item"])
+        if operation == "Delete":
+            return None
+        if operation == "Update":
+            return updated_item(request, old_item, key)
+        raise ValueError("Unsupported transaction operation: %s" % operation)
+
+
+class LocalTables(abc.ABC):
+    """The view of a local backend's tables a LocalClient works with in a transaction."""
+
+    @abc.abstractmethod
+    def table_names(self):
+        """Returns the names of every table."""
+
+    @abc.abstractmethod
+    def create_table(self, table_name, key_names):
+        """Creates an empty table keyed by the attributes in key_names."""
+
+    @abc.abstractmethod
+    def key_names(self, table_name):
+        """Returns the key attribute names of a table, or None if it doesn't exist."""
+
+    @abc.abstractmethod
+    def load(self, table_name, item_key):
+        """Returns the item stored under item_key, or None if there isn't one."""
+
+    @abc.abstractmethod
+    def store(self, table_name, item_key, item):
+        """Stores item under item_key, or deletes the stored item if item is None."""
+
+    def key(self, table_name, key_or_item):
+        """Returns the key attributes of key_or_item, which must hold all of them."""
+
+        key_names = self.key_names(table_name)
+        if key_names is None:
+            raise client_error(
+                "ResourceNotFoundException",
+                "Requested resource not found: %s" % table_name,
+                "DescribeTable",
+            )
+        if any(key_name not in key_or_item for key_name in key_names):
+            raise ValueError("The provided key element does not match the schema")
+        return {key_name: key_or_item[key_name] for key_name in key_names}
+
+    def get(self, table_name, key):
+        item = self.load(table_name, self.item_key(self.key(table_name, key)))
+        return copy.deepcopy(item)
+
+    def write(self, table_name, key, item):
+        self.store(table_name, self.item_key(key), copy.deepcopy(item))
+
+    @staticmethod
+    def item_key(key):
+        return json.dumps(key, sort_keys=True)
+
+
+class MemoryTables(LocalTables):
+    def __init__(self, tables):
+        self.tables = tables
+
+    def table_names(self):
+        return list(self.tables)
+
+    def create_table(self, table_name, key_names):
+        self.tables[table_name] = {"KeyNames": key_names, "Items": {}}
+
+    def key_names(self, table_name):
+        table = self.tables.get(table_name)
+        return table["KeyNames"] if table is not None else None
+
+    def load(self, table_name, item_key):
+        return self.tables[table_name]["Items"].get(item_key)
+
+    def store(self, table_name, item_key, item):
+        items = self.tables[table_name]["Items"]
+        if item is None:
+            items.pop(item_key, None)
+        else:
+            items[item_key] = item
+
+
+class MemoryClient(LocalClient):
+    """Keeps tables in this process. They are gone once the process exits."""
+
+    def __init__(self):
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self, write=True):
+        with self.lock:
+            yield MemoryTables(self.tables)
+
+
+class SQLiteTables(LocalTables):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def table_names(self):
+        rows = self.connection.execute("SELECT table_name FROM sling_tables")
+        return [table_name for table_name, in rows]
+
+    def create_table(self, table_name, key_names):
+        self.connection.execute(
+            "INSERT INTO sling_tables (table_name, key_names) VALUES (?, ?)",
+            (table_name, json.dumps(key_names)),
+        )
+
+    def key_names(self, table_name):
+        row = self.connection.execute(
+            "SELECT key_names FROM sling_tables WHERE table_name = ?", (table_name,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def load(self, table_name, item_key):
+        row = self.connection.execute(
+            "SELECT item FROM sling_items WHERE table_name = ? AND item_key = ?",
+            (table_name, item_key),
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def store(self, table_name, item_key, item):
+        if item is None:
+            self.connection.execute(
+                "DELETE FROM sling_items WHERE table_name = ? AND item_key = ?",
+                (table_name, item_key),
+            )
+        else:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sling_items (table_name, item_key, item) VALUES (?, ?, ?)",
+                (table_name, item_key, json.dumps(item)),
+            )
+
+
+class SQLiteClient(LocalClient):
+    """Keeps tables in a SQLite database file shared by every process that opens it.
+
+    The database runs in WAL mode so reads don't wait on writers. Reads run in
+    deferred transactions that never take the write lock, while writes take it up
+    front so conditions are checked against what they commit. Binary attributes
+    aren't supported.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.local = threading.local()
+        with self.transaction() as tables:
+            tables.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sling_tables (table_name TEXT PRIMARY KEY, key_names TEXT NOT NULL)"
+            )
+            tables.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sling_items (table_name TEXT NOT NULL, item_key TEXT NOT NULL, item TEXT NOT NULL, PRIMARY KEY (table_name, item_key))"
+            )
+
+    def connection(self):
+        """Returns this thread's connection, as sqlite3 connections can't be shared."""
+
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database, isolation_level=None, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self, write=True):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield SQLiteTables(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
@@ -30,6 +30,9 @@ def gateway_factory():
     -v and -s flag.
     """
 
+    # Services the tests register are put straight into the table
+    api.service_registry.clear()
+
     client = boto3.client("dynamodb")
     lock_table_name = LOCK_TABLE_NAME
     service_table_name = SERVICE_TABLE_NAME
@@ -70,6 +73,15 @@ def gateway_factory():
             "JobId": {"S": ""},
         },
     )
+    client.put_item(
+        TableName=lock_table_name,
+        Item={
+            "LockName": {"S": "unheld_lock_2"},
+            "HeldBy": {"S": ""},
+            "Lock_Acquire_DateTime": {"S": ""},
+            "JobId": {"S": ""},
+        },
+    )
     client.put_item(
         TableName=service_table_name, Item={"ServiceName": {"S": "unheld_service"}},
     )
@@ -80,6 +92,26 @@ def gateway_factory():
             "HeldBy": {"S": "held_service"},
             "Lock_Acquire_DateTime": {"S": "2020"},
             "JobId": {"S": "101"},
+            "FencingToken": {"N": "5"},
+        },
+    )
+    client.put_item(
+        TableName=lock_table_name,
+        Item={
+            "LockName": {"S": "held_lock_2"},
+            "HeldBy": {"S": "held_service"},
+            "Lock_Acquire_DateTime": {"S": "2020"},
+            "JobId": {"S": "102"},
+        },
+    )
+    client.put_item(
+        TableName=lock_table_name,
+        Item={
+            "LockName": {"S": "expired_lock"},
+            "HeldBy": {"S": "held_service"},
+            "Lock_Acquire_DateTime": {"S": "2020"},
+            "JobId": {"S": "103"},
+            "LeaseExpiry": {"N": "1"},
         },
     )
     client.put_item(
@@ -104,13 +136,23 @@ def gateway_factory():
     client.delete_item(
         TableName=lock_table_name, Key={"LockName": {"S": "unheld_lock"}},
     )
+    client.delete_item(
+        TableName=lock_table_name, Key={"LockName": {"S": "unheld_lock_2"}},
+    )
     client.delete_item(
         TableName=service_table_name, Key={"ServiceName": {"S": "unheld_service"}}
     )
     client.delete_item(
         TableName=lock_table_name, Key={"LockName": {"S": "held_lock"}},
     )
+    client.delete_item(
+        TableName=lock_table_name, Key={"LockName": {"S": "held_lock_2"}},
+    )
+    client.delete_item(
+        TableName=lock_table_name, Key={"LockName": {"S": "expired_lock"}},
+    )
     client.delete_item(
         TableName=service_table_name, Key={"ServiceName": {"S": "held_service"}}
     )
     client.delete_item(TableName=log_table_name, Key={"JobId": {"S": "101"}})
+    client.delete_item(TableName=log_table_name, Key={"JobId": {"S": "102"}})
@@ -1,17 +1,32 @@
 import json
 import pytest
+import threading
+import time
 import uuid
 import boto3
 
+from Sling.chalicelib import api
 from Sling.chalicelib.api import (
     retrieve_tables_values,
     dictify_resp,
+    ServiceRegistryCache,
     ValidationException,
 )
 
+from .conftest import app
 from .constants import *
 
 
+class StubLambdaContext:
+    """Stands in for the context Lambda hands an invocation."""
+
+    def __init__(self, remaining_time_in_millis):
+        self.remaining_time_in_millis = remaining_time_in_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_time_in_millis
+
+
 @pytest.mark.usefixtures("gateway_factory")
 class TestChaliceHelperFunctions:
     """Class testing the helper functions in api.py"""
@@ -75,6 +90,33 @@ class TestChaliceHelperFunctions:
         assert resp["LockName"] == expected[1]
         assert resp["JobId"] == expected[2]
 
+    def test_service_registry_cache_bounds(self):
+        cache = ServiceRegistryCache(ttl=60, max_size=2)
+        cache.add("Services", "a")
+        cache.add("Services", "b")
+        assert cache.contains("Services", "a")
+        # b is now the least recently used, so it is forgotten first
+        cache.add("Services", "c")
+        assert not cache.contains("Services", "b")
+        assert cache.contains("Services", "a") and cache.contains("Services", "c")
+
+        expired = ServiceRegistryCache(ttl=-1, max_size=2)
+        expired.add("Services", "a")
+        assert not expired.contains("Services", "a")
+
+    def test_get_wait_deadline(self, monkeypatch):
+        monkeypatch.setattr(app, "lambda_context", None, raising=False)
+        assert api.get_wait_deadline({"WaitTimeout": 5}, 100) == 105
+
+        # The wait ends early enough for the invocation to answer before it times out
+        monkeypatch.setattr(
+            app, "lambda_context", StubLambdaContext(3000), raising=False
+        )
+        assert api.get_wait_deadline({"WaitTimeout": 5}, 100) == (
+            100 + 3 - api.LAMBDA_TIMEOUT_MARGIN
+        )
+        assert api.get_wait_deadline({"WaitTimeout": 1}, 100) == 101
+
 
 @pytest.mark.usefixtures("gateway_factory")
 class TestChaliceLocksAndServicesAPI:
@@ -166,6 +208,54 @@ class TestChaliceLocksAndServicesAPI:
         )
         assert actual["ResponseMetadata"]["Message"] == expected
 
+        resp = retrieve_tables_values("unheld_lock", LOCK_TABLE_NAME)
+        assert (
+            resp[0]["Item"]["Lock_Acquire_DateTime"]["S"]
+            == actual["ResponseMetadata"]["LockAcquireDateTime"]
+        )
+
+    def test_acquire_compact_response(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "unheld_lock",
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire",
+            headers={
+                "Content-Type": "application/json",
+                "X-Sling-Response-Format": "compact",
+            },
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        actual = json.loads(response["body"])
+        assert sorted(actual["ResponseMetadata"]) == [
+            "FencingToken",
+            "JobId",
+            "LeaseExpiry",
+            "LockAcquireDateTime",
+        ]
+
+        body = dict(
+            body,
+            JobId=actual["ResponseMetadata"]["JobId"],
+            LogTableName=self.log_table_name,
+        )
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={
+                "Content-Type": "application/json",
+                "X-Sling-Response-Format": "compact",
+            },
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        assert json.loads(response["body"]) == {"ResponseMetadata": {}}
+
     def test_acquire_acquired_lock(self, gateway_factory):
         body = {
             "ServiceName": "unheld_service",
@@ -198,184 +288,1577 @@ class TestChaliceLocksAndServicesAPI:
         assert response["statusCode"] == 409
         assert json.loads(response["body"])["Message"] == "Unable to acquire a lock"
 
-    def test_release_lock(self, gateway_factory):
+    def test_acquire_with_unregistered_service(self, gateway_factory):
         body = {
-            "ServiceName": "held_service",
+            "ServiceName": "doesn't exist",
+            "LockName": "unheld_lock",
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 400
+        assert json.loads(response["body"])["Message"] == "Service doesn't exist"
+
+        # The lock is left untouched when the service check fails
+        resp = retrieve_tables_values("unheld_lock", LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["HeldBy"]["S"] == ""
+
+    def test_acquire_held_lock_with_unregistered_service(self, gateway_factory):
+        body = {
+            "ServiceName": "doesn't exist",
             "LockName": "held_lock",
-            "JobId": "101",
             "LockTableName": self.lock_table_name,
-            "LogTableName": self.log_table_name,
+            "ServiceTableName": self.service_table_name,
         }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 400
 
+    def test_acquire_with_lease(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "unheld_lock",
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+            "LeaseDuration": 60,
+        }
         response = gateway_factory.handle_request(
             method="POST",
-            path="/release",
+            path="/acquire",
             headers={"Content-Type": "application/json"},
             body=json.dumps(body),
         )
         assert response["statusCode"] == 200
         actual = json.loads(response["body"])
-        expected = "%s released the following lock: %s with JobId: %s" % (
-            "held_service",
-            "held_lock",
-            "101",
+        resp = retrieve_tables_values("unheld_lock", LOCK_TABLE_NAME)
+        assert float(resp[0]["Item"]["LeaseExpiry"]["N"]) == pytest.approx(
+            actual["ResponseMetadata"]["LeaseExpiry"]
         )
-        assert actual["ResponseMetadata"]["Message"] == expected
 
-    def test_release_released_lock(self, gateway_factory):
+    @pytest.mark.parametrize("lease_duration", [0, -5, "60", True])
+    def test_acquire_with_invalid_lease(self, gateway_factory, lease_duration):
         body = {
             "ServiceName": "unheld_service",
             "LockName": "unheld_lock",
-            "JobId": "101",
             "LockTableName": self.lock_table_name,
-            "LogTableName": self.log_table_name,
+            "ServiceTableName": self.service_table_name,
+            "LeaseDuration": lease_duration,
         }
         response = gateway_factory.handle_request(
             method="POST",
-            path="/release",
+            path="/acquire",
             headers={"Content-Type": "application/json"},
             body=json.dumps(body),
         )
-        assert response["statusCode"] == 409
-        assert json.loads(response["body"])["Message"] == "Unable to release lock"
+        assert response["statusCode"] == 400
 
-    def test_release_nonexistant_lock(self, gateway_factory):
-        nonexistent_lock_name_body = {
-            "LockName": "doesn't exist",
-            "ServiceName": self.service_name,
-            "JobId": "101",
+    def test_acquire_expired_lock(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "expired_lock",
             "LockTableName": self.lock_table_name,
-            "LogTableName": self.log_table_name,
+            "ServiceTableName": self.service_table_name,
         }
         response = gateway_factory.handle_request(
             method="POST",
-            path="/release",
+            path="/acquire",
             headers={"Content-Type": "application/json"},
-            body=json.dumps(nonexistent_lock_name_body),
+            body=json.dumps(body),
         )
-        assert response["statusCode"] == 409
+        assert response["statusCode"] == 200
+        resp = retrieve_tables_values("expired_lock", LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["HeldBy"]["S"] == "unheld_service"
+        assert "LeaseExpiry" not in resp[0]["Item"]
 
-    def test_release_lock_with_nonexisting_service(self, gateway_factory):
-        nonexistent_service_name_body = {
-            "LockName": "released_service_lock",
-            "ServiceName": "released_service",
-            "JobId": "101",
+        # The new holder gets a token one past the stalled holder's token
+        actual = json.loads(response["body"])
+        assert int(resp[0]["Item"]["FencingToken"]["N"]) == (
+            actual["ResponseMetadata"]["FencingToken"]
+        )
+
+    def test_acquire_fencing_token_increases(self, gateway_factory):
+        client = boto3.client("dynamodb")
+        client.update_item(
+            TableName=self.lock_table_name,
+            Key={"LockName": {"S": "unheld_lock"}},
+            UpdateExpression="SET FencingToken = :fencing_token",
+            ExpressionAttributeValues={":fencing_token": {"N": str(10 ** 17)}},
+        )
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "unheld_lock",
             "LockTableName": self.lock_table_name,
-            "LogTableName": self.log_table_name,
+            "ServiceTableName": self.service_table_name,
         }
         response = gateway_factory.handle_request(
             method="POST",
-            path="/release",
+            path="/acquire",
             headers={"Content-Type": "application/json"},
-            body=json.dumps(nonexistent_service_name_body),
+            body=json.dumps(body),
         )
+        # Tokens count acquires, so no clock decides whether one is handed out
         assert response["statusCode"] == 200
+        actual = json.loads(response["body"])
+        assert actual["ResponseMetadata"]["FencingToken"] == 10 ** 17 + 1
 
-    def test_release_lock_never_existed_service(self, gateway_factory):
-        never_existed_service_name_body = {
+    def test_renew(self, gateway_factory):
+        body = {
+            "ServiceName": "held_service",
             "LockName": "held_lock",
-            "ServiceName": "doesn't exist",
             "JobId": "101",
             "LockTableName": self.lock_table_name,
-            "LogTableName": self.log_table_name,
+            "LeaseDuration": 60,
         }
         response = gateway_factory.handle_request(
             method="POST",
-            path="/release",
+            path="/renew",
             headers={"Content-Type": "application/json"},
-            body=json.dumps(never_existed_service_name_body),
+            body=json.dumps(body),
         )
-        assert response["statusCode"] == 409
+        assert response["statusCode"] == 200
+        resp = retrieve_tables_values("held_lock", LOCK_TABLE_NAME)
+        assert "LeaseExpiry" in resp[0]["Item"]
 
-    def test_release_lock_nonexistant_job_id(self, gateway_factory):
-        nonexistent_job_id_body = {
-            "LockName": self.lock_name,
-            "ServiceName": self.service_name,
+    def test_renew_taken_over_lock(self, gateway_factory):
+        body = {
+            "ServiceName": "held_service",
+            "LockName": "held_lock",
             "JobId": "doesn't exist",
             "LockTableName": self.lock_table_name,
-            "LogTableName": self.log_table_name,
+            "LeaseDuration": 60,
         }
         response = gateway_factory.handle_request(
             method="POST",
-            path="/release",
+            path="/renew",
             headers={"Content-Type": "application/json"},
-            body=json.dumps(nonexistent_job_id_body),
+            body=json.dumps(body),
         )
         assert response["statusCode"] == 409
-        assert json.loads(response["body"])["Message"] == "Unable to release lock"
+        assert json.loads(response["body"])["Message"] == "Unable to renew lock"
 
-    def test_deregister_lock_held_by_a_service(self, gateway_factory):
-        body = {"LockName": "held_lock", "LockTableName": self.lock_table_name}
+    def test_priority(self, gateway_factory):
+        def post(path, **fields):
+            body = {"LockName": "held_lock", "LockTableName": self.lock_table_name}
+            body.update(fields)
+            return gateway_factory.handle_request(
+                method="POST",
+                path=path,
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+
+        # A failed high priority acquire asks the holder to yield
+        response = post(
+            "/acquire",
+            ServiceName="unheld_service",
+            ServiceTableName=self.service_table_name,
+            Priority=10,
+        )
+        assert response["statusCode"] == 409
+        response = post(
+            "/renew", ServiceName="held_service", JobId="101", LeaseDuration=60
+        )
+        assert response["statusCode"] == 200
+        assert json.loads(response["body"])["ResponseMetadata"]["YieldRequested"]
+        assert json.loads(post("/lock_status")["body"])["YieldRequested"]
+
+        response = post(
+            "/release",
+            ServiceName="held_service",
+            JobId="101",
+            LogTableName=self.log_table_name,
+        )
+        assert response["statusCode"] == 200
+
+        # Lower priorities can't slip in ahead of the pending acquire
+        response = post(
+            "/acquire",
+            ServiceName="held_service",
+            ServiceTableName=self.service_table_name,
+        )
+        assert response["statusCode"] == 409
+        response = post(
+            "/acquire",
+            ServiceName="unheld_service",
+            ServiceTableName=self.service_table_name,
+            Priority=10,
+        )
+        assert response["statusCode"] == 200
+        resp = retrieve_tables_values("held_lock", LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["HeldBy"]["S"] == "unheld_service"
+        assert "PendingPriority" not in resp[0]["Item"]
+        assert not json.loads(post("/lock_status")["body"])["YieldRequested"]
 
+    def test_idempotency_key(self, gateway_factory):
+        def post(path, **fields):
+            body = {
+                "ServiceName": "unheld_service",
+                "LockName": "unheld_lock",
+                "LockTableName": self.lock_table_name,
+            }
+            body.update(fields)
+            return gateway_factory.handle_request(
+                method="POST",
+                path=path,
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+
+        acquire_fields = {
+            "ServiceTableName": self.service_table_name,
+            "IdempotencyKey": "acquire-1",
+        }
+        response = post("/acquire", **acquire_fields)
+        assert response["statusCode"] == 200
+        acquired = json.loads(response["body"])["ResponseMetadata"]
+
+        # A retried acquire gets back what the first one was handed
+        response = post("/acquire", **acquire_fields)
+        assert response["statusCode"] == 200
+        replayed = json.loads(response["body"])["ResponseMetadata"]
+        assert replayed["Replayed"]
+        for key in ["JobId", "FencingToken", "LockAcquireDateTime", "LeaseExpiry"]:
+            assert replayed[key] == acquired[key]
+
+        acquire_fields["IdempotencyKey"] = "acquire-2"
+        assert post("/acquire", **acquire_fields)["statusCode"] == 409
+
+        release_fields = {
+            "JobId": acquired["JobId"],
+            "LogTableName": self.log_table_name,
+            "IdempotencyKey": "release-1",
+        }
+        assert post("/release", **release_fields)["statusCode"] == 200
+        response = post("/release", **release_fields)
+        assert response["statusCode"] == 200
+        assert json.loads(response["body"])["ResponseMetadata"]["Replayed"]
+
+        release_fields["IdempotencyKey"] = "release-2"
+        assert post("/release", **release_fields)["statusCode"] == 409
+
+    def test_acquire_wait(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "unheld_lock",
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+            "WaitTimeout": 1,
+        }
         response = gateway_factory.handle_request(
             method="POST",
-            path="/deregister_lock",
+            path="/acquire_wait",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+
+    def test_acquire_wait_times_out(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "held_lock",
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+            "WaitTimeout": 0.5,
+        }
+        start = time.time()
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire_wait",
             headers={"Content-Type": "application/json"},
             body=json.dumps(body),
         )
         assert response["statusCode"] == 409
-        assert json.loads(response["body"])["Message"] == "Unable to deregister a lock"
+        assert time.time() - start >= 0.5
 
-    def test_deregister_lock_not_held_by_a_service(self, gateway_factory):
-        body = {"LockName": "unheld_lock", "LockTableName": self.lock_table_name}
+    def test_acquire_wait_for_released_lock(self, gateway_factory):
+        def release_held_lock():
+            time.sleep(0.3)
+            boto3.client("dynamodb").update_item(
+                TableName=self.lock_table_name,
+                Key={"LockName": {"S": "held_lock"}},
+                UpdateExpression="SET HeldBy = :empty_string, JobId = :empty_string",
+                ExpressionAttributeValues={":empty_string": {"S": ""}},
+            )
 
+        releaser = threading.Thread(target=release_held_lock)
+        releaser.start()
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "held_lock",
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+            "WaitTimeout": 10,
+        }
         response = gateway_factory.handle_request(
             method="POST",
-            path="/deregister_lock",
+            path="/acquire_wait",
             headers={"Content-Type": "application/json"},
             body=json.dumps(body),
         )
+        releaser.join()
         assert response["statusCode"] == 200
-        actual = json.loads(response["body"])
-        expected = "Deregistered Lock: %s" % body["LockName"]
-        assert actual["ResponseMetadata"]["Message"] == expected
+        resp = retrieve_tables_values("held_lock", LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["HeldBy"]["S"] == "unheld_service"
 
-    def test_deregister_service_holding_lock(self, gateway_factory):
+    def test_acquire_wait_with_unregistered_service(self, gateway_factory):
         body = {
-            "ServiceName": "held_service",
+            "ServiceName": "doesn't exist",
+            "LockName": "held_lock",
+            "LockTableName": self.lock_table_name,
             "ServiceTableName": self.service_table_name,
+            "WaitTimeout": 10,
         }
+        start = time.time()
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire_wait",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        # Waiting can't help an unregistered service, so it fails straight away
+        assert response["statusCode"] == 400
+        assert time.time() - start < 10
 
+    def enqueue(self, gateway_factory, service_name, lock_name):
+        body = {
+            "ServiceName": service_name,
+            "LockName": lock_name,
+            "LockTableName": self.lock_table_name,
+        }
         response = gateway_factory.handle_request(
             method="POST",
-            path="/deregister_service",
+            path="/enqueue",
             headers={"Content-Type": "application/json"},
             body=json.dumps(body),
         )
         assert response["statusCode"] == 200
-        actual = json.loads(response["body"])
-        expected = "Deregistered Service: %s" % body["ServiceName"]
-        assert actual["ResponseMetadata"]["Message"] == expected
+        return json.loads(response["body"])["ResponseMetadata"]
 
-    def test_deregister_service_not_holding_lock(self, gateway_factory):
+    def acquire_with_ticket(self, gateway_factory, service_name, lock_name, ticket):
         body = {
-            "ServiceName": "unheld_service",
+            "ServiceName": service_name,
+            "LockName": lock_name,
+            "LockTableName": self.lock_table_name,
             "ServiceTableName": self.service_table_name,
         }
-
-        response = gateway_factory.handle_request(
+        if ticket is not None:
+            body["Ticket"] = ticket
+        return gateway_factory.handle_request(
             method="POST",
-            path="/deregister_service",
+            path="/acquire",
             headers={"Content-Type": "application/json"},
             body=json.dumps(body),
         )
+
+    def test_enqueue(self, gateway_factory):
+        lock_name = str(uuid.uuid4())
+        boto3.client("dynamodb").put_item(
+            TableName=self.lock_table_name,
+            Item={
+                "LockName": {"S": lock_name},
+                "HeldBy": {"S": ""},
+                "JobId": {"S": ""},
+            },
+        )
+
+        first = self.enqueue(gateway_factory, "unheld_service", lock_name)
+        second = self.enqueue(gateway_factory, "held_service", lock_name)
+        assert (first["Ticket"], first["Position"]) == (1, 0)
+        assert (second["Ticket"], second["Position"]) == (2, 1)
+
+        # Neither callers without a ticket nor later tickets may jump the queue
+        response = self.acquire_with_ticket(
+            gateway_factory, "unheld_service", lock_name, None
+        )
+        assert response["statusCode"] == 409
+        response = self.acquire_with_ticket(gateway_factory, "held_service", lock_name, 2)
+        assert response["statusCode"] == 409
+
+        response = self.acquire_with_ticket(
+            gateway_factory, "unheld_service", lock_name, 1
+        )
         assert response["statusCode"] == 200
-        actual = json.loads(response["body"])
-        expected = "Deregistered Service: %s" % body["ServiceName"]
-        assert actual["ResponseMetadata"]["Message"] == expected
 
-    def test_deregister_nonexistant_lock(self, gateway_factory):
-        body = {"LockName": "doesn't exist", "LockTableName": self.lock_table_name}
         response = gateway_factory.handle_request(
             method="POST",
-            path="/deregister_lock",
+            path="/lock_status",
             headers={"Content-Type": "application/json"},
-            body=json.dumps(body),
+            body=json.dumps(
+                {"LockName": lock_name, "LockTableName": self.lock_table_name}
+            ),
+        )
+        assert response["statusCode"] == 200
+        status = json.loads(response["body"])
+        assert status["HeldBy"] == "unheld_service"
+        assert status["QueueHead"] == 2
+        assert status["QueueDepth"] == 1
+
+        boto3.client("dynamodb").delete_item(
+            TableName=self.lock_table_name, Key={"LockName": {"S": lock_name}}
+        )
+
+    def test_enqueue_abandoned_head(self, gateway_factory):
+        lock_name = str(uuid.uuid4())
+        client = boto3.client("dynamodb")
+        client.put_item(
+            TableName=self.lock_table_name,
+            Item={
+                "LockName": {"S": lock_name},
+                "HeldBy": {"S": ""},
+                "JobId": {"S": ""},
+            },
+        )
+        tickets = [
+            self.enqueue(gateway_factory, "unheld_service", lock_name)["Ticket"]
+            for _ in range(3)
+        ]
+        assert tickets == [1, 2, 3]
+
+        # Ticket 1 never shows up for its turn
+        client.update_item(
+            TableName=self.lock_table_name,
+            Key={"LockName": {"S": lock_name}},
+            UpdateExpression="SET QueueHeadExpiry = :expired",
+            ExpressionAttributeValues={":expired": {"N": "1"}},
+        )
+
+        # Ticket 3 can't jump ahead of ticket 2, it only moves the head past ticket 1
+        response = self.acquire_with_ticket(
+            gateway_factory, "unheld_service", lock_name, 3
+        )
+        assert response["statusCode"] == 409
+        resp = retrieve_tables_values(lock_name, LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["QueueHead"]["N"] == "2"
+        assert float(resp[0]["Item"]["QueueHeadExpiry"]["N"]) > time.time()
+
+        # Ticket 2 got a full turn of its own, so ticket 3 still has to wait for it
+        response = self.acquire_with_ticket(
+            gateway_factory, "unheld_service", lock_name, 3
+        )
+        assert response["statusCode"] == 409
+        response = self.acquire_with_ticket(
+            gateway_factory, "unheld_service", lock_name, 2
+        )
+        assert response["statusCode"] == 200
+
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": lock_name,
+            "JobId": json.loads(response["body"])["ResponseMetadata"]["JobId"],
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        response = self.acquire_with_ticket(
+            gateway_factory, "unheld_service", lock_name, 3
+        )
+        assert response["statusCode"] == 200
+
+        client.delete_item(
+            TableName=self.lock_table_name, Key={"LockName": {"S": lock_name}}
+        )
+
+    def test_enqueue_idle_queue(self, gateway_factory):
+        lock_name = str(uuid.uuid4())
+        client = boto3.client("dynamodb")
+        # Ticket 1 took its turn and released the lock long ago
+        client.put_item(
+            TableName=self.lock_table_name,
+            Item={
+                "LockName": {"S": lock_name},
+                "HeldBy": {"S": ""},
+                "JobId": {"S": ""},
+                "QueueHead": {"N": "2"},
+                "QueueTail": {"N": "1"},
+                "QueueHeadExpiry": {"N": "1"},
+            },
+        )
+
+        first = self.enqueue(gateway_factory, "unheld_service", lock_name)
+        second = self.enqueue(gateway_factory, "held_service", lock_name)
+        assert (first["Ticket"], first["Position"]) == (2, 0)
+        assert (second["Ticket"], second["Position"]) == (3, 1)
+
+        # The new head gets a full turn, so nobody can take the lock from it
+        response = self.acquire_with_ticket(
+            gateway_factory, "held_service", lock_name, None
+        )
+        assert response["statusCode"] == 409
+        response = self.acquire_with_ticket(gateway_factory, "held_service", lock_name, 3)
+        assert response["statusCode"] == 409
+        response = self.acquire_with_ticket(
+            gateway_factory, "unheld_service", lock_name, 2
+        )
+        assert response["statusCode"] == 200
+
+        client.delete_item(
+            TableName=self.lock_table_name, Key={"LockName": {"S": lock_name}}
+        )
+
+    def test_enqueue_nonexistant_lock(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "doesn't exist",
+            "LockTableName": self.lock_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/enqueue",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 409
+        assert json.loads(response["body"])["Message"] == "Unable to join the lock queue"
+
+    def test_lock_status_nonexistant_lock(self, gateway_factory):
+        body = {"LockName": "doesn't exist", "LockTableName": self.lock_table_name}
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/lock_status",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 400
+        assert json.loads(response["body"])["Message"] == "Lock doesn't exist"
+
+    def test_release_lock(self, gateway_factory):
+        body = {
+            "ServiceName": "held_service",
+            "LockName": "held_lock",
+            "JobId": "101",
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        actual = json.loads(response["body"])
+        expected = "%s released the following lock: %s with JobId: %s" % (
+            "held_service",
+            "held_lock",
+            "101",
+        )
+        assert actual["ResponseMetadata"]["Message"] == expected
+
+    def test_release_lock_with_acquire_date_time(self, gateway_factory):
+        body = {
+            "ServiceName": "held_service",
+            "LockName": "held_lock",
+            "JobId": "101",
+            "LockAcquireDateTime": "2020-06-03 10:07:18",
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+
+        # The log entry carries the acquire time the caller sent back
+        client = boto3.client("dynamodb")
+        log_item = client.get_item(
+            TableName=self.log_table_name, Key={"JobId": {"S": "101"}}
+        )["Item"]
+        assert log_item["Lock_Acquire_DateTime"]["S"] == "2020-06-03 10:07:18"
+
+    @pytest.mark.parametrize(
+        "fencing_token, expected_status", [(5, 200), (4, 409), ("5", 400)]
+    )
+    def test_release_lock_with_fencing_token(
+        self, gateway_factory, fencing_token, expected_status
+    ):
+        body = {
+            "ServiceName": "held_service",
+            "LockName": "held_lock",
+            "JobId": "101",
+            "FencingToken": fencing_token,
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == expected_status
+
+    def test_release_released_lock(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "unheld_lock",
+            "JobId": "101",
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 409
+        assert json.loads(response["body"])["Message"] == "Unable to release lock"
+
+    def test_release_nonexistant_lock(self, gateway_factory):
+        nonexistent_lock_name_body = {
+            "LockName": "doesn't exist",
+            "ServiceName": self.service_name,
+            "JobId": "101",
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(nonexistent_lock_name_body),
+        )
+        assert response["statusCode"] == 409
+
+    def test_release_lock_with_nonexisting_service(self, gateway_factory):
+        nonexistent_service_name_body = {
+            "LockName": "released_service_lock",
+            "ServiceName": "released_service",
+            "JobId": "101",
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(nonexistent_service_name_body),
+        )
+        assert response["statusCode"] == 200
+
+    def test_release_lock_never_existed_service(self, gateway_factory):
+        never_existed_service_name_body = {
+            "LockName": "held_lock",
+            "ServiceName": "doesn't exist",
+            "JobId": "101",
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(never_existed_service_name_body),
+        )
+        assert response["statusCode"] == 409
+
+    def test_release_lock_nonexistant_job_id(self, gateway_factory):
+        nonexistent_job_id_body = {
+            "LockName": self.lock_name,
+            "ServiceName": self.service_name,
+            "JobId": "doesn't exist",
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(nonexistent_job_id_body),
+        )
+        assert response["statusCode"] == 409
+        assert json.loads(response["body"])["Message"] == "Unable to release lock"
+
+    def test_acquire_batch(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockNames": ["unheld_lock", "unheld_lock_2"],
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire_batch",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        actual = json.loads(response["body"])
+        assert sorted(actual["ResponseMetadata"]["JobIds"]) == [
+            "unheld_lock",
+            "unheld_lock_2",
+        ]
+        assert actual["ResponseMetadata"]["FencingTokens"] == {
+            "unheld_lock": 1,
+            "unheld_lock_2": 1,
+        }
+
+    def test_acquire_batch_with_held_lock(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockNames": ["unheld_lock", "held_lock"],
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire_batch",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 409
+        assert json.loads(response["body"])["Message"] == "Unable to acquire locks"
+
+        # Nothing is acquired when any lock in the batch is held
+        resp = retrieve_tables_values("unheld_lock", LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["HeldBy"]["S"] == ""
+
+    def test_acquire_batch_duplicate_locks(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockNames": ["unheld_lock", "unheld_lock"],
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire_batch",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 400
+
+    def test_release_batch(self, gateway_factory):
+        body = {
+            "ServiceName": "held_service",
+            "Locks": [
+                {"LockName": "held_lock", "JobId": "101"},
+                {"LockName": "held_lock_2", "JobId": "102"},
+            ],
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release_batch",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        resp = retrieve_tables_values("held_lock_2", LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["HeldBy"]["S"] == ""
+
+    def test_release_batch_with_wrong_job_id(self, gateway_factory):
+        body = {
+            "ServiceName": "held_service",
+            "Locks": [
+                {"LockName": "held_lock", "JobId": "101"},
+                {"LockName": "held_lock_2", "JobId": "doesn't exist"},
+            ],
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release_batch",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 409
+        assert json.loads(response["body"])["Message"] == "Unable to release locks"
+        resp = retrieve_tables_values("held_lock", LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["HeldBy"]["S"] == "held_service"
+
+    def test_semaphore(self, gateway_factory):
+        lock_name = str(uuid.uuid4())
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/register_lock",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(
+                {
+                    "LockName": lock_name,
+                    "LockTableName": self.lock_table_name,
+                    "Permits": 2,
+                }
+            ),
+        )
+        assert response["statusCode"] == 200
+
+        def acquire(mode):
+            body = {
+                "ServiceName": "unheld_service",
+                "LockName": lock_name,
+                "LockTableName": self.lock_table_name,
+                "ServiceTableName": self.service_table_name,
+                "Mode": mode,
+            }
+            return gateway_factory.handle_request(
+                method="POST",
+                path="/acquire",
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+
+        first = acquire("semaphore")
+        second = acquire("semaphore")
+        assert first["statusCode"] == 200
+        assert second["statusCode"] == 200
+        # Holders that got in at the same time still get different tokens
+        assert [
+            json.loads(holder["body"])["ResponseMetadata"]["FencingToken"]
+            for holder in (first, second)
+        ] == [1, 2]
+
+        # Every permit is taken, and a semaphore never has an exclusive holder
+        assert acquire("semaphore")["statusCode"] == 409
+        assert acquire("exclusive")["statusCode"] == 409
+
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/deregister_lock",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(
+                {"LockName": lock_name, "LockTableName": self.lock_table_name}
+            ),
+        )
+        assert response["statusCode"] == 409
+
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": lock_name,
+            "JobId": json.loads(first["body"])["ResponseMetadata"]["JobId"],
+            "FencingToken": 1,
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+            "Mode": "semaphore",
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+
+        # Releasing the same holder twice fails
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 409
+
+        assert acquire("semaphore")["statusCode"] == 200
+        resp = retrieve_tables_values(lock_name, LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["HolderCount"]["N"] == "2"
+        assert len(resp[0]["Item"]["Holders"]["M"]) == 2
+
+        boto3.client("dynamodb").delete_item(
+            TableName=self.lock_table_name, Key={"LockName": {"S": lock_name}}
+        )
+
+    def test_semaphore_lease(self, gateway_factory):
+        client = boto3.client("dynamodb")
+        lock_name = str(uuid.uuid4())
+
+        def request(path, body):
+            return gateway_factory.handle_request(
+                method="POST",
+                path=path,
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(
+                    {"LockName": lock_name, "LockTableName": self.lock_table_name, **body}
+                ),
+            )
+
+        def acquire():
+            return request(
+                "/acquire",
+                {
+                    "ServiceName": "unheld_service",
+                    "ServiceTableName": self.service_table_name,
+                    "Mode": "semaphore",
+                    "LeaseDuration": 60,
+                },
+            )
+
+        def renew(acquired, fencing_token):
+            return request(
+                "/renew",
+                {
+                    "ServiceName": "unheld_service",
+                    "JobId": acquired["JobId"],
+                    "FencingToken": fencing_token,
+                    "LeaseDuration": 60,
+                    "Mode": "semaphore",
+                },
+            )
+
+        def expire(job_id):
+            client.update_item(
+                TableName=self.lock_table_name,
+                Key={"LockName": {"S": lock_name}},
+                UpdateExpression="SET Holders.#job_id.LeaseExpiry = :expired",
+                ExpressionAttributeNames={"#job_id": job_id},
+                ExpressionAttributeValues={":expired": {"N": "1"}},
+            )
+
+        assert request("/register_lock", {"Permits": 2})["statusCode"] == 200
+        crashed, renewed = [
+            json.loads(acquire()["body"])["ResponseMetadata"] for _ in range(2)
+        ]
+
+        # Each holder renews its own lease, and only under its own token
+        assert renew(renewed, renewed["FencingToken"])["statusCode"] == 200
+        assert renew(renewed, crashed["FencingToken"])["statusCode"] == 409
+
+        # A holder whose lease ran out gives its permit to the next acquire, while
+        # the holder that renewed keeps its own
+        expire(crashed["JobId"])
+        assert acquire()["statusCode"] == 200
+        resp = retrieve_tables_values(lock_name, LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["HolderCount"]["N"] == "2"
+        assert crashed["JobId"] not in resp[0]["Item"]["Holders"]["M"]
+        assert crashed["JobId"] not in resp[0]["Item"]["HolderTokens"]["M"]
+        assert renewed["JobId"] in resp[0]["Item"]["Holders"]["M"]
+        assert acquire()["statusCode"] == 409
+
+        # A semaphore whose holders have all run out can be deregistered
+        for job_id in resp[0]["Item"]["Holders"]["M"]:
+            expire(job_id)
+        assert request("/deregister_lock", {})["statusCode"] == 200
+        assert "Item" not in retrieve_tables_values(lock_name, LOCK_TABLE_NAME)[0]
+
+    def test_shared_mode(self, gateway_factory):
+        def request(path, service_name, lock_name, mode, job_id=None):
+            body = {
+                "ServiceName": service_name,
+                "LockName": lock_name,
+                "LockTableName": self.lock_table_name,
+                "ServiceTableName": self.service_table_name,
+                "LogTableName": self.log_table_name,
+                "Mode": mode,
+            }
+            if job_id is not None:
+                body["JobId"] = job_id
+            return gateway_factory.handle_request(
+                method="POST",
+                path=path,
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+
+        first = request("/acquire", "unheld_service", "unheld_lock", "shared")
+        second = request("/acquire", "held_service", "unheld_lock", "shared")
+        assert first["statusCode"] == 200
+        assert second["statusCode"] == 200
+
+        # Readers keep writers out, and writers keep readers out
+        assert (
+            request("/acquire", "unheld_service", "unheld_lock", "exclusive")[
+                "statusCode"
+            ]
+            == 409
+        )
+        assert (
+            request("/acquire", "unheld_service", "held_lock", "shared")["statusCode"]
+            == 409
+        )
+
+        holders = ((first, "unheld_service"), (second, "held_service"))
+        for response, service_name in holders:
+            job_id = json.loads(response["body"])["ResponseMetadata"]["JobId"]
+            release = request("/release", service_name, "unheld_lock", "shared", job_id)
+            assert release["statusCode"] == 200
+
+            # A shared holder can only be released once
+            release = request("/release", service_name, "unheld_lock", "shared", job_id)
+            assert release["statusCode"] == 409
+
+        assert (
+            request("/acquire", "unheld_service", "unheld_lock", "exclusive")[
+                "statusCode"
+            ]
+            == 200
+        )
+
+    def test_shared_mode_on_expired_lock(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "expired_lock",
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+            "Mode": "shared",
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        resp = retrieve_tables_values("expired_lock", LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["HeldBy"]["S"] == ""
+        assert resp[0]["Item"]["ReaderCount"]["N"] == "1"
+
+    def test_shared_mode_lease(self, gateway_factory):
+        client = boto3.client("dynamodb")
+        lock_name = str(uuid.uuid4())
+        client.put_item(
+            TableName=self.lock_table_name,
+            Item={
+                "LockName": {"S": lock_name},
+                "HeldBy": {"S": ""},
+                "JobId": {"S": ""},
+            },
+        )
+
+        def request(path, service_name, mode, **options):
+            body = {
+                "ServiceName": service_name,
+                "LockName": lock_name,
+                "LockTableName": self.lock_table_name,
+                "ServiceTableName": self.service_table_name,
+                "LogTableName": self.log_table_name,
+                "Mode": mode,
+                **options,
+            }
+            return gateway_factory.handle_request(
+                method="POST",
+                path=path,
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+
+        crashed = request("/acquire", "unheld_service", "shared", LeaseDuration=60)
+        renewed = request("/acquire", "held_service", "shared", LeaseDuration=60)
+        assert crashed["statusCode"] == 200
+        assert renewed["statusCode"] == 200
+        crashed_job_id = json.loads(crashed["body"])["ResponseMetadata"]["JobId"]
+        renewed_job_id = json.loads(renewed["body"])["ResponseMetadata"]["JobId"]
+
+        # Each reader has a lease of its own, which only it can renew
+        renew = request(
+            "/renew", "held_service", "shared", JobId=renewed_job_id, LeaseDuration=60
+        )
+        assert renew["statusCode"] == 200
+        renew = request(
+            "/renew", "unheld_service", "shared", JobId=renewed_job_id, LeaseDuration=60
+        )
+        assert renew["statusCode"] == 409
+
+        # One reader's lease runs out. Only it is pruned, so the reader that
+        # renewed still keeps writers out.
+        client.update_item(
+            TableName=self.lock_table_name,
+            Key={"LockName": {"S": lock_name}},
+            UpdateExpression="SET Readers.#job_id.LeaseExpiry = :expired",
+            ExpressionAttributeNames={"#job_id": crashed_job_id},
+            ExpressionAttributeValues={":expired": {"N": "1"}},
+        )
+        assert request("/acquire", "unheld_service", "exclusive")["statusCode"] == 409
+        resp = retrieve_tables_values(lock_name, LOCK_TABLE_NAME)
+        assert list(resp[0]["Item"]["Readers"]["M"]) == [renewed_job_id]
+        assert resp[0]["Item"]["ReaderCount"]["N"] == "1"
+
+        # A lock whose readers have all run out can be deregistered
+        client.update_item(
+            TableName=self.lock_table_name,
+            Key={"LockName": {"S": lock_name}},
+            UpdateExpression="SET Readers.#job_id.LeaseExpiry = :expired",
+            ExpressionAttributeNames={"#job_id": renewed_job_id},
+            ExpressionAttributeValues={":expired": {"N": "1"}},
+        )
+        deregister = gateway_factory.handle_request(
+            method="POST",
+            path="/deregister_lock",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(
+                {"LockName": lock_name, "LockTableName": self.lock_table_name}
+            ),
+        )
+        assert deregister["statusCode"] == 200
+        assert "Item" not in retrieve_tables_values(lock_name, LOCK_TABLE_NAME)[0]
+
+    def test_hierarchical_locks(self, gateway_factory):
+        client = boto3.client("dynamodb")
+        repo = str(uuid.uuid4())
+        lock_names = [repo, repo + "/main", repo + "/release"]
+        for lock_name in lock_names:
+            client.put_item(
+                TableName=self.lock_table_name,
+                Item={
+                    "LockName": {"S": lock_name},
+                    "HeldBy": {"S": ""},
+                    "JobId": {"S": ""},
+                },
+            )
+
+        def request(path, lock_name, hierarchical, job_id=None):
+            body = {
+                "ServiceName": "unheld_service",
+                "LockName": lock_name,
+                "LockTableName": self.lock_table_name,
+                "ServiceTableName": self.service_table_name,
+                "LogTableName": self.log_table_name,
+                "Hierarchical": hierarchical,
+            }
+            if job_id is not None:
+                body["JobId"] = job_id
+            return gateway_factory.handle_request(
+                method="POST",
+                path=path,
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+
+        # Branches of one repository don't block each other
+        main = request("/acquire", repo + "/main", True)
+        release = request("/acquire", repo + "/release", True)
+        assert main["statusCode"] == 200
+        assert release["statusCode"] == 200
+
+        # The whole repository can't be locked while a branch is
+        assert request("/acquire", repo, False)["statusCode"] == 409
+
+        branches = ((main, repo + "/main"), (release, repo + "/release"))
+        for response, lock_name in branches:
+            job_id = json.loads(response["body"])["ResponseMetadata"]["JobId"]
+            assert request("/release", lock_name, True, job_id)["statusCode"] == 200
+
+        repo_lock = request("/acquire", repo, False)
+        assert repo_lock["statusCode"] == 200
+
+        # And no branch can be locked while the whole repository is
+        assert request("/acquire", repo + "/main", True)["statusCode"] == 409
+
+        for lock_name in lock_names:
+            client.delete_item(
+                TableName=self.lock_table_name, Key={"LockName": {"S": lock_name}}
+            )
+
+    def test_hierarchical_lock_with_expired_holder(self, gateway_factory):
+        client = boto3.client("dynamodb")
+        repo = str(uuid.uuid4())
+        for lock_name in [repo, repo + "/main", repo + "/release"]:
+            client.put_item(
+                TableName=self.lock_table_name,
+                Item={
+                    "LockName": {"S": lock_name},
+                    "HeldBy": {"S": ""},
+                    "JobId": {"S": ""},
+                },
+            )
+
+        def acquire(lock_name, **fields):
+            body = dict(
+                {
+                    "ServiceName": "unheld_service",
+                    "LockName": lock_name,
+                    "LockTableName": self.lock_table_name,
+                    "ServiceTableName": self.service_table_name,
+                },
+                **fields
+            )
+            return gateway_factory.handle_request(
+                method="POST",
+                path="/acquire",
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+
+        main = acquire(repo + "/main", Hierarchical=True, LeaseDuration=60)
+        release = acquire(repo + "/release", Hierarchical=True, LeaseDuration=60)
+        assert main["statusCode"] == 200
+        assert release["statusCode"] == 200
+        assert acquire(repo)["statusCode"] == 409
+
+        # Both marks run out, but only the holder of main crashed. The holder of
+        # release renewed its lease, which its mark doesn't show.
+        client.update_item(
+            TableName=self.lock_table_name,
+            Key={"LockName": {"S": repo}},
+            UpdateExpression="SET Intentions.#main.LeaseExpiry = :expired, Intentions.#release.LeaseExpiry = :expired",
+            ExpressionAttributeNames={
+                "#main": repo + "/main",
+                "#release": repo + "/release",
+            },
+            ExpressionAttributeValues={":expired": {"N": "1"}},
+        )
+        client.update_item(
+            TableName=self.lock_table_name,
+            Key={"LockName": {"S": repo + "/main"}},
+            UpdateExpression="SET LeaseExpiry = :expired",
+            ExpressionAttributeValues={":expired": {"N": "1"}},
+        )
+        assert acquire(repo)["statusCode"] == 409
+        resp = retrieve_tables_values(repo, LOCK_TABLE_NAME)
+        assert list(resp[0]["Item"]["Intentions"]["M"]) == [repo + "/release"]
+
+        # A release that doesn't repeat Hierarchical still clears the mark
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": repo + "/release",
+            "JobId": json.loads(release["body"])["ResponseMetadata"]["JobId"],
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+            "LockAcquireDateTime": "2020",
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        assert acquire(repo)["statusCode"] == 200
+
+        for lock_name in [repo, repo + "/main", repo + "/release"]:
+            client.delete_item(
+                TableName=self.lock_table_name, Key={"LockName": {"S": lock_name}}
+            )
+
+    def test_release_batch_hierarchical_lock(self, gateway_factory):
+        client = boto3.client("dynamodb")
+        repo = str(uuid.uuid4())
+        lock_names = [repo, repo + "/main", "unheld_lock_" + repo]
+        for lock_name in lock_names:
+            client.put_item(
+                TableName=self.lock_table_name,
+                Item={
+                    "LockName": {"S": lock_name},
+                    "HeldBy": {"S": ""},
+                    "JobId": {"S": ""},
+                },
+            )
+
+        def acquire(lock_name, **fields):
+            body = dict(
+                {
+                    "ServiceName": "unheld_service",
+                    "LockName": lock_name,
+                    "LockTableName": self.lock_table_name,
+                    "ServiceTableName": self.service_table_name,
+                },
+                **fields
+            )
+            return gateway_factory.handle_request(
+                method="POST",
+                path="/acquire",
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+
+        main = acquire(repo + "/main", Hierarchical=True)
+        other = acquire("unheld_lock_" + repo)
+        assert main["statusCode"] == 200
+        assert other["statusCode"] == 200
+
+        # A batch release clears the marks above a hierarchical lock, whatever it says
+        body = {
+            "ServiceName": "unheld_service",
+            "Locks": [
+                {
+                    "LockName": repo + "/main",
+                    "JobId": json.loads(main["body"])["ResponseMetadata"]["JobId"],
+                },
+                {
+                    "LockName": "unheld_lock_" + repo,
+                    "JobId": json.loads(other["body"])["ResponseMetadata"]["JobId"],
+                },
+            ],
+            "LockTableName": self.lock_table_name,
+            "LogTableName": self.log_table_name,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/release_batch",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        resp = retrieve_tables_values(repo, LOCK_TABLE_NAME)
+        assert resp[0]["Item"]["Intentions"]["M"] == {}
+        assert acquire(repo)["statusCode"] == 200
+
+        for lock_name in lock_names:
+            client.delete_item(
+                TableName=self.lock_table_name, Key={"LockName": {"S": lock_name}}
+            )
+
+    def test_hierarchical_lock_without_ancestor(self, gateway_factory):
+        client = boto3.client("dynamodb")
+        lock_name = str(uuid.uuid4()) + "/main"
+        client.put_item(
+            TableName=self.lock_table_name,
+            Item={
+                "LockName": {"S": lock_name},
+                "HeldBy": {"S": ""},
+                "JobId": {"S": ""},
+            },
+        )
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": lock_name,
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+            "Hierarchical": True,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 409
+
+        # Acquiring a hierarchical lock never registers its ancestors
+        ancestor_name = lock_name.split("/")[0]
+        assert retrieve_tables_values(ancestor_name, LOCK_TABLE_NAME) == [{}]
+
+        client.delete_item(
+            TableName=self.lock_table_name, Key={"LockName": {"S": lock_name}}
+        )
+
+    def test_hierarchical_lock_with_empty_level(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "unheld_lock//main",
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+            "Hierarchical": True,
+        }
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 400
+
+    @pytest.mark.parametrize(
+        "extra_fields",
+        [
+            {"Mode": "unknown"},
+            {"Mode": "semaphore", "Priority": 1},
+            {"Mode": "shared", "Priority": 1},
+            {"Priority": -1},
+            {"Priority": "high"},
+            {"Mode": "shared", "IdempotencyKey": "acquire-1"},
+            {"IdempotencyKey": ""},
+        ],
+    )
+    def test_acquire_with_invalid_mode(self, gateway_factory, extra_fields):
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": "unheld_lock",
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+        }
+        body.update(extra_fields)
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/acquire",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 400
+
+    def test_deregister_lock_held_by_a_service(self, gateway_factory):
+        body = {"LockName": "held_lock", "LockTableName": self.lock_table_name}
+
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/deregister_lock",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 409
+        assert json.loads(response["body"])["Message"] == "Unable to deregister a lock"
+
+    def test_deregister_lock_not_held_by_a_service(self, gateway_factory):
+        body = {"LockName": "unheld_lock", "LockTableName": self.lock_table_name}
+
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/deregister_lock",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        actual = json.loads(response["body"])
+        expected = "Deregistered Lock: %s" % body["LockName"]
+        assert actual["ResponseMetadata"]["Message"] == expected
+
+    def test_deregister_service_holding_lock(self, gateway_factory):
+        body = {
+            "ServiceName": "held_service",
+            "ServiceTableName": self.service_table_name,
+        }
+
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/deregister_service",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        actual = json.loads(response["body"])
+        expected = "Deregistered Service: %s" % body["ServiceName"]
+        assert actual["ResponseMetadata"]["Message"] == expected
+
+    def test_deregister_service_not_holding_lock(self, gateway_factory):
+        body = {
+            "ServiceName": "unheld_service",
+            "ServiceTableName": self.service_table_name,
+        }
+
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/deregister_service",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
+        )
+        assert response["statusCode"] == 200
+        actual = json.loads(response["body"])
+        expected = "Deregistered Service: %s" % body["ServiceName"]
+        assert actual["ResponseMetadata"]["Message"] == expected
+
+    def test_deregister_nonexistant_lock(self, gateway_factory):
+        body = {"LockName": "doesn't exist", "LockTableName": self.lock_table_name}
+        response = gateway_factory.handle_request(
+            method="POST",
+            path="/deregister_lock",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(body),
         )
 
         assert response["statusCode"] == 409
         assert json.loads(response["body"])["Message"] == "Unable to deregister a lock"
 
+    def test_service_registry_cache(self, gateway_factory):
+        client = boto3.client("dynamodb")
+
+        def acquire(lock_name):
+            body = {
+                "ServiceName": "unheld_service",
+                "LockName": lock_name,
+                "LockTableName": self.lock_table_name,
+                "ServiceTableName": self.service_table_name,
+            }
+            return gateway_factory.handle_request(
+                method="POST",
+                path="/acquire",
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+
+        def deregister():
+            body = {
+                "ServiceName": "unheld_service",
+                "ServiceTableName": self.service_table_name,
+            }
+            return gateway_factory.handle_request(
+                method="POST",
+                path="/deregister_service",
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+
+        # A failed acquire still shows the service is registered
+        assert acquire("held_lock")["statusCode"] == 409
+        assert api.service_registry.contains(self.service_table_name, "unheld_service")
+
+        # The cached service isn't looked up again
+        client.delete_item(
+            TableName=self.service_table_name,
+            Key={"ServiceName": {"S": "unheld_service"}},
+        )
+        assert acquire("unheld_lock")["statusCode"] == 200
+
+        # Deregistering forgets it
+        client.put_item(
+            TableName=self.service_table_name,
+            Item={"ServiceName": {"S": "unheld_service"}},
+        )
+        assert deregister()["statusCode"] == 200
+        response = acquire("unheld_lock_2")
+        assert response["statusCode"] == 400
+        assert json.loads(response["body"])["Message"] == "Service doesn't exist"
+
+    def test_acquire_single_write(self, gateway_factory):
+        lock_name = str(uuid.uuid4())
+        boto3.client("dynamodb").put_item(
+            TableName=self.lock_table_name,
+            Item={
+                "LockName": {"S": lock_name},
+                "HeldBy": {"S": ""},
+                "JobId": {"S": ""},
+            },
+        )
+        api.service_registry.add(self.service_table_name, "unheld_service")
+        operations = []
+
+        def record(model, **kwargs):
+            operations.append(model.name)
+
+        client = api.SingletonDynamoDBClient.getInstance()
+        client.meta.events.register("before-call.dynamodb", record)
+        body = {
+            "ServiceName": "unheld_service",
+            "LockName": lock_name,
+            "LockTableName": self.lock_table_name,
+            "ServiceTableName": self.service_table_name,
+        }
+        try:
+            # A cached service gets the lock and its fencing token in one update
+            response = gateway_factory.handle_request(
+                method="POST",
+                path="/acquire",
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+            assert response["statusCode"] == 200
+            assert json.loads(response["body"])["ResponseMetadata"]["FencingToken"] == 1
+            assert operations == ["UpdateItem"]
+
+            # A failed one still reads the lock row, to clear stale marks on it
+            response = gateway_factory.handle_request(
+                method="POST",
+                path="/acquire",
+                headers={"Content-Type": "application/json"},
+                body=json.dumps(body),
+            )
+            assert response["statusCode"] == 409
+            assert operations == ["UpdateItem", "UpdateItem", "GetItem"]
+        finally:
+            client.meta.events.unregister("before-call.dynamodb", record)
+            boto3.client("dynamodb").delete_item(
+                TableName=self.lock_table_name, Key={"LockName": {"S": lock_name}}
+            )
+
     def test_deregister_nonexistant_service(self, gateway_factory):
         body = {
             "ServiceName": "doesn't exist",
@@ -0,0 +1,178 @@
+import asyncio
+import gzip
+import json
+import pytest
+
+from unittest import mock
+
+from Sling.chalicelib.async_state_manager import (
+    AsyncLockClient,
+    AsyncResponse,
+    RequestNotSentError,
+    read_response,
+)
+from Sling.chalicelib.state_manager import LockNotAcquiredError
+
+
+def read(data):
+    async def feed_and_read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await read_response(reader)
+
+    return asyncio.run(feed_and_read())
+
+
+@pytest.mark.parametrize(
+    "data, expected_content, expected_keep_alive",
+    [
+        (
+            b"HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\n{\"Code\": 1}",
+            b'{"Code": 1}',
+            True,
+        ),
+        (
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"5\r\n{\"Cod\r\n6\r\ne\": 1}\r\n0\r\n\r\n",
+            b'{"Code": 1}',
+            True,
+        ),
+        (
+            b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 11\r\n\r\n{\"Code\": 1}",
+            b'{"Code": 1}',
+            False,
+        ),
+        (b"HTTP/1.0 200 OK\r\n\r\n{\"Code\": 1}", b'{"Code": 1}', False),
+        (
+            b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nContent-Length: 31\r\n\r\n"
+            + gzip.compress(b'{"Code": 1}', mtime=0),
+            b'{"Code": 1}',
+            True,
+        ),
+        (
+            b"HTTP/1.1 100 Continue\r\n\r\n"
+            b"HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\n{\"Code\": 1}",
+            b'{"Code": 1}',
+            True,
+        ),
+        (b"HTTP/1.1 204 No Content\r\n\r\n", b"", True),
+    ],
+)
+def test_read_response(data, expected_content, expected_keep_alive):
+    response, keep_alive = read(data)
+    assert response.status_code in (200, 204)
+    assert response.content == expected_content
+    assert keep_alive == expected_keep_alive
+
+
+def mock_response(status_code, body):
+    return AsyncResponse(status_code, {}, json.dumps(body).encode("utf-8"))
+
+
+def test_acquire_many_releases_on_failure():
+    client = AsyncLockClient(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "unheld_service",
+        "LockTable",
+        "RegisteredServices",
+        "LogTable",
+    )
+    posts = []
+
+    async def post(route, params, **options):
+        posts.append((route, params))
+        if route == "acquire" and params["LockName"] == "held_lock":
+            return mock_response(409, {"Message": "Unable to acquire a lock"})
+        metadata = {"JobId": params["LockName"] + "_job"}
+        return mock_response(200, {"ResponseMetadata": metadata})
+
+    client.post = post
+    with pytest.raises(LockNotAcquiredError):
+        asyncio.run(client.acquire_many(["unheld_lock", "held_lock", "unheld_lock_2"]))
+
+    # Only the locks that were acquired are given back
+    released = sorted(params["JobId"] for route, params in posts if route == "release")
+    assert released == ["unheld_lock_2_job", "unheld_lock_job"]
+
+    posts.clear()
+    results = asyncio.run(
+        client.acquire_many(["unheld_lock", "held_lock"], return_exceptions=True)
+    )
+    assert results[0] == {"JobId": "unheld_lock_job"}
+    assert isinstance(results[1], LockNotAcquiredError)
+    assert all(route == "acquire" for route, params in posts)
+
+
+def send_to_dropping_server(make_request, max_attempts=3):
+    """Sends a request to a server that reads each request and closes the connection.
+
+    Returns the error the client raised and how many requests reached the server.
+    """
+
+    requests_read = []
+
+    async def drop(reader, writer):
+        requests_read.append(await reader.readuntil(b"\r\n\r\n"))
+        writer.close()
+
+    async def send():
+        server = await asyncio.start_server(drop, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        client = AsyncLockClient(
+            "http://127.0.0.1:%s/api/" % port,
+            "unheld_service",
+            "LockTable",
+            "RegisteredServices",
+            "LogTable",
+            max_attempts=max_attempts,
+            backoff_base=0,
+        )
+        try:
+            with pytest.raises(Exception) as error:
+                await make_request(client)
+        finally:
+            client.close()
+            server.close()
+            await server.wait_closed()
+        return error.value
+
+    return asyncio.run(send()), len(requests_read)
+
+
+@mock.patch.dict("os.environ", {"NO_PROXY": "*"})
+def test_async_lock_client_retries_like_lock_client():
+    # An exclusive release carries an idempotency key, so a lost response is resent
+    error, sent = send_to_dropping_server(
+        lambda client: client.release("held_lock", {"JobId": "101"})
+    )
+    assert sent == 3
+
+    # A semaphore acquire that was written and may have gone through isn't
+    error, sent = send_to_dropping_server(
+        lambda client: client.acquire("semaphore_lock", mode="semaphore")
+    )
+    assert not isinstance(error, RequestNotSentError)
+    assert sent == 1
+
+
+def test_async_lock_client_resends_requests_that_were_never_written():
+    client = AsyncLockClient(
+        "http://127.0.0.1:1/api/",
+        "unheld_service",
+        "LockTable",
+        "RegisteredServices",
+        "LogTable",
+        max_attempts=3,
+    )
+    attempts = []
+
+    async def refuse(*args):
+        attempts.append(args)
+        raise RequestNotSentError("Unable to connect")
+
+    client.pool.post = refuse
+    with mock.patch("asyncio.sleep", new=mock.AsyncMock()):
+        with pytest.raises(RequestNotSentError):
+            asyncio.run(client.acquire("semaphore_lock", mode="semaphore"))
+    assert len(attempts) == 3
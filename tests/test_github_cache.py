@@ -0,0 +1,73 @@
+import json
+import requests
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from Sling.chalicelib.github_cache import ConditionalRequestAdapter, FileResponseCache
+
+
+class PullRequestsHandler(BaseHTTPRequestHandler):
+    """Serves a fixed pull request list, answering revalidations with a 304."""
+
+    etag = '"v1"'
+    body = json.dumps([{"number": 1}]).encode("utf-8")
+    not_modified = 0
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == self.etag:
+            PullRequestsHandler.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", self.etag)
+            self.send_header("X-RateLimit-Remaining", "4999")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.send_header("ETag", self.etag)
+        self.send_header("X-RateLimit-Remaining", "5000")
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_conditional_requests(tmp_path):
+    server = HTTPServer(("127.0.0.1", 0), PullRequestsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%s/" % server.server_port
+    cache_path = str(tmp_path / "github_cache.json")
+
+    try:
+        session = requests.Session()
+        session.mount(url, ConditionalRequestAdapter(FileResponseCache(cache_path, 10)))
+        assert session.get(url + "pulls").json() == [{"number": 1}]
+        assert PullRequestsHandler.not_modified == 0
+
+        response = session.get(url + "pulls")
+        assert response.status_code == 200
+        assert response.json() == [{"number": 1}]
+        assert response.headers["X-RateLimit-Remaining"] == "4999"
+        assert PullRequestsHandler.not_modified == 1
+        session.adapters[url].cache.save()
+
+        # A new session, as in the next invocation, revalidates from the saved file
+        session = requests.Session()
+        session.mount(url, ConditionalRequestAdapter(FileResponseCache(cache_path, 10)))
+        assert session.get(url + "pulls").json() == [{"number": 1}]
+        assert PullRequestsHandler.not_modified == 2
+    finally:
+        server.shutdown()
+
+
+def test_file_response_cache_evicts(tmp_path):
+    cache = FileResponseCache(str(tmp_path / "github_cache.json"), 2)
+    cache.set("a", {"etag": "1"})
+    cache.set("b", {"etag": "2"})
+    cache.get("a")
+    cache.set("c", {"etag": "3"})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"etag": "1"}
+    assert cache.get("c") == {"etag": "3"}
@@ -0,0 +1,29 @@
+from Sling.chalicelib.import_report import import_times, parse_import_times, report
+
+
+IMPORTTIME_OUTPUT = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _json
+import time:       850 |        970 | json
+import time:      2000 |       2970 | app
+"""
+
+
+def test_parse_import_times():
+    times = parse_import_times(IMPORTTIME_OUTPUT)
+    assert times == [("_json", 120, 120), ("json", 850, 970), ("app", 2000, 2970)]
+
+    text, total_ms = report("lockapi", times, top=1)
+    assert total_ms == 2.97
+    assert text.splitlines()[0] == "lockapi: 3.0 ms over 3 modules"
+    assert text.splitlines()[1].endswith("app")
+
+
+def test_lock_api_skips_bot_dependencies():
+    modules = {module for module, _, _ in import_times("lockapi")}
+    assert "chalicelib.api" in modules
+    assert "chalicelib.prmbot" not in modules
+    assert not modules & {"github3", "requests"}
+
+    modules = {module for module, _, _ in import_times("prmbot")}
+    assert "chalicelib.prmbot" in modules
+    assert not modules & {"chalicelib.api", "github3", "requests"}
@@ -1,5 +1,12 @@
+import hashlib
+import hmac
+import json
 import pytest
 import github3
+import requests
+from chalice.config import Config
+from chalice.local import LocalGateway
+from datetime import datetime, timezone
 from unittest.mock import MagicMock
 
 from Sling.chalicelib.prmbot import (
@@ -8,8 +15,15 @@ from Sling.chalicelib.prmbot import (
     has_valid_label,
     has_valid_review,
     get_mergeable_pr,
+    get_mergeable_pr_graphql,
+    GraphQLError,
     merge_pull_req,
 )
+from Sling.chalicelib import prmbot, state_manager
+from Sling.chalicelib.scan_cursor import ScanCursor
+from Sling.chalicelib.state_manager import LockNotAcquiredError
+
+from .conftest import app
 
 
 def test_invalid_config_path():
@@ -162,3 +176,325 @@ def test_get_mergeable_pr(review_list, config, expected, make_review_list):
         mergeable_id.append(pull_req.id)
 
     assert mergeable_id == expected
+
+
+@pytest.mark.parametrize("review_workers", [1, 4])
+def test_get_mergeable_pr_with_failed_reviews(review_workers, make_review_list):
+    review_list = make_review_list(
+        [
+            {
+                "pr_id": "%05d" % i,
+                "pr_labels": [{"name": "mergeable"}],
+                "reviews_info": [("OWNER", "APPROVED")],
+            }
+            for i in range(10)
+        ]
+    )
+    review_list[3].reviews.side_effect = requests.exceptions.ConnectionError(
+        "Connection reset"
+    )
+    config = {"merge_label": "mergeable", "review_workers": review_workers}
+
+    mergeable_id = [pull_req.id for pull_req in get_mergeable_pr(review_list, config)]
+    assert mergeable_id == ["%05d" % i for i in range(10) if i != 3]
+
+
+def graphql_page(nodes, end_cursor=None):
+    response = MagicMock()
+    response.json.return_value = {
+        "data": {
+            "repository": {
+                "pullRequests": {
+                    "pageInfo": {
+                        "hasNextPage": end_cursor is not None,
+                        "endCursor": end_cursor,
+                    },
+                    "nodes": nodes,
+                }
+            }
+        }
+    }
+    return response
+
+
+def graphql_reviews(reviews, end_cursor=None):
+    return {
+        "pageInfo": {"hasNextPage": end_cursor is not None, "endCursor": end_cursor},
+        "nodes": [
+            {"authorAssociation": author_association, "state": state}
+            for author_association, state in reviews
+        ],
+    }
+
+
+def graphql_node(number, reviews, end_cursor=None):
+    return {
+        "number": number,
+        "databaseId": 1000 + number,
+        "reviews": graphql_reviews(reviews, end_cursor),
+    }
+
+
+def test_get_mergeable_pr_graphql():
+    github_client = MagicMock()
+    github_client.session.post.side_effect = [
+        graphql_page(
+            [
+                graphql_node(1, [("OWNER", "APPROVED")]),
+                graphql_node(2, [("NONE", "APPROVED")]),
+            ],
+            end_cursor="page_2",
+        ),
+        graphql_page(
+            [
+                # Every review counts, as it does over REST, so an approval
+                # stands even if the same member later requested changes
+                graphql_node(3, [("MEMBER", "APPROVED"), ("MEMBER", "CHANGES_REQUESTED")]),
+                graphql_node(4, [("MEMBER", "CHANGES_REQUESTED"), ("MEMBER", "APPROVED")]),
+                graphql_node(5, [("MEMBER", "COMMENTED")]),
+            ]
+        ),
+    ]
+    repository = MagicMock()
+    repository.pull_request.side_effect = lambda number: "pull_request_%s" % number
+    config = {"repo_owner": "owner", "repo_name": "repo", "merge_label": "mergeable"}
+
+    mergeable_pr = get_mergeable_pr_graphql(github_client, repository, config)
+    assert mergeable_pr == ["pull_request_1", "pull_request_3", "pull_request_4"]
+
+    # The label is filtered by GitHub and the second page starts at the first's cursor
+    first_query, second_query = [
+        call.kwargs["json"]["variables"]
+        for call in github_client.session.post.call_args_list
+    ]
+    assert first_query["labels"] == ["mergeable"]
+    assert first_query["cursor"] is None
+    assert second_query["cursor"] == "page_2"
+
+
+def test_get_mergeable_pr_graphql_review_pages():
+    review_page = MagicMock()
+    review_page.json.return_value = {
+        "data": {
+            "repository": {
+                "pullRequest": {"reviews": graphql_reviews([("OWNER", "APPROVED")])}
+            }
+        }
+    }
+    github_client = MagicMock()
+    github_client.session.post.side_effect = [
+        graphql_page([graphql_node(1, [("NONE", "COMMENTED")], end_cursor="reviews_2")]),
+        review_page,
+    ]
+    repository = MagicMock()
+    repository.pull_request.side_effect = lambda number: "pull_request_%s" % number
+    config = {"repo_owner": "owner", "repo_name": "repo", "merge_label": "mergeable"}
+
+    mergeable_pr = get_mergeable_pr_graphql(github_client, repository, config)
+    assert mergeable_pr == ["pull_request_1"]
+
+    # The approval is on the second page of reviews, which starts at the first's cursor
+    review_query = github_client.session.post.call_args_list[1].kwargs["json"]
+    assert review_query["variables"]["number"] == 1
+    assert review_query["variables"]["cursor"] == "reviews_2"
+
+
+def test_get_mergeable_pr_graphql_errors():
+    github_client = MagicMock()
+    github_client.session.post.return_value.json.return_value = {
+        "errors": [{"message": "Could not resolve to a Repository"}]
+    }
+    config = {"repo_owner": "owner", "repo_name": "repo", "merge_label": "mergeable"}
+
+    with pytest.raises(GraphQLError):
+        get_mergeable_pr_graphql(github_client, MagicMock(), config)
+
+
+def test_get_mergeable_pr_with_scan_cursor(make_review_list, tmp_path):
+    cursor_path = str(tmp_path / "scan_cursor.json")
+    config = {"merge_label": "mergeable", "review_workers": 1}
+
+    def list_pull_requests(updated_days, head_shas):
+        review_list = make_review_list(
+            [
+                {
+                    "pr_id": "%05d" % i,
+                    "pr_labels": [{"name": "mergeable"}],
+                    "reviews_info": [("OWNER", "APPROVED")] if i % 2 else [],
+                }
+                for i in range(4)
+            ]
+        )
+        for i, pull_req in enumerate(review_list):
+            pull_req.number = i
+            pull_req.updated_at = datetime(2020, 1, updated_days[i], tzinfo=timezone.utc)
+            pull_req.head = MagicMock(sha=head_shas[i])
+        return review_list
+
+    review_list = list_pull_requests([1, 2, 3, 4], ["a", "b", "c", "d"])
+    scan_cursor = ScanCursor(cursor_path, "owner/repo")
+    mergeable_pr = get_mergeable_pr(review_list, config, scan_cursor)
+    assert [pull_req.id for pull_req in mergeable_pr] == ["00001", "00003"]
+    scan_cursor.save()
+
+    # Only the pull request with a new commit, and the one updated at the cursor,
+    # have their reviews fetched again
+    review_list = list_pull_requests([1, 2, 4, 4], ["a", "b2", "c", "d"])
+    scan_cursor = ScanCursor(cursor_path, "owner/repo")
+    mergeable_pr = get_mergeable_pr(review_list, config, scan_cursor)
+    assert [pull_req.id for pull_req in mergeable_pr] == ["00001", "00003"]
+    assert [pull_req.reviews.called for pull_req in review_list] == [
+        False,
+        True,
+        True,
+        True,
+    ]
+
+
+WEBHOOK_SECRET = "webhook_secret"
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    """Posts webhook events to the bot, with GitHub and the lock API mocked out."""
+
+    monkeypatch.setattr(
+        prmbot,
+        "get_secret",
+        lambda secret_name, region_name: {
+            "github_username": "user",
+            "github_password": "password",
+            "webhook_secret": WEBHOOK_SECRET,
+        },
+    )
+    github_client = MagicMock()
+    monkeypatch.setattr(github3, "login", lambda *args, **kwargs: github_client)
+    merged = []
+
+    def merge_with_lock(mergeable_pr, config, wait=True):
+        # The webhook must not wait for the lock, or GitHub gives up on the delivery
+        assert not wait
+        merged.extend(mergeable_pr)
+        return post.failure
+
+    monkeypatch.setattr(prmbot, "merge_with_lock", merge_with_lock)
+    gateway = LocalGateway(app, Config())
+
+    def post(event, payload, secret=WEBHOOK_SECRET):
+        body = json.dumps(payload)
+        signature = hmac.new(
+            secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+        response = gateway.handle_request(
+            method="POST",
+            path="/webhook",
+            headers={
+                "Content-Type": "application/json",
+                "X-GitHub-Event": event,
+                "X-Hub-Signature-256": "sha256=" + signature,
+            },
+            body=body,
+        )
+        return response["statusCode"], json.loads(response["body"])
+
+    post.github_client = github_client
+    post.merged = merged
+    post.failure = None
+    return post
+
+
+def pull_request_event(labels, state="open"):
+    return {
+        "action": "submitted",
+        "repository": {"full_name": "jadeknightjr/dumpy"},
+        "pull_request": {
+            "number": 7,
+            "state": state,
+            "labels": [{"name": label} for label in labels],
+        },
+    }
+
+
+def test_webhook_rejects_invalid_signature(webhook):
+    status, body = webhook("ping", {}, secret="wrong_secret")
+    assert status == 401
+    assert webhook("ping", {}) == (200, {"Message": "pong"})
+
+
+def test_webhook_skips_unlabelled_pull_request(webhook):
+    status, body = webhook("pull_request", pull_request_event(["bugs"]))
+    assert status == 200
+    assert not webhook.github_client.repository.called
+    assert webhook.merged == []
+
+
+@pytest.mark.parametrize(
+    "review_state, expected_merged", [("APPROVED", 1), ("COMMENTED", 0)]
+)
+def test_webhook_merges_approved_pull_request(webhook, review_state, expected_merged):
+    pull_req = MagicMock(spec=github3.pulls.ShortPullRequest, id=7)
+    pull_req.reviews = MagicMock(
+        return_value=[
+            MagicMock(
+                spec=github3.pulls.ReviewComment,
+                author_association="OWNER",
+                state=review_state,
+            )
+        ]
+    )
+    webhook.github_client.repository.return_value.pull_request.return_value = pull_req
+
+    status, body = webhook(
+        "pull_request_review", pull_request_event(["mergeable"])
+    )
+    assert status == 200
+    webhook.github_client.repository.return_value.pull_request.assert_called_with(7)
+    assert webhook.merged == [pull_req] * expected_merged
+
+
+def test_webhook_reports_failed_merge(webhook):
+    pull_req = MagicMock(spec=github3.pulls.ShortPullRequest, id=7)
+    pull_req.reviews = MagicMock(
+        return_value=[
+            MagicMock(
+                spec=github3.pulls.ReviewComment,
+                author_association="OWNER",
+                state="APPROVED",
+            )
+        ]
+    )
+    webhook.github_client.repository.return_value.pull_request.return_value = pull_req
+    webhook.failure = {"message": "Failed to acquire lock: lock_name", "status_code": 409}
+
+    status, body = webhook("pull_request_review", pull_request_event(["mergeable"]))
+    assert status == 409
+    assert body == {"Message": "Failed to acquire lock: lock_name"}
+
+
+def test_merge_with_lock_reports_held_lock(monkeypatch):
+    clients = []
+
+    class HeldLockClient:
+        def __init__(self, *args, **kwargs):
+            clients.append(kwargs)
+
+        def lock(self, lock_name, **acquire_options):
+            assert acquire_options["wait_timeout"] is None
+            raise LockNotAcquiredError("Unable to acquire lock: %s" % lock_name, None)
+
+    monkeypatch.setattr(state_manager, "LockClient", HeldLockClient)
+    config = {
+        "service_name": "service",
+        "lock_name": "lock_name",
+        "lock_table_name": "locks",
+        "service_table_name": "services",
+        "log_table_name": "logs",
+        "acquire_wait_timeout": 30,
+        "api_route": "https://example.com/api/",
+    }
+    pull_req = MagicMock(number=7)
+
+    failure = prmbot.merge_with_lock([pull_req], config, wait=False)
+    assert failure["status_code"] == 409
+    assert clients[0]["max_attempts"] == 1
+    assert not pull_req.merge.called
@@ -0,0 +1,201 @@
+import asyncio
+import os
+import pytest
+import requests
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from Sling.chalicelib.async_state_manager import AsyncLockClient
+from Sling.chalicelib.server import accepts_gzip
+from Sling.chalicelib.state_manager import (
+    LockClient,
+    LockNotAcquiredError,
+    state_manager_acquire,
+    state_manager_release,
+)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Tables the server's default config names
+LOCK_TABLE_NAME = "SlingLockTable"
+SERVICE_TABLE_NAME = "SlingRegisteredServices"
+LOG_TABLE_NAME = "SlingLogTable"
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    """Runs the standalone server on a memory backend in its own process."""
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = dict(os.environ, STORAGE_BACKEND="memory")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "chalicelib.server", "--port", str(port)],
+        cwd=REPO_ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = "http://127.0.0.1:%s/" % port
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                pytest.fail("Server didn't start")
+            time.sleep(0.05)
+
+    for path, body in [
+        (
+            "register_service",
+            {"ServiceName": "served_service", "ServiceTableName": SERVICE_TABLE_NAME},
+        ),
+        ("register_lock", {"LockName": "served_lock", "LockTableName": LOCK_TABLE_NAME}),
+    ]:
+        assert requests.post(url + path, json=body).status_code == 200
+
+    yield url
+    process.terminate()
+    process.wait()
+
+
+def test_server_acquire_and_release(server_url):
+    args = ("served_service", "served_lock", LOCK_TABLE_NAME, SERVICE_TABLE_NAME)
+    response = state_manager_acquire(server_url, *args)
+    assert response.status_code == 200
+    acquired = response.json()["ResponseMetadata"]
+
+    assert state_manager_acquire(server_url, *args).status_code == 409
+
+    response = state_manager_release(
+        server_url,
+        "served_service",
+        "served_lock",
+        acquired["JobId"],
+        LOCK_TABLE_NAME,
+        LOG_TABLE_NAME,
+        acquired["LockAcquireDateTime"],
+        acquired["FencingToken"],
+    )
+    assert response.status_code == 200
+
+
+def test_server_concurrent_acquires(server_url):
+    args = ("served_service", "served_lock", LOCK_TABLE_NAME, SERVICE_TABLE_NAME)
+    responses = []
+
+    def acquire():
+        responses.append(state_manager_acquire(server_url, *args))
+
+    threads = [threading.Thread(target=acquire) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Requests served on different threads each see their own body
+    assert sorted(response.status_code for response in responses) == [200] + [409] * 7
+
+
+def test_server_lock_client(server_url):
+    body = {"LockName": "client_lock", "LockTableName": LOCK_TABLE_NAME}
+    assert requests.post(server_url + "register_lock", json=body).status_code == 200
+
+    with LockClient(
+        server_url,
+        "served_service",
+        LOCK_TABLE_NAME,
+        SERVICE_TABLE_NAME,
+        LOG_TABLE_NAME,
+        max_attempts=2,
+        compact_responses=True,
+    ) as client:
+        with client.lock("client_lock", lease_duration=60) as acquired:
+            assert "HTTPHeaders" not in acquired
+            with pytest.raises(LockNotAcquiredError):
+                client.acquire("client_lock")
+        with client.lock("client_lock"):
+            pass
+
+
+def test_server_async_lock_client(server_url):
+    lock_names = ["async_lock_%s" % i for i in range(20)]
+
+    async def run():
+        async with AsyncLockClient(
+            server_url,
+            "async_service",
+            LOCK_TABLE_NAME,
+            SERVICE_TABLE_NAME,
+            LOG_TABLE_NAME,
+            max_attempts=2,
+            max_connections=8,
+            compact_responses=True,
+        ) as client:
+            await client.register_service()
+            await asyncio.gather(*[client.register_lock(name) for name in lock_names])
+
+            acquired = await client.acquire_many(lock_names, lease_duration=60)
+            assert len({metadata["JobId"] for metadata in acquired}) == len(lock_names)
+            with pytest.raises(LockNotAcquiredError):
+                await client.acquire(lock_names[0])
+            await asyncio.gather(
+                *[
+                    client.release(name, metadata)
+                    for name, metadata in zip(lock_names, acquired)
+                ]
+            )
+
+            async with client.lock(lock_names[0]) as metadata:
+                assert "JobId" in metadata
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        ("gzip, deflate", True),
+        ("br;q=1.0, GZIP;q=0.5", True),
+        ("*", True),
+        ("gzip;q=0", False),
+        ("identity", False),
+        ("", False),
+    ],
+)
+def test_accepts_gzip(accept_encoding, expected):
+    assert accepts_gzip(accept_encoding) == expected
+
+
+def test_server_gzips_large_responses(server_url):
+    lock_names = ["batch_lock_%s" % i for i in range(40)]
+    for lock_name in lock_names:
+        body = {"LockName": lock_name, "LockTableName": LOCK_TABLE_NAME}
+        assert requests.post(server_url + "register_lock", json=body).status_code == 200
+
+    body = {
+        "ServiceName": "served_service",
+        "LockNames": lock_names,
+        "LockTableName": LOCK_TABLE_NAME,
+        "ServiceTableName": SERVICE_TABLE_NAME,
+    }
+    response = requests.post(
+        server_url + "acquire_batch",
+        json=body,
+        headers={"X-Sling-Response-Format": "compact"},
+    )
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert sorted(response.json()["ResponseMetadata"]["JobIds"]) == sorted(lock_names)
+
+    # Small responses aren't worth compressing
+    body = {"LockName": lock_names[0], "LockTableName": LOCK_TABLE_NAME}
+    response = requests.post(server_url + "lock_status", json=body)
+    assert "Content-Encoding" not in response.headers
@@ -1,8 +1,17 @@
+import pytest
+import requests
+
 from unittest import mock
 
 from Sling.chalicelib.state_manager import (
+    LockClient,
+    LockClientError,
+    LockNotAcquiredError,
     state_manager_acquire,
+    state_manager_acquire_wait,
+    state_manager_enqueue,
     state_manager_release,
+    state_manager_renew,
 )
 
 
@@ -50,3 +59,270 @@ def test_state_manager_release(mocked_request):
         url="https://api_route.execute-api.us-west-2.amazonaws.com/api/release",
         json=params,
     )
+
+
+@mock.patch("requests.post")
+def test_state_manager_release_with_acquire_date_time(mocked_request):
+    # The acquire time is only sent when the caller has it
+    resp = state_manager_release(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "unheld_service",
+        "unheld_lock",
+        "001",
+        "LockTable",
+        "LogTable",
+        "2020-06-03 10:07:18",
+    )
+    params = {
+        "LockName": "unheld_lock",
+        "ServiceName": "unheld_service",
+        "JobId": "001",
+        "LockTableName": "LockTable",
+        "LogTableName": "LogTable",
+        "LockAcquireDateTime": "2020-06-03 10:07:18",
+    }
+    mocked_request.assert_called_once_with(
+        url="https://api_route.execute-api.us-west-2.amazonaws.com/api/release",
+        json=params,
+    )
+
+
+@mock.patch("requests.post")
+def test_state_manager_renew(mocked_request):
+    # Test parameters are correct
+    resp = state_manager_renew(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "unheld_service",
+        "unheld_lock",
+        "001",
+        "LockTable",
+        60,
+    )
+    params = {
+        "LockName": "unheld_lock",
+        "ServiceName": "unheld_service",
+        "JobId": "001",
+        "LockTableName": "LockTable",
+        "LeaseDuration": 60,
+    }
+    mocked_request.assert_called_once_with(
+        url="https://api_route.execute-api.us-west-2.amazonaws.com/api/renew",
+        json=params,
+    )
+
+    # Shared holders say so, since their lease is kept apart
+    mocked_request.reset_mock()
+    state_manager_renew(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "unheld_service",
+        "unheld_lock",
+        "001",
+        "LockTable",
+        60,
+        mode="shared",
+    )
+    mocked_request.assert_called_once_with(
+        url="https://api_route.execute-api.us-west-2.amazonaws.com/api/renew",
+        json={**params, "Mode": "shared"},
+    )
+
+
+@mock.patch("requests.post")
+def test_state_manager_acquire_wait(mocked_request):
+    # Test parameters are correct
+    resp = state_manager_acquire_wait(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "unheld_service",
+        "unheld_lock",
+        "LockTable",
+        "RegisteredServices",
+        20,
+    )
+    params = {
+        "LockName": "unheld_lock",
+        "ServiceName": "unheld_service",
+        "LockTableName": "LockTable",
+        "ServiceTableName": "RegisteredServices",
+        "WaitTimeout": 20,
+    }
+    mocked_request.assert_called_once_with(
+        url="https://api_route.execute-api.us-west-2.amazonaws.com/api/acquire_wait",
+        json=params,
+    )
+
+
+@mock.patch("requests.post")
+def test_state_manager_enqueue(mocked_request):
+    # Test parameters are correct
+    resp = state_manager_enqueue(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "unheld_service",
+        "unheld_lock",
+        "LockTable",
+    )
+    params = {
+        "LockName": "unheld_lock",
+        "ServiceName": "unheld_service",
+        "LockTableName": "LockTable",
+    }
+    mocked_request.assert_called_once_with(
+        url="https://api_route.execute-api.us-west-2.amazonaws.com/api/enqueue",
+        json=params,
+    )
+
+
+@mock.patch("requests.post")
+def test_state_manager_acquire_with_priority(mocked_request):
+    # Test parameters are correct
+    resp = state_manager_acquire(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "unheld_service",
+        "unheld_lock",
+        "LockTable",
+        "RegisteredServices",
+        priority=10,
+    )
+    params = {
+        "LockName": "unheld_lock",
+        "ServiceName": "unheld_service",
+        "LockTableName": "LockTable",
+        "ServiceTableName": "RegisteredServices",
+        "Priority": 10,
+    }
+    mocked_request.assert_called_once_with(
+        url="https://api_route.execute-api.us-west-2.amazonaws.com/api/acquire",
+        json=params,
+    )
+
+
+@mock.patch("requests.post")
+def test_state_manager_release_with_idempotency_key(mocked_request):
+    # Test parameters are correct
+    resp = state_manager_release(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "held_service",
+        "held_lock",
+        "101",
+        "LockTable",
+        "LogTable",
+        idempotency_key="release-1",
+    )
+    params = {
+        "LockName": "held_lock",
+        "ServiceName": "held_service",
+        "JobId": "101",
+        "LockTableName": "LockTable",
+        "LogTableName": "LogTable",
+        "IdempotencyKey": "release-1",
+    }
+    mocked_request.assert_called_once_with(
+        url="https://api_route.execute-api.us-west-2.amazonaws.com/api/release",
+        json=params,
+    )
+
+
+def mock_response(status_code, body):
+    response = mock.MagicMock(status_code=status_code)
+    response.json.return_value = body
+    return response
+
+
+@mock.patch("time.sleep")
+def test_lock_client_lock(mocked_sleep):
+    acquired = {"JobId": "101", "FencingToken": 5, "LockAcquireDateTime": "2020"}
+    session = mock.MagicMock()
+    session.post.side_effect = [
+        mock_response(409, {"Message": "Unable to acquire a lock"}),
+        mock_response(200, {"ResponseMetadata": acquired}),
+        mock_response(200, {"ResponseMetadata": {}}),
+    ]
+    client = LockClient(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "held_service",
+        "LockTable",
+        "RegisteredServices",
+        "LogTable",
+        session=session,
+    )
+
+    # The lock is released even though the body raised
+    with pytest.raises(ValueError):
+        with client.lock("held_lock", lease_duration=60) as lock:
+            assert lock == acquired
+            raise ValueError()
+
+    first_acquire, second_acquire, release = session.post.call_args_list
+    # A busy lock is retried with the same key, so a lost response can be replayed
+    assert first_acquire.kwargs["json"] == second_acquire.kwargs["json"]
+    assert second_acquire.kwargs["json"]["LeaseDuration"] == 60
+    assert mocked_sleep.call_count == 1
+    params = release.kwargs["json"]
+    assert release.kwargs["url"].endswith("/release")
+    assert (params["JobId"], params["FencingToken"]) == ("101", 5)
+    assert params["LockAcquireDateTime"] == "2020"
+
+
+@mock.patch("time.sleep")
+def test_lock_client_gives_up(mocked_sleep):
+    session = mock.MagicMock()
+    session.post.return_value = mock_response(409, {"Message": "Unable to acquire a lock"})
+    client = LockClient(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "unheld_service",
+        "LockTable",
+        "RegisteredServices",
+        "LogTable",
+        max_attempts=3,
+        session=session,
+    )
+    with pytest.raises(LockNotAcquiredError):
+        client.acquire("held_lock")
+    assert session.post.call_count == 3
+
+    # Releases are only retried when the API or the connection failed
+    session.post.reset_mock()
+    session.post.side_effect = [
+        requests.exceptions.ConnectionError(),
+        mock_response(500, {"Message": "Unexpected exception occurred"}),
+        mock_response(409, {"Message": "Unable to release lock"}),
+    ]
+    with pytest.raises(LockClientError):
+        client.release("held_lock", {"JobId": "101"})
+    assert session.post.call_count == 3
+
+
+@mock.patch("time.sleep")
+def test_lock_client_retries_only_idempotent_requests(mocked_sleep):
+    session = mock.MagicMock()
+    client = LockClient(
+        "https://api_route.execute-api.us-west-2.amazonaws.com/api/",
+        "unheld_service",
+        "LockTable",
+        "RegisteredServices",
+        "LogTable",
+        max_attempts=3,
+        session=session,
+    )
+
+    # A semaphore acquire that may have gone through isn't sent again
+    session.post.side_effect = [requests.exceptions.ReadTimeout()]
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.acquire("semaphore_lock", mode="semaphore")
+    assert session.post.call_count == 1
+
+    session.post.reset_mock()
+    session.post.side_effect = [
+        mock_response(502, {"Message": "Bad Gateway"}),
+    ]
+    with pytest.raises(LockClientError):
+        client.release("shared_lock", {"JobId": "101"}, mode="shared")
+    assert session.post.call_count == 1
+
+    # One that never reached the API is
+    session.post.reset_mock()
+    session.post.side_effect = [
+        requests.exceptions.ConnectTimeout(),
+        mock_response(200, {"ResponseMetadata": {"JobId": "101"}}),
+    ]
+    assert client.acquire("semaphore_lock", mode="semaphore") == {"JobId": "101"}
+    assert session.post.call_count == 2
@@ -0,0 +1,384 @@
+import json
+import pytest
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from chalice.config import Config
+from chalice.local import LocalGateway
+
+from Sling.chalicelib import api
+from Sling.chalicelib.storage import (
+    LocalClient,
+    LocalTables,
+    MemoryClient,
+    SQLiteClient,
+    create_tables,
+    dynamodb_client_config,
+    get_client,
+)
+
+from .conftest import app
+from .constants import *
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def local_client(request, tmp_path):
+    if request.param == "memory":
+        client = MemoryClient()
+    else:
+        client = SQLiteClient(str(tmp_path / "sling.db"))
+    create_tables(client, LOCK_TABLE_NAME, SERVICE_TABLE_NAME, LOG_TABLE_NAME)
+    return client
+
+
+@pytest.fixture
+def local_gateway(local_client, monkeypatch):
+    """Serves the lock API from a local backend holding a registered service."""
+
+    monkeypatch.setattr(
+        api.SingletonDynamoDBClient, "_SingletonDynamoDBClient__instance", local_client
+    )
+    api.service_registry.clear()
+    local_client.put_item(
+        TableName=SERVICE_TABLE_NAME, Item={"ServiceName": {"S": "local_service"}}
+    )
+    return LocalGateway(app, Config())
+
+
+def post(gateway, path, body):
+    response = gateway.handle_request(
+        method="POST",
+        path=path,
+        headers={"Content-Type": "application/json"},
+        body=json.dumps(body),
+    )
+    return response["statusCode"], json.loads(response["body"])
+
+
+def test_get_client():
+    assert isinstance(get_client("memory"), MemoryClient)
+    with pytest.raises(ValueError):
+        get_client("unknown")
+
+
+def test_local_backends_are_abstract():
+    # A backend missing part of its storage fails when it is built, not when it is used
+    with pytest.raises(TypeError):
+        LocalClient()
+    with pytest.raises(TypeError):
+        LocalTables()
+
+
+def test_dynamodb_client_config():
+    config = dynamodb_client_config({"read_timeout": 5, "retry_mode": "standard"})
+    assert config.read_timeout == 5
+    assert config.connect_timeout == 1
+    assert config.retries == {"mode": "standard", "max_attempts": 3}
+
+
+def test_get_dynamodb_client_warms_up(monkeypatch):
+    calls = []
+    config = {
+        "lock_table_name": LOCK_TABLE_NAME,
+        "dynamodb_client": {"max_pool_connections": 20, "warm_up": True},
+    }
+    monkeypatch.setattr(
+        "botocore.client.BaseClient._make_api_call",
+        lambda client, operation_name, params: calls.append((operation_name, params)),
+    )
+
+    # Outside Lambda, nothing is sent while the client is built
+    monkeypatch.delenv("AWS_LAMBDA_FUNCTION_NAME", raising=False)
+    client = get_client("dynamodb", config=config)
+    assert client.meta.config.max_pool_connections == 20
+    assert calls == []
+
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "sling-dev")
+    get_client("dynamodb", config=config)
+    assert calls == [("DescribeTable", {"TableName": LOCK_TABLE_NAME})]
+
+
+def test_update_item(local_client):
+    key = {"LockName": {"S": "queued_lock"}}
+    update = {
+        "TableName": LOCK_TABLE_NAME,
+        "Key": key,
+        "UpdateExpression": "SET QueueTail = if_not_exists(QueueTail, :zero) + :one ADD Waiters :waiter",
+        "ExpressionAttributeValues": {
+            ":zero": {"N": "0"},
+            ":one": {"N": "1"},
+            ":waiter": {"SS": ["a"]},
+        },
+        "ReturnValues": "ALL_NEW",
+    }
+    response = local_client.update_item(**update)
+    assert response["Attributes"] == {
+        "LockName": {"S": "queued_lock"},
+        "QueueTail": {"N": "1"},
+        "Waiters": {"SS": ["a"]},
+    }
+    response = local_client.update_item(**dict(update, ReturnValues="UPDATED_NEW"))
+    assert response["Attributes"]["QueueTail"] == {"N": "2"}
+    assert "LockName" not in response["Attributes"]
+
+    response = local_client.batch_get_item(
+        RequestItems={
+            LOCK_TABLE_NAME: {
+                "Keys": [key, {"LockName": {"S": "missing_lock"}}],
+                "ConsistentRead": True,
+            }
+        }
+    )
+    assert response["Responses"][LOCK_TABLE_NAME] == [
+        local_client.get_item(TableName=LOCK_TABLE_NAME, Key=key)["Item"]
+    ]
+
+    # Removing the last element of a set removes the attribute
+    local_client.update_item(
+        TableName=LOCK_TABLE_NAME,
+        Key=key,
+        UpdateExpression="DELETE Waiters :waiter",
+        ConditionExpression="contains(Waiters, :member) AND size(Waiters) = :one",
+        ExpressionAttributeValues={
+            ":waiter": {"SS": ["a"]},
+            ":member": {"S": "a"},
+            ":one": {"N": "1"},
+        },
+    )
+    item = local_client.get_item(TableName=LOCK_TABLE_NAME, Key=key)["Item"]
+    assert "Waiters" not in item
+
+    with pytest.raises(ClientError) as e:
+        local_client.update_item(
+            TableName=LOCK_TABLE_NAME,
+            Key=key,
+            UpdateExpression="SET QueueTail = :zero",
+            ConditionExpression="attribute_not_exists(QueueTail) OR QueueTail < :one",
+            ExpressionAttributeValues={":zero": {"N": "0"}, ":one": {"N": "1"}},
+        )
+    assert e.value.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
+
+def test_nested_map_update(local_client):
+    key = {"LockName": {"S": "semaphore_lock"}}
+    local_client.put_item(
+        TableName=LOCK_TABLE_NAME, Item=dict(key, Holders={"M": {}})
+    )
+    local_client.update_item(
+        TableName=LOCK_TABLE_NAME,
+        Key=key,
+        UpdateExpression="SET Holders.#job_id = :holder",
+        ExpressionAttributeNames={"#job_id": "job-1"},
+        ExpressionAttributeValues={":holder": {"M": {"ServiceName": {"S": "a"}}}},
+    )
+    local_client.update_item(
+        TableName=LOCK_TABLE_NAME,
+        Key=key,
+        UpdateExpression="REMOVE Holders.#job_id",
+        ConditionExpression="Holders.#job_id.ServiceName = :held_by",
+        ExpressionAttributeNames={"#job_id": "job-1"},
+        ExpressionAttributeValues={":held_by": {"S": "a"}},
+    )
+    item = local_client.get_item(TableName=LOCK_TABLE_NAME, Key=key)["Item"]
+    assert item["Holders"] == {"M": {}}
+
+    # A path under a missing map can't be set
+    with pytest.raises(ClientError) as e:
+        local_client.update_item(
+            TableName=LOCK_TABLE_NAME,
+            Key=key,
+            UpdateExpression="SET Missing.#job_id = :holder",
+            ExpressionAttributeNames={"#job_id": "job-1"},
+            ExpressionAttributeValues={":holder": {"S": "a"}},
+        )
+    assert e.value.response["Error"]["Code"] == "ValidationException"
+
+
+def test_transact_write_items_is_all_or_nothing(local_client):
+    lock_key = {"LockName": {"S": "unheld_lock"}}
+    local_client.put_item(
+        TableName=LOCK_TABLE_NAME, Item=dict(lock_key, HeldBy={"S": ""})
+    )
+    with pytest.raises(ClientError) as e:
+        local_client.transact_write_items(
+            TransactItems=[
+                api.service_check_item(SERVICE_TABLE_NAME, "unregistered_service"),
+                {
+                    "Update": {
+                        "TableName": LOCK_TABLE_NAME,
+                        "Key": lock_key,
+                        "UpdateExpression": "SET HeldBy = :held_by",
+                        "ExpressionAttributeValues": {":held_by": {"S": "a"}},
+                    }
+                },
+            ]
+        )
+    assert e.value.response["Error"]["Code"] == "TransactionCanceledException"
+    assert api.service_check_failed(e.value)
+    item = local_client.get_item(TableName=LOCK_TABLE_NAME, Key=lock_key)["Item"]
+    assert item["HeldBy"] == {"S": ""}
+
+    with pytest.raises(ClientError) as e:
+        local_client.transact_write_items(
+            TransactItems=[
+                {"ConditionCheck": {"TableName": "MissingTable", "Key": lock_key}}
+            ]
+        )
+    assert e.value.response["Error"]["Code"] == "ResourceNotFoundException"
+
+
+def test_lock_api(local_gateway):
+    lock = {"LockName": "local_lock", "LockTableName": LOCK_TABLE_NAME}
+    holder = dict(
+        lock, ServiceName="local_service", ServiceTableName=SERVICE_TABLE_NAME
+    )
+    assert post(local_gateway, "/register_lock", lock)[0] == 200
+
+    status, body = post(local_gateway, "/acquire", holder)
+    assert status == 200
+    job_id = body["ResponseMetadata"]["JobId"]
+    assert post(local_gateway, "/acquire", holder)[0] == 409
+    assert post(local_gateway, "/acquire", dict(holder, Mode="shared"))[0] == 409
+
+    release = dict(holder, JobId=job_id, LogTableName=LOG_TABLE_NAME)
+    assert post(local_gateway, "/release", release)[0] == 200
+    assert post(local_gateway, "/release", release)[0] == 409
+
+    status, body = post(local_gateway, "/acquire", dict(holder, Mode="shared"))
+    assert status == 200
+    status, body = post(local_gateway, "/lock_status", lock)
+    assert body["ReaderCount"] == 1
+
+    for position in [0, 1]:
+        status, body = post(local_gateway, "/enqueue", holder)
+        assert status == 200
+        assert body["ResponseMetadata"]["Position"] == position
+
+
+def test_semaphore_api(local_gateway):
+    lock = {"LockName": "local_semaphore", "LockTableName": LOCK_TABLE_NAME}
+    holder = dict(
+        lock,
+        ServiceName="local_service",
+        ServiceTableName=SERVICE_TABLE_NAME,
+        Mode="semaphore",
+    )
+    assert post(local_gateway, "/register_lock", dict(lock, Permits=2))[0] == 200
+
+    job_ids = []
+    for fencing_token in [1, 2]:
+        status, body = post(local_gateway, "/acquire", holder)
+        assert status == 200
+        assert body["ResponseMetadata"]["FencingToken"] == fencing_token
+        job_ids.append(body["ResponseMetadata"]["JobId"])
+    assert post(local_gateway, "/acquire", holder)[0] == 409
+
+    release = dict(holder, JobId=job_ids[0], LogTableName=LOG_TABLE_NAME)
+    assert post(local_gateway, "/release", release)[0] == 200
+    assert post(local_gateway, "/acquire", holder)[0] == 200
+
+
+def test_hierarchical_api(local_gateway):
+    holder = {
+        "LockTableName": LOCK_TABLE_NAME,
+        "ServiceName": "local_service",
+        "ServiceTableName": SERVICE_TABLE_NAME,
+    }
+    for lock_name in ["repo", "repo/main"]:
+        lock = {"LockName": lock_name, "LockTableName": LOCK_TABLE_NAME}
+        assert post(local_gateway, "/register_lock", lock)[0] == 200
+
+    status, body = post(
+        local_gateway, "/acquire", dict(holder, LockName="repo/main", Hierarchical=True)
+    )
+    assert status == 200
+    assert post(local_gateway, "/acquire", dict(holder, LockName="repo"))[0] == 409
+
+    release = dict(
+        holder,
+        LockName="repo/main",
+        Hierarchical=True,
+        JobId=body["ResponseMetadata"]["JobId"],
+        LogTableName=LOG_TABLE_NAME,
+    )
+    assert post(local_gateway, "/release", release)[0] == 200
+    status, body = post(local_gateway, "/acquire", dict(holder, LockName="repo"))
+    assert status == 200
+
+    # A holder below that lets its lease run out doesn't keep the ancestor out
+    release = dict(
+        holder,
+        LockName="repo",
+        JobId=body["ResponseMetadata"]["JobId"],
+        LogTableName=LOG_TABLE_NAME,
+    )
+    assert post(local_gateway, "/release", release)[0] == 200
+    status, body = post(
+        local_gateway,
+        "/acquire",
+        dict(holder, LockName="repo/main", Hierarchical=True, LeaseDuration=0.1),
+    )
+    assert status == 200
+    assert post(local_gateway, "/acquire", dict(holder, LockName="repo"))[0] == 409
+    time.sleep(0.2)
+    assert post(local_gateway, "/acquire", dict(holder, LockName="repo"))[0] == 200
+
+
+def test_sqlite_concurrent_acquires(tmp_path):
+    database = str(tmp_path / "sling.db")
+    create_tables(
+        SQLiteClient(database), LOCK_TABLE_NAME, SERVICE_TABLE_NAME, LOG_TABLE_NAME
+    )
+    SQLiteClient(database).put_item(
+        TableName=LOCK_TABLE_NAME,
+        Item={"LockName": {"S": "contended_lock"}, "HeldBy": {"S": ""}},
+    )
+
+    # Every thread has its own client, as separate processes sharing the file would
+    results = []
+
+    def acquire(service_name):
+        try:
+            SQLiteClient(database).update_item(
+                TableName=LOCK_TABLE_NAME,
+                Key={"LockName": {"S": "contended_lock"}},
+                UpdateExpression="SET HeldBy = :held_by",
+                ConditionExpression="HeldBy = :empty_string",
+                ExpressionAttributeValues={
+                    ":held_by": {"S": service_name},
+                    ":empty_string": {"S": ""},
+                },
+            )
+            results.append(service_name)
+        except ClientError:
+            pass
+
+    threads = [
+        threading.Thread(target=acquire, args=("service_%s" % i,)) for i in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 1
+    item = SQLiteClient(database).get_item(
+        TableName=LOCK_TABLE_NAME, Key={"LockName": {"S": "contended_lock"}}
+    )["Item"]
+    assert item["HeldBy"] == {"S": results[0]}
+
+
+def test_sqlite_reads_dont_wait_on_writers(tmp_path):
+    database = str(tmp_path / "sling.db")
+    client = SQLiteClient(database)
+    create_tables(client, LOCK_TABLE_NAME, SERVICE_TABLE_NAME, LOG_TABLE_NAME)
+    key = {"LockName": {"S": "written_lock"}}
+    client.put_item(TableName=LOCK_TABLE_NAME, Item=dict(key, HeldBy={"S": ""}))
+
+    # Another process is in the middle of a write
+    writer, reader = SQLiteClient(database), SQLiteClient(database)
+    with writer.transaction() as tables:
+        tables.write(LOCK_TABLE_NAME, key, dict(key, HeldBy={"S": "writer"}))
+        item = reader.get_item(TableName=LOCK_TABLE_NAME, Key=key)["Item"]
+        assert item["HeldBy"] == {"S": ""}